@@ -1,5 +1,14 @@
 from .elements import *
 from .particle import *
+from .losses import *
 from .tracking import *
 from .plotting import *
 from .other import *
+from .adaptive import *
+from .lattice import *
+from .store import *
+from .madx import *
+from .acceptance import *
+from .scan import *
+from .montecarlo import *
+from .profiling import LineProfile, instrument
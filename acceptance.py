@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Analytic acceptance for MAD-X-like tracking in python.         #
+#                                                                      #
+########################################################################
+
+import numpy as np
+from .elements import (Drift, Kicker, Quadrupole, DoubleApDrift, Septum,
+                       QuadHole, TransferMap)
+from .losses import losscodes
+
+__all__ = ['polygon_area', 'Acceptance']
+
+##################################################
+#                                                #
+#   Convex polygons                              #
+#                                                #
+##################################################
+
+def _cut(polygon, a, d):
+    """Parts of a convex polygon where a.z+d <= 0 and where it is > 0.
+
+    Either part is None if empty.
+    """
+    v = polygon @ a + d
+    if (v <= 0).all():
+        return polygon, None
+    if (v > 0).all():
+        return None, polygon
+    inside = []
+    outside = []
+    n = len(polygon)
+    for i in range(n):
+        p, q = polygon[i], polygon[(i+1) % n]
+        vp, vq = v[i], v[(i+1) % n]
+        (inside if vp <= 0 else outside).append(p)
+        if (vp <= 0) != (vq <= 0):
+            point = p + vp / (vp - vq) * (q - p)
+            inside.append(point)
+            outside.append(point)
+    return _polygon(inside), _polygon(outside)
+
+def _polygon(points):
+    """Array of points, None if they enclose no area"""
+    if len(points) < 3:
+        return None
+    points = np.array(points)
+    if polygon_area(points) == 0:
+        return None
+    return points
+
+def polygon_area(polygon):
+    """Area of a polygon given as an (n, 2) array of vertices"""
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+##################################################
+#                                                #
+#   Acceptance                                   #
+#                                                #
+##################################################
+
+class _Piece:
+    """Convex region of initial (x, px), mapped affinely to (x, px) now"""
+    def __init__(self, polygon, matrix, offset):
+        self.polygon = polygon
+        self.matrix = matrix
+        self.offset = offset
+
+    def mapped(self, matrix, offset):
+        return _Piece(self.polygon, matrix @ self.matrix,
+                      matrix @ self.offset + offset)
+
+def _drift_map(length):
+    return np.array([[1.0, length], [0.0, 1.0]]), np.zeros(2)
+
+class Acceptance:
+    """Regions of initial (x, px) by loss category, as polygons.
+
+    Within an element every particle follows an affine map of its
+    initial (x, px), as long as it stays on one side of a septum,
+    collimator or QuadHole. The set of initial conditions passing an
+    aperture edge is then a half-plane, and the regions ending in each
+    loss category are convex polygons, cut out of the window
+    [xmin, xmax] x [xpmin, xpmax] by clipping. Edges only checked at
+    the element ends in track() are exact. Curved trajectories in the
+    field of kickers and septa are constrained at samples points along
+    the element, which bounds the region of survivors from outside.
+
+    polygons maps each loss label, 'CIRCULATING' for particles that
+    leave the line, to a list of (n, 2) arrays of vertices.
+
+    Septa with zero blade thickness are not supported, since the
+    virtual blade crossing is not an affine function of the initial
+    conditions. Kickers are treated physically, also for negative
+    bending angles with an aperture.
+    """
+    def __init__(self, line, xmin, xmax, xpmin, xpmax, samples=16):
+        self.xmin = xmin
+        self.xmax = xmax
+        self.xpmin = xpmin
+        self.xpmax = xpmax
+        self.samples = samples
+        self.polygons = {}
+        window = np.array([[xmin, xpmin], [xmax, xpmin],
+                           [xmax, xpmax], [xmin, xpmax]], dtype=float)
+        pieces = [_Piece(window, np.identity(2), np.zeros(2))]
+        for element in line:
+            pieces = self._element(element, pieces)
+        for piece in pieces:
+            self._lose(piece, 'CIRCULATING')
+
+    def area(self, label='CIRCULATING'):
+        """Area of the region of label in mm*mrad"""
+        return 1E6 * sum(polygon_area(polygon)
+                         for polygon in self.polygons.get(label, ()))
+
+    def areas(self):
+        """Dict of the area of every loss label in mm*mrad"""
+        return {label: self.area(label) for label in self.polygons}
+
+    def codes(self, x, px):
+        """Loss codes of losscodes for initial conditions x, px.
+
+        Points outside the window, or on a boundary between regions,
+        may get either code or stay 0.
+        """
+        x, px = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                    np.asarray(px, dtype=float))
+        codes = np.zeros(x.shape, dtype=losscodes.dtype())
+        for label, polygons in self.polygons.items():
+            code = losscodes.code(label)
+            for polygon in polygons:
+                inside = np.ones(x.shape, dtype=bool)
+                edges = np.roll(polygon, -1, axis=0) - polygon
+                # Sign of the shoelace sum, clipping keeps it
+                orientation = np.sign(np.sum(polygon[:, 0]*edges[:, 1]
+                                             - polygon[:, 1]*edges[:, 0]))
+                for (x0, px0), (dx, dpx) in zip(polygon, edges):
+                    inside &= orientation * (dx*(px-px0) - dpx*(x-x0)) >= 0
+                codes[inside] = code
+        return codes
+
+    def _lose(self, piece, label):
+        self.polygons.setdefault(label, []).append(piece.polygon)
+
+    def _split(self, pieces, a, d, label):
+        """Lose the parts of pieces where a.(x, px)+d > 0 now"""
+        kept = []
+        for piece in pieces:
+            # In initial coordinates
+            inside, outside = _cut(piece.polygon, a @ piece.matrix,
+                                   a @ piece.offset + d)
+            if outside is not None:
+                self._lose(_Piece(outside, piece.matrix, piece.offset),
+                           label)
+            if inside is not None:
+                kept.append(_Piece(inside, piece.matrix, piece.offset))
+        return kept
+
+    def _above(self, pieces, edge, label, length=0.0):
+        """Lose pieces with x > edge after a drift of length"""
+        return self._split(pieces, np.array([1.0, length]), -edge, label)
+
+    def _below(self, pieces, edge, label, length=0.0):
+        """Lose pieces with x < edge after a drift of length"""
+        return self._split(pieces, np.array([-1.0, -length]), edge, label)
+
+    def _branch(self, pieces, edge):
+        """Pieces with x < edge and with x >= edge"""
+        below = []
+        above = []
+        for piece in pieces:
+            inside, outside = _cut(piece.polygon, piece.matrix[0],
+                                   piece.offset[0] - edge)
+            if inside is not None:
+                below.append(_Piece(inside, piece.matrix, piece.offset))
+            if outside is not None:
+                above.append(_Piece(outside, piece.matrix, piece.offset))
+        return below, above
+
+    def _curved(self, pieces, length, quadraticA, edge, slope, label,
+                side):
+        """Lose pieces crossing a moving edge on a parabolic path.
+
+        x(s) = x + px*s + quadraticA*s**2 is compared to the edge
+        edge + slope*s, losing the particles below it (side -1) or
+        above it (side 1) at any of the sampled s.
+        """
+        for s in np.linspace(0, length, self.samples)[1:]:
+            a = side * np.array([1.0, s])
+            d = side * (quadraticA*s**2 - edge - slope*s)
+            pieces = self._split(pieces, a, d, label)
+        return pieces
+
+    def _element(self, element, pieces):
+        if not pieces:
+            return pieces
+        if isinstance(element, TransferMap):
+            return [piece.mapped(element.matrix, element.offset)
+                    for piece in pieces]
+        if isinstance(element, QuadHole):
+            cache = element._cached()
+            outside, hole = self._branch(pieces, element.haaxu-element.hr)
+            hole, above = self._branch(hole, element.haaxu+element.hr)
+            return (self._element(cache.hole, hole)
+                    + self._element(cache.circ, outside + above))
+        if not isinstance(element, (Drift, Kicker, Quadrupole, DoubleApDrift,
+                                    Septum)):
+            raise ValueError("No acceptance model for element " +
+                             str(element.name) + " of type " +
+                             type(element).__name__)
+        cache = element._cached()
+        if getattr(cache, 'drift', None) is not None:
+            return self._element(cache.drift, pieces)
+        labels = {location: losscodes.label(code)
+                  for location, code in element.codes.items()}
+        length = element.len
+        if isinstance(element, Drift):
+            if element.r > 0:
+                pieces = self._above(pieces, element.offset_u+element.r,
+                                     labels['start'])
+                pieces = self._below(pieces, element.offset_u-element.r,
+                                     labels['start'])
+                pieces = self._above(pieces, element.offset_d+element.r,
+                                     labels['down'], length)
+                pieces = self._below(pieces, element.offset_d-element.r,
+                                     labels['down'], length)
+            return [piece.mapped(*_drift_map(length)) for piece in pieces]
+        if isinstance(element, Kicker):
+            if element.r > 0:
+                pieces = self._above(pieces, element.r, labels['start'])
+                pieces = self._below(pieces, -element.r, labels['start'])
+                pieces = self._curved(pieces, length, cache.quadraticA,
+                                      element.r, 0.0, labels['down'], 1)
+                pieces = self._curved(pieces, length, cache.quadraticA,
+                                      -element.r, 0.0, labels['down'], -1)
+            matrix = np.array([[1.0, length], [0.0, 1.0]])
+            offset = np.array([element.an/2 * length, element.an])
+            return [piece.mapped(matrix, offset) for piece in pieces]
+        if isinstance(element, Quadrupole):
+            r = element.r
+            if r > 0:
+                pieces = self._above(pieces, element.offset_au+r,
+                                     labels['start'])
+                pieces = self._below(pieces, element.offset_au-r,
+                                     labels['start'])
+            sk = cache.sk
+            if element.k > 0:
+                matrix = np.array([[cache.cos, cache.sin/sk],
+                                   [-1.0*sk*cache.sin, cache.cos]])
+            else:
+                matrix = np.array([[cache.cosh, cache.sinh/sk],
+                                   [sk*cache.sinh, cache.cosh]])
+            offset = (np.array([element.offset_f, 0.0])
+                      - matrix[:, 0]*element.offset_f)
+            pieces = [piece.mapped(matrix, offset) for piece in pieces]
+            if r > 0:
+                pieces = self._above(pieces, element.offset_ad+r,
+                                     labels['down'])
+                pieces = self._below(pieces, element.offset_ad-r,
+                                     labels['down'])
+            return pieces
+        if isinstance(element, DoubleApDrift):
+            up, down = element.collpos_up, element.collpos_down
+            half = element.coll_thick/2
+            circ, extr = self._start(pieces, element, up, half, 'coll',
+                                     labels)
+            if element.cdiam > 0:
+                circ = self._below(circ, down-element.cdiam,
+                                   labels['down_circ'], length)
+            circ = self._above(circ, down-half, labels['down_coll_circ'],
+                               length)
+            if element.ediam > 0:
+                extr = self._above(extr, down+element.ediam,
+                                   labels['down_extr'], length)
+            extr = self._below(extr, down+half, labels['down_coll_extr'],
+                               length)
+            return [piece.mapped(*_drift_map(length))
+                    for piece in circ + extr]
+        # Septum
+        if element.blade_thick <= 0:
+            raise ValueError("No acceptance model for septum " +
+                             str(element.name) + " with a virtual blade")
+        up, down = element.bladepos_up, element.bladepos_down
+        half = element.blade_thick/2
+        circ, extr = self._start(pieces, element, up, half, 'blade', labels)
+        if element.cdiam > 0:
+            circ = self._below(circ, down-element.cdiam, labels['down_circ'],
+                               length)
+        circ = self._above(circ, down-half, labels['down_blade_circ'],
+                           length)
+        extr = self._curved(extr, length, cache.quadraticA, up+half,
+                            cache.slope, labels['down_blade_extr'], -1)
+        if element.ediam > 0:
+            extr = self._curved(extr, length, cache.quadraticA,
+                                up+element.ediam, cache.slope,
+                                labels['down_extr'], 1)
+        matrix = np.array([[1.0, length], [0.0, 1.0]])
+        offset = np.array([element.an/2 * length, element.an])
+        return ([piece.mapped(*_drift_map(length)) for piece in circ]
+                + [piece.mapped(matrix, offset) for piece in extr])
+
+    def _start(self, pieces, element, up, half, wall, labels):
+        """Upstream checks of DoubleApDrift and Septum, then branch"""
+        if element.ediam > 0:
+            pieces = self._above(pieces, up+element.ediam,
+                                 labels['start_extr'])
+        if element.cdiam > 0:
+            pieces = self._below(pieces, up-element.cdiam,
+                                 labels['start_circ'])
+        circ, extr = self._branch(pieces, up-half)
+        hit, extr = self._branch(extr, up+half)
+        for piece in hit:
+            self._lose(piece, labels['start_' + wall])
+        return circ, extr
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Adaptive acceptance grids for MAD-X-like tracking in python.   #
+#                                                                      #
+########################################################################
+
+import numpy as np
+from .particle import ParticleBank
+from .tracking import track_bank
+from .losses import losscodes
+from .plotting import _color_table
+
+__all__ = ['AdaptiveGrid']
+
+# Largest cells left to the boundary following rather than split
+_SMALLEST = 8
+
+##################################################
+#                                                #
+#   AdaptiveGrid                                 #
+#                                                #
+##################################################
+
+class AdaptiveGrid:
+    """Acceptance grid refined only where the loss category changes.
+
+    Covers the same gridpoints as TrackGrid with the same arguments,
+    but first tracks a coarse lattice with a spacing of 2**levels
+    points. Cells whose corners, edge midpoints and centre end up in
+    different categories, the loss codes themselves or the colours of
+    colorcodes if given, are split in four, other cells are filled
+    with the loss code of their first corner. With edges, splitting
+    stops at cells _SMALLEST gridpoints across, and loss boundaries are
+    then followed at full resolution: every untracked gridpoint next to
+    (also diagonally) a tracked point with another loss code than it
+    was filled with is tracked, until no more are found. This catches
+    boundaries, e.g. along a thin septum blade band, that run between
+    the points of a cell as long as they cross a tracked point
+    somewhere. Without edges, cells are split down to single
+    gridpoints instead.
+
+    The number of particles tracked grows with the length of the loss
+    boundaries rather than with the area of the grid, so the savings
+    grow with the resolution and larger levels pay off on finer grids.
+    Features that never touch a tracked point, e.g. islands smaller
+    than a coarse cell, are missed; lower levels make that less likely.
+
+    particles holds the resulting raster of loss codes, so the grid
+    can be passed to acceptanceplot like a TrackGrid. It holds no
+    final states, so loss positions, e.g. for lossmap(), need a
+    TrackGrid. leaves lists the cells filled before following the
+    boundaries as rows (i0, i1, j0, j1, code), inclusive corners.
+    """
+    def __init__(self, line, xmin, xmax, xres, xpmin, xpmax, xpres,
+                 levels=4, colorcodes=None, edges=True):
+        self.xmin = xmin
+        self.xmax = xmax
+        self.xres = xres
+        self.xpmin = xpmin
+        self.xpmax = xpmax
+        self.xpres = xpres
+
+        self.nx = round((xmax-xmin)/xres)
+        self.npx = round((xpmax-xpmin)/xpres)
+
+        self.particles = np.zeros((self.nx, self.npx),
+                                  dtype=losscodes.dtype())
+        self.tracked = np.zeros((self.nx, self.npx), dtype=bool)
+        self.colorcodes = colorcodes
+
+        step = 2**levels
+        smallest = _SMALLEST if edges else 1
+        xs = np.union1d(np.arange(0, self.nx, step), [self.nx-1])
+        ys = np.union1d(np.arange(0, self.npx, step), [self.npx-1])
+        # Single row or column grids still need one (flat) cell
+        xs = np.append(xs, xs[-1]) if len(xs) == 1 else xs
+        ys = np.append(ys, ys[-1]) if len(ys) == 1 else ys
+        i0, j0 = np.meshgrid(xs[:-1], ys[:-1], indexing='ij')
+        i1, j1 = np.meshgrid(xs[1:], ys[1:], indexing='ij')
+        cells = np.stack((i0.ravel(), i1.ravel(), j0.ravel(), j1.ravel()))
+
+        leaves = []
+        while cells.shape[1] > 0:
+            i0, i1, j0, j1 = cells
+            im = (i0+i1) // 2
+            jm = (j0+j1) // 2
+            # Corners, edge midpoints and centre, the corners of the
+            # children if the cell is split
+            points = self._categories(
+                line, np.concatenate((i0, i0, i1, i1, im, im, i0, i1, im)),
+                np.concatenate((j0, j1, j0, j1, j0, j1, jm, jm, jm)))
+            points = points.reshape(9, -1)
+            uniform = (points == points[0]).all(axis=0)
+            # Split the others, unless all their points are corners,
+            # or left to the boundary following once small
+            split = ~uniform & ((i1-i0 > smallest) | (j1-j0 > smallest))
+            leaves.append(cells[:, ~split])
+            cells = self._split(cells[:, split])
+
+        self.leaves = np.concatenate(leaves, axis=1).transpose()
+        self.leaves = np.column_stack((self.leaves,
+                                       self.particles[self.leaves[:, 0],
+                                                      self.leaves[:, 2]]))
+        self._fill()
+        if edges:
+            self._follow(line)
+
+    @property
+    def ntracked(self):
+        """Number of particles actually tracked"""
+        return int(self.tracked.sum())
+
+    def _fill(self):
+        """Fill the untracked points of the leaves with their code"""
+        i0, i1, j0, j1, code = self.leaves.transpose()
+        # Cells of one shape at a time, those with untracked points
+        # inside, i.e. larger than the 3x3 points sampled
+        shapes = np.stack((i1-i0, j1-j0), axis=1)
+        large = (shapes > 2).any(axis=1)
+        for di, dj in np.unique(shapes[large], axis=0):
+            same = large & (shapes[:, 0] == di) & (shapes[:, 1] == dj)
+            i = i0[same, None, None] + np.arange(di+1)[:, None]
+            j = j0[same, None, None] + np.arange(dj+1)
+            region = self.particles[i, j]
+            self.particles[i, j] = np.where(self.tracked[i, j], region,
+                                            code[same, None, None])
+
+    def _follow(self, line):
+        """Track untracked points next to a boundary, until none left"""
+        shape = self.tracked.shape
+        front = np.flatnonzero(self.tracked)
+        while len(front) > 0:
+            i, j = np.unravel_index(front, shape)
+            codes = self.particles[i, j]
+            todo = []
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    ni, nj = i + di, j + dj
+                    inside = ((ni >= 0) & (ni < shape[0])
+                              & (nj >= 0) & (nj < shape[1]))
+                    ni, nj = ni[inside], nj[inside]
+                    # Filled with another code than its neighbour
+                    doubt = ~self.tracked[ni, nj] & (
+                        self.particles[ni, nj] != codes[inside])
+                    todo.append(np.ravel_multi_index((ni[doubt], nj[doubt]),
+                                                     shape))
+            front = np.unique(np.concatenate(todo))
+            i, j = np.unravel_index(front, shape)
+            self._categories(line, i, j)
+
+    def _category(self, codes):
+        if self.colorcodes is None:
+            return codes
+        return _color_table(self.colorcodes)[codes]
+
+    def _categories(self, line, i, j):
+        """Track the untracked gridpoints (i, j), return categories"""
+        todo = ~self.tracked[i, j]
+        if todo.any():
+            index = np.unique(np.ravel_multi_index((i[todo], j[todo]),
+                                                   self.tracked.shape))
+            ti, tj = np.unravel_index(index, self.tracked.shape)
+            # due to matrix indexing we start at xmin,xpmax
+            bank = ParticleBank(self.xmin+ti*self.xres,
+                                self.xpmax-tj*self.xpres)
+            track_bank(bank, line)
+            self.particles[ti, tj] = bank.lost
+            self.tracked[ti, tj] = True
+        return self._category(self.particles[i, j])
+
+    @staticmethod
+    def _split(cells):
+        """Quarter cells, collapsing halves that would be empty"""
+        i0, i1, j0, j1 = cells
+        im = (i0+i1) // 2
+        jm = (j0+j1) // 2
+        children = np.concatenate((np.stack((i0, im, j0, jm)),
+                                   np.stack((im, i1, j0, jm)),
+                                   np.stack((i0, im, jm, j1)),
+                                   np.stack((im, i1, jm, j1))), axis=1)
+        ci0, ci1, cj0, cj1 = children
+        keep = ~((ci0 == ci1) & (np.tile(i1-i0, 4) > 0))
+        keep &= ~((cj0 == cj1) & (np.tile(j1-j0, 4) > 0))
+        return children[:, keep]
+
+    def raster(self, xres=None, xpres=None):
+        """Loss codes resampled to a regular raster of another resolution.
+
+        Uses the nearest gridpoint, so the native resolution returns
+        particles unchanged.
+        """
+        if xres is None:
+            xres = self.xres
+        if xpres is None:
+            xpres = self.xpres
+        nx = round((self.xmax-self.xmin)/xres)
+        npx = round((self.xpmax-self.xpmin)/xpres)
+        i = np.clip(np.rint(np.arange(nx)*xres/self.xres).astype(int),
+                    0, self.nx-1)
+        j = np.clip(np.rint(np.arange(npx)*xpres/self.xpres).astype(int),
+                    0, self.npx-1)
+        return self.particles[np.ix_(i, j)]
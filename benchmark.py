@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Benchmarks for MAD-X-like tracking in python.                  #
+#                                                                      #
+########################################################################
+
+# Usage: python -m linetracking.benchmark [-o results.json]
+#            [-b baseline.json] [--tolerance 0.2] [--quick]
+# Exits with status 1 if a case is slower than the baseline by more
+# than the tolerance.
+
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+from .elements import (Drift, Kicker, Quadrupole, DoubleApDrift, Septum,
+                       QuadHole)
+from .particle import Particle
+from .tracking import track, TrackGrid, TrackList
+from .plotting import _color_losses, acceptanceplot, trajectoryplot
+from . import jit
+
+__all__ = ['lss2_line', 'synthetic_line', 'measure', 'element_costs', 'run',
+           'compare', 'report', 'main']
+
+##################################################
+#                                                #
+#   Lines                                        #
+#                                                #
+##################################################
+
+def lss2_line():
+    """The SPS LSS2 extraction line of examples/sps_lss2_se.py"""
+    from .examples import sps_lss2_se
+    return sps_lss2_se.line
+
+# One element per kind, with apertures wide enough for the synthetic
+# beam of _synthetic_beam() to survive most of a long line
+_SYNTHETIC = {
+    'Drift': lambda name, sign: Drift(name, 1.0, 0.05),
+    'Kicker': lambda name, sign: Kicker(name, 1.0, 1E-10, 0.05),
+    'Quadrupole': lambda name, sign: Quadrupole(name, 1.0, sign*1E-4, 0.05),
+    'DoubleApDrift': lambda name, sign: DoubleApDrift(name, 1.0, 0.02, 0.02,
+                                                      0.001, 0.05, 0.05),
+    'Septum': lambda name, sign: Septum(name, 1.0, 1E-10, 0.02, 0.02,
+                                        0.0001, 0.05, 0.05),
+    'QuadHole': lambda name, sign: QuadHole(name, 1.0, sign*1E-4,
+                                            -sign*1.6E-5, 0.1, 0.01,
+                                            0.03, 0.03, 0.03),
+}
+
+# Elements register their loss labels in losscodes for good, so long
+# synthetic lines reuse a few names rather than one per element
+_NAMES = 10
+
+def synthetic_line(kind, nelements):
+    """Line of nelements elements of class name kind"""
+    return [_SYNTHETIC[kind]('BENCH_{0}{1}'.format(kind.upper(),
+                                                   index % _NAMES),
+                             1 - 2*(index % 2))
+            for index in range(nelements)]
+
+def _synthetic_beam(n):
+    x, px = np.meshgrid(np.linspace(-0.005, 0.005, n),
+                        np.linspace(-1E-6, 1E-6, n), indexing='ij')
+    return np.column_stack((x.ravel(), px.ravel()))
+
+# Grid of the LSS2 acceptance plots, nx*npx = size**2 points
+def _lss2_grid(line, size, **kwargs):
+    return TrackGrid(line, 0.035, 0.085, 0.05/size, -0.004, 0.002,
+                     0.006/size, **kwargs)
+
+##################################################
+#                                                #
+#   Measurements                                 #
+#                                                #
+##################################################
+
+def measure(function, particles, repeat=3):
+    """Time and peak memory of function(), tracking particles particles.
+
+    The time is the best of repeat runs. Peak memory is the largest
+    allocation seen by tracemalloc (which covers numpy arrays) during
+    one extra, untimed run.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds,
+            'particles': particles,
+            'rate': particles / seconds if seconds > 0 else float('inf'),
+            'peak_bytes': peak}
+
+def element_costs(line, inits, repeat=3):
+    """Batch tracking time per particle of every element in line.
+
+    The particles of inits enter each element in the state the
+    upstream elements left them in, so the cost includes the
+    element's own loss checks for a realistic beam.
+    """
+    inits = np.asarray(inits, dtype=float).reshape(-1, 2)
+    s = np.zeros(len(inits))
+    x = inits[:, 0].copy()
+    px = inits[:, 1].copy()
+    lost = np.zeros(len(inits), dtype=np.uint32)
+    alive = np.ones(len(inits), dtype=bool)
+    costs = []
+    for element in line:
+        nalive = int(alive.sum())
+        seconds = float('inf')
+        for _ in range(repeat):
+            state = (s.copy(), x.copy(), px.copy(), alive.copy(),
+                     lost.copy())
+            start = time.perf_counter()
+            element.track_batch(*state)
+            seconds = min(seconds, time.perf_counter() - start)
+        s, x, px, alive, lost = state
+        costs.append({'name': element.name,
+                      'type': type(element).__name__,
+                      'particles': nalive,
+                      'seconds': seconds,
+                      'seconds_per_particle': seconds / max(nalive, 1)})
+    return costs
+
+##################################################
+#                                                #
+#   Benchmark cases                              #
+#                                                #
+##################################################
+
+def _track_all(line, inits):
+    def run():
+        for x, px in inits:
+            track(Particle(float(x), float(px)), line)
+    return run
+
+def run(quick=False, repeat=3):
+    """Run all benchmark cases, return the results as a dict.
+
+    quick limits grid sizes and synthetic line lengths, e.g. for a
+    fast check before committing.
+    """
+    line = lss2_line()
+    from .examples import sps_lss2_se as example
+    sizes = (20, 100) if quick else (20, 100, 300)
+    lengths = (10, 100) if quick else (10, 100, 1000, 10000)
+    cases = {}
+
+    # Single particles, TrackList and TrackGrid on LSS2
+    inits = _lss2_grid(line, 20).particles.start[..., 1:].reshape(-1, 2)
+    cases['lss2/track'] = measure(_track_all(line, inits), len(inits),
+                                  repeat)
+    for batch in (True, False):
+        cases['lss2/tracklist/batch={0}'.format(batch)] = measure(
+            lambda: TrackList(line, inits, batch=batch), len(inits), repeat)
+    for size in sizes:
+        for history in (None, 'final', 'loss', 1):
+            cases['lss2/trackgrid/{0}x{0}/history={1}'.format(
+                size, history)] = measure(
+                    lambda: _lss2_grid(line, size, history=history),
+                    size**2, repeat)
+        if jit.available():
+            # Untimed first call compiles or loads the kernels
+            _lss2_grid(line, 2, backend='jit')
+            cases['lss2/trackgrid/{0}x{0}/backend=jit'.format(size)] = measure(
+                lambda: _lss2_grid(line, size, backend='jit'),
+                size**2, repeat)
+    cases['lss2/trackgrid/{0}x{0}/batch=False'.format(sizes[0])] = measure(
+        lambda: _lss2_grid(line, sizes[0], batch=False), sizes[0]**2, repeat)
+
+    # Synthetic lines of every element type
+    beam = _synthetic_beam(10 if quick else 30)
+    for kind in _SYNTHETIC:
+        for nelements in lengths:
+            synthetic = synthetic_line(kind, nelements)
+            cases['synthetic/{0}/{1}'.format(kind, nelements)] = measure(
+                lambda: TrackList(synthetic, beam, history=None),
+                len(beam), repeat)
+
+    # Colouring and plotting
+    import matplotlib.pyplot as plt
+    grid = _lss2_grid(line, sizes[-1], history=None)
+    cases['color_losses/{0}x{0}'.format(sizes[-1])] = measure(
+        lambda: _color_losses(grid.particles, example.colorcodes()),
+        sizes[-1]**2, repeat)
+
+    def plot_acceptance():
+        acceptanceplot(grid, example.colorcodes(), example.colormap(),
+                       show=False)
+        plt.close('all')
+    cases['acceptanceplot/{0}x{0}'.format(sizes[-1])] = measure(
+        plot_acceptance, sizes[-1]**2, repeat)
+
+    tracks = TrackList(line, inits)
+    def plot_trajectories():
+        trajectoryplot(tracks, example.beamcolorcodes(),
+                       example.beamcolormap(), show=False)
+        plt.close('all')
+    cases['trajectoryplot/{0}'.format(len(inits))] = measure(
+        plot_trajectories, len(inits), repeat)
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'jit': jit.available(),
+                     'machine': platform.machine(),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'quick': quick},
+            'cases': cases,
+            'elements': element_costs(line, inits, repeat)}
+
+##################################################
+#                                                #
+#   Reports and baselines                        #
+#                                                #
+##################################################
+
+def compare(results, baseline, tolerance=0.2):
+    """Cases whose rate dropped by more than tolerance vs baseline.
+
+    Returns a list of (case, rate, baseline rate), cases missing from
+    either side are ignored.
+    """
+    regressions = []
+    for case, result in results['cases'].items():
+        reference = baseline['cases'].get(case)
+        if reference is None:
+            continue
+        if result['rate'] < (1-tolerance) * reference['rate']:
+            regressions.append((case, result['rate'], reference['rate']))
+    return regressions
+
+def report(results, file=sys.stdout):
+    """Print a table of the results"""
+    print('{0:<44} {1:>12} {2:>14} {3:>10}'.format(
+        'case', 'seconds', 'particles/s', 'peak MB'), file=file)
+    for case, result in results['cases'].items():
+        print('{0:<44} {1:>12.4g} {2:>14.4g} {3:>10.2f}'.format(
+            case, result['seconds'], result['rate'],
+            result['peak_bytes']/1E6), file=file)
+    print('\n{0:<20} {1:<14} {2:>10} {3:>16}'.format(
+        'element', 'type', 'particles', 'ns/particle'), file=file)
+    for cost in results['elements']:
+        print('{0:<20} {1:<14} {2:>10} {3:>16.1f}'.format(
+            cost['name'], cost['type'], cost['particles'],
+            cost['seconds_per_particle']*1E9), file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tracking throughput benchmarks")
+    parser.add_argument('-o', '--output', help="write results as JSON")
+    parser.add_argument('-b', '--baseline', help="JSON results to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed relative throughput drop")
+    parser.add_argument('--quick', action='store_true',
+                        help="smaller grids and lines")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    results = run(args.quick, args.repeat)
+    report(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for case, rate, reference in regressions:
+            print('REGRESSION {0}: {1:.4g} particles/s, baseline '
+                  '{2:.4g}'.format(case, rate, reference))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
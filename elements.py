@@ -26,6 +26,52 @@
 # TODO Add copy constuctor? Make constructor arguments optional?
 
 import math
+from types import SimpleNamespace
+import numpy as np
+from .losses import losscodes
+
+__all__ = ['Drift', 'Kicker', 'Quadrupole', 'DoubleApDrift', 'Septum',
+           'QuadHole', 'TransferMap']
+
+def _lose(hit, index, alive, lost, code):
+    """Flag particles index[hit] as lost, returns mask of survivors."""
+    alive[index[hit]] = False
+    lost[index[hit]] = code
+    return ~hit
+
+class _Element:
+    """Base of all elements, caching values derived from parameters.
+
+    _prepare() computes transfer coefficients, loss codes and delegate
+    elements once. Setting any public attribute drops the cache, so it
+    is rebuilt on the next use after e.g. a parameter scan step.
+    """
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            object.__setattr__(self, '_cache', None)
+
+    def __getstate__(self):
+        # Loss codes are per process, rebuilt once unpickled
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        return state
+
+    def _cached(self):
+        cache = self.__dict__.get('_cache')
+        if cache is None:
+            cache = self._prepare()
+            object.__setattr__(self, '_cache', cache)
+        return cache
+
+    def _prepare(self):
+        return SimpleNamespace(codes=losscodes.register(self.name,
+                                                         self.losslocations))
+
+    @property
+    def codes(self):
+        """Loss codes of the element, by loss location"""
+        return self._cached().codes
 
 ##################################################
 #                                                #
@@ -33,21 +79,26 @@ import math
 #                                                #
 ##################################################
 
-class Drift:
+class Drift(_Element):
     """A 'drift' for accelerators."""
+    substeps = 0
+    nelements = 1
+    losslocations = ('start', 'down')
+
     def __init__(self, name, length, radius, offset_up=0, offset_down=0):
         self.name = name
         self.len = length
         self.r = radius
         self.offset_u = offset_up
         self.offset_d = offset_down
+        self._cached()
 
     def track(self, particle):
         # Does particle hit instantly?
         if self.r > 0:
             if (particle.x > self.offset_u+self.r
                     or particle.x < self.offset_u-self.r):
-                particle.lost = self.name + '_start'
+                particle.losscode = self.codes['start']
                 return
         # Particle is within aperture!
         x_inc = self.len * particle.px
@@ -58,20 +109,60 @@ class Drift:
                                 / (x_inc + self.offset_u-self.offset_d))
                 particle.s += self.len * s_hit_over_l
                 particle.x += x_inc * s_hit_over_l
-                particle.lost = self.name + '_down'
+                particle.losscode = self.codes['down']
                 return
             if (particle.x + x_inc) < self.offset_d-self.r:
                 s_hit_over_l = ((self.offset_u-self.r - particle.x)
                                 / (x_inc + self.offset_u-self.offset_d))
                 particle.s += self.len * s_hit_over_l
                 particle.x += x_inc * s_hit_over_l
-                particle.lost = self.name + '_down'
+                particle.losscode = self.codes['down']
                 return
         # Particle made it out!
         particle.s += self.len
         particle.x += x_inc
         return
 
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track() for arrays of particles.
+
+        Updates s, x, px and lost in place for particles flagged in
+        alive, and clears alive for the ones that get lost.
+        """
+        i = np.flatnonzero(alive)
+        xi = x[i]
+        pxi = px[i]
+        # Does particle hit instantly?
+        if self.r > 0:
+            ok = _lose((xi > self.offset_u+self.r)
+                       | (xi < self.offset_u-self.r),
+                       i, alive, lost, self.codes['start'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+        # Particle is within aperture!
+        x_inc = self.len * pxi
+        # Does it hit downstream?
+        if self.r > 0:
+            over = (xi + x_inc) > self.offset_d+self.r
+            hit = over | ((xi + x_inc) < self.offset_d-self.r)
+            edge = np.where(over, self.offset_u+self.r,
+                            self.offset_u-self.r)[hit]
+            s_hit_over_l = ((edge - xi[hit])
+                            / (x_inc[hit] + self.offset_u-self.offset_d))
+            s[i[hit]] += self.len * s_hit_over_l
+            x[i[hit]] += x_inc[hit] * s_hit_over_l
+            ok = _lose(hit, i, alive, lost, self.codes['down'])
+            i, xi, x_inc = i[ok], xi[ok], x_inc[ok]
+        # Particle made it out!
+        s[i] += self.len
+        x[i] = xi + x_inc
+        return
+
+    def transfer(self):
+        """Affine map (matrix, offset) of (x, px), None with aperture"""
+        if self.r > 0:
+            return None
+        return np.array([[1.0, self.len], [0.0, 1.0]]), np.zeros(2)
+
     def aperture(self, infty, s0):
         if self.r > 0:
             return [[[s0, self.r+self.offset_u],
@@ -91,50 +182,67 @@ class Drift:
 #                                                #
 ##################################################
 
-class Kicker:
+class Kicker(_Element):
     """A transverse kicker (dipole)."""
+    substeps = 0
+    nelements = 1
+    losslocations = ('start', 'down')
+
     def __init__(self, name, length, bendingangle, radius):
         self.name = name
         self.len = length
         self.an = bendingangle
         self.r = radius
+        self._cached()
 
-    def track(self, particle):
+    def _prepare(self):
+        cache = super()._prepare()
         # Drift in disguise?
         if self.an == 0:
-            Drift(self.name, self.len, self.r).track(particle)
+            cache.drift = Drift(self.name, self.len, self.r)
+            return cache
+        cache.drift = None
+        cache.quadraticA = self.an/self.len/2
+        cache.edge = math.copysign(self.r, self.an)
+        return cache
+
+    def track(self, particle):
+        cache = self._cached()
+        # Drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track(particle)
             return
         # Actual kicker!
         if self.r > 0:
             # Does particle hit instantly?
             if particle.x > self.r or particle.x < (-1*self.r):
-                particle.lost = self.name + '_start'
+                particle.losscode = self.codes['start']
                 return
             # Particle is within aperture!
             # Downstream hit on side the particle is bent away from?
             # (Solve an/len/2*s^2+px0*s+x0 == -sgn(an)*r)
             # (If solutions exist they are either both>0 or both<0)
-            quadraticA = self.an/self.len/2
+            quadraticA = cache.quadraticA
             quadraticB = particle.px
-            quadraticC = particle.x + math.copysign(self.r, self.an)
+            quadraticC = particle.x + cache.edge
             quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
             if quadraticD > 0:
                 hitdist = (-1*quadraticB - quadraticD**0.5) / (2*quadraticA)
                 if hitdist > 0 and hitdist < self.len:
                     particle.s += hitdist
-                    particle.x = -1*math.copysign(self.r, self.an)
-                    particle.lost = self.name + '_down'
+                    particle.x = -1*cache.edge
+                    particle.losscode = self.codes['down']
                     return
             # Downstream hit on side the particle is bent towards?
             # (Solve an/len/2*s^2+px0*s+x0 == sgn(an)*r)
             # (Guaranteed to have a solution >0 and one <0 because physics)
-            quadraticC = particle.x - math.copysign(self.r, self.an)
+            quadraticC = particle.x - cache.edge
             quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
             hitdist = (-1*quadraticB + quadraticD**0.5) / (2*quadraticA)
             if hitdist < self.len:
                 particle.s += hitdist
-                particle.x = math.copysign(self.r, self.an)
-                particle.lost = self.name + '_down'
+                particle.x = cache.edge
+                particle.losscode = self.codes['down']
                 return
         # Particle made it out!
         particle.s += self.len
@@ -142,6 +250,56 @@ class Kicker:
         particle.px += self.an
         return
 
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track(), see Drift.track_batch()."""
+        cache = self._cached()
+        # Drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track_batch(s, x, px, alive, lost, record)
+            return
+        # Actual kicker!
+        i = np.flatnonzero(alive)
+        xi = x[i]
+        pxi = px[i]
+        if self.r > 0:
+            # Does particle hit instantly?
+            ok = _lose((xi > self.r) | (xi < (-1*self.r)),
+                       i, alive, lost, self.codes['start'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+            # Downstream hit on side the particle is bent away from?
+            quadraticA = cache.quadraticA
+            quadraticC = xi + cache.edge
+            quadraticD = pxi**2 - 4*quadraticA*quadraticC
+            with np.errstate(invalid='ignore'):
+                hitdist = (-1*pxi - quadraticD**0.5) / (2*quadraticA)
+            hit = (quadraticD > 0) & (hitdist > 0) & (hitdist < self.len)
+            s[i[hit]] += hitdist[hit]
+            x[i[hit]] = -1*cache.edge
+            ok = _lose(hit, i, alive, lost, self.codes['down'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+            # Downstream hit on side the particle is bent towards?
+            quadraticC = xi - cache.edge
+            quadraticD = pxi**2 - 4*quadraticA*quadraticC
+            with np.errstate(invalid='ignore'):
+                hitdist = (-1*pxi + quadraticD**0.5) / (2*quadraticA)
+            hit = hitdist < self.len
+            s[i[hit]] += hitdist[hit]
+            x[i[hit]] = cache.edge
+            ok = _lose(hit, i, alive, lost, self.codes['down'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+        # Particle made it out!
+        s[i] += self.len
+        x[i] = xi + (pxi + self.an/2) * self.len
+        px[i] = pxi + self.an
+        return
+
+    def transfer(self):
+        """Affine map (matrix, offset) of (x, px), None with aperture"""
+        if self.r > 0:
+            return None
+        return (np.array([[1.0, self.len], [0.0, 1.0]]),
+                np.array([self.an/2 * self.len, self.an]))
+
     def aperture(self, infty, s0):
         if self.r > 0:
             return [[[s0, self.r], [s0+self.len, self.r],
@@ -157,7 +315,7 @@ class Kicker:
 #                                                #
 ##################################################
 
-class Quadrupole:
+class Quadrupole(_Element):
     """A simple quadrupole, internal aperture check missing.
 
     Uses k=1/(Brho)*dBy/dx
@@ -167,6 +325,10 @@ class Quadrupole:
     available to users.
     """
 
+    substeps = 0
+    nelements = 1
+    losslocations = ('start', 'down')
+
     def __init__(self, name, length, quad_k, radius, offset_field=0,
                  offset_aperture_up=0, offset_aperture_down=0):
         self.name = name
@@ -176,48 +338,119 @@ class Quadrupole:
         self.offset_au = offset_aperture_up
         self.offset_ad = offset_aperture_down
         self.offset_f = offset_field
+        self._cached()
 
-    def track(self, particle):
+    def _prepare(self):
+        cache = super()._prepare()
         # Drift in disguise?
         if self.k == 0:
-            Drift(self.name, self.len, self.r,
-                  offset_up=self.offset_au,
-                  offset_down=self.offset_ad).track(particle)
+            cache.drift = Drift(self.name, self.len, self.r,
+                                offset_up=self.offset_au,
+                                offset_down=self.offset_ad)
+            return cache
+        cache.drift = None
+        # Focussing quad?
+        if self.k > 0:
+            cache.sk = self.k**0.5
+            cache.cos = math.cos(cache.sk*self.len)
+            cache.sin = math.sin(cache.sk*self.len)
+        # Defocussing quad!
+        else:
+            cache.sk = (-1.0*self.k)**0.5
+            cache.cosh = math.cosh(cache.sk*self.len)
+            cache.sinh = math.sinh(cache.sk*self.len)
+        return cache
+
+    def track(self, particle):
+        cache = self._cached()
+        # Drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track(particle)
             return
         # Actual quadrupole!
         # Does particle hit instantly?
         if self.r > 0:
             if (particle.x > self.offset_au+self.r
                     or particle.x < self.offset_au-self.r):
-                particle.lost = self.name + '_start'
+                particle.losscode = self.codes['start']
                 return
         # Particle is within aperture!
         xeff = particle.x - self.offset_f
         # Focussing quad?
+        sk = cache.sk
         if self.k > 0:
-            sk = self.k**0.5
             particle.s += self.len
-            particle.x = (xeff*math.cos(sk*self.len)
-                          + particle.px/sk*math.sin(sk*self.len)
+            particle.x = (xeff*cache.cos + particle.px/sk*cache.sin
                           + self.offset_f)
-            particle.px = (-1.0*xeff*sk*math.sin(sk*self.len)
-                           + particle.px*math.cos(sk*self.len))
+            particle.px = -1.0*xeff*sk*cache.sin + particle.px*cache.cos
         # Defocussing quad!
         else:
-            sk = (-1.0*self.k)**0.5
             particle.s += self.len
-            particle.x = (xeff*math.cosh(sk*self.len)
-                          + particle.px/sk*math.sinh(sk*self.len)
+            particle.x = (xeff*cache.cosh + particle.px/sk*cache.sinh
                           + self.offset_f)
-            particle.px = (xeff*sk*math.sinh(sk*self.len)
-                           + particle.px*math.cosh(sk*self.len))
+            particle.px = xeff*sk*cache.sinh + particle.px*cache.cosh
         # Downstream aperture check!
         if self.r > 0:
             if (particle.x > self.offset_ad+self.r
                     or particle.x < self.offset_ad-self.r):
-                particle.lost = self.name + '_down'
+                particle.losscode = self.codes['down']
                 return
 
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track(), see Drift.track_batch()."""
+        cache = self._cached()
+        # Drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track_batch(s, x, px, alive, lost, record)
+            return
+        # Actual quadrupole!
+        i = np.flatnonzero(alive)
+        xi = x[i]
+        pxi = px[i]
+        # Does particle hit instantly?
+        if self.r > 0:
+            ok = _lose((xi > self.offset_au+self.r)
+                       | (xi < self.offset_au-self.r),
+                       i, alive, lost, self.codes['start'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+        # Particle is within aperture!
+        xeff = xi - self.offset_f
+        # Focussing quad?
+        sk = cache.sk
+        if self.k > 0:
+            xi = xeff*cache.cos + pxi/sk*cache.sin + self.offset_f
+            pxi = -1.0*xeff*sk*cache.sin + pxi*cache.cos
+        # Defocussing quad!
+        else:
+            xi = xeff*cache.cosh + pxi/sk*cache.sinh + self.offset_f
+            pxi = xeff*sk*cache.sinh + pxi*cache.cosh
+        s[i] += self.len
+        x[i] = xi
+        px[i] = pxi
+        # Downstream aperture check!
+        if self.r > 0:
+            _lose((xi > self.offset_ad+self.r) | (xi < self.offset_ad-self.r),
+                  i, alive, lost, self.codes['down'])
+        return
+
+    def transfer(self):
+        """Affine map (matrix, offset) of (x, px), None with aperture"""
+        if self.r > 0:
+            return None
+        if self.k == 0:
+            return np.array([[1.0, self.len], [0.0, 1.0]]), np.zeros(2)
+        cache = self._cached()
+        sk = cache.sk
+        if self.k > 0:
+            matrix = np.array([[cache.cos, cache.sin/sk],
+                               [-1.0*sk*cache.sin, cache.cos]])
+        else:
+            matrix = np.array([[cache.cosh, cache.sinh/sk],
+                               [sk*cache.sinh, cache.cosh]])
+        # Field axis offset: x-offset_f is transported, not x
+        offset = np.array([self.offset_f, 0.0]) - matrix[:, 0]*self.offset_f
+        return matrix, offset
+
     def aperture(self, infty, s0):
         if self.r > 0:
             return [[[s0, self.r+self.offset_au], [s0+self.len, self.r+self.offset_ad],
@@ -236,12 +469,17 @@ class Quadrupole:
 # TODO Make drift with angle to replace 0 thickness case?
 # TODO Improve readability
 
-class DoubleApDrift:
+class DoubleApDrift(_Element):
     """A drift with two separate apertures.
 
     Centered on the 'cirulating' aperture, with extraction aperture on
     the positive side.
     """
+    substeps = 0
+    nelements = 1
+    losslocations = ('start_extr', 'start_coll', 'start_circ', 'down_circ',
+                     'down_coll_circ', 'down_extr', 'down_coll_extr')
+
     def __init__(self, name, length, collpos_upstream, collpos_downstream,
                  coll_thickness, d_circulating, d_extraction):
         self.name = name
@@ -255,28 +493,38 @@ class DoubleApDrift:
         self.ediam = d_extraction
         if d_extraction > 0:
             self.ediam += coll_thickness/2
+        self._cached()
 
-    def track(self, particle):
+    def _prepare(self):
+        cache = super()._prepare()
+        cache.drift = None
         # Normal drift in disguise?
         if self.coll_thick == 0:
             radius = (self.ediam+self.cdiam)/2
             offset = self.ediam-radius
-            Drift(self.name, self.len, radius, offset_up=offset,
-                  offset_down=offset).track(particle)
+            cache.drift = Drift(self.name, self.len, radius,
+                                offset_up=offset, offset_down=offset)
+        return cache
+
+    def track(self, particle):
+        cache = self._cached()
+        # Normal drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track(particle)
             return
         # Does particle hit instantly?
         # ...On the extraction side?
         if self.ediam > 0 and particle.x > (self.collpos_up + self.ediam):
-            particle.lost = self.name + '_start_extr'
+            particle.losscode = self.codes['start_extr']
             return
         # ...On the collimator?
         if (particle.x < (self.collpos_up + self.coll_thick/2)
                 and particle.x > (self.collpos_up - self.coll_thick/2)):
-            particle.lost = self.name + '_start_coll'
+            particle.losscode = self.codes['start_coll']
             return
         # ...On the circulating side?
         if self.cdiam > 0 and particle.x < (self.collpos_up - self.cdiam):
-            particle.lost = self.name + '_start_circ'
+            particle.losscode = self.codes['start_circ']
             return
         # Particle is within aperture!
         x_inc = self.len * particle.px
@@ -289,7 +537,7 @@ class DoubleApDrift:
                            / (self.collpos_down - self.collpos_up - x_inc))
                 particle.s += incfrac * self.len
                 particle.x += incfrac * x_inc
-                particle.lost = self.name + '_down_circ'
+                particle.losscode = self.codes['down_circ']
                 return
             # Does it successfully exit from the circulating aperture?
             if ((particle.x + x_inc)
@@ -302,7 +550,7 @@ class DoubleApDrift:
                        / (self.collpos_down - self.collpos_up - x_inc))
             particle.s += incfrac * self.len
             particle.x += incfrac * x_inc
-            particle.lost = self.name + '_down_coll_circ'
+            particle.losscode = self.codes['down_coll_circ']
             return
         # Extraction aperture!
         # Does it hit the downstream extraction aperture?
@@ -312,7 +560,7 @@ class DoubleApDrift:
                        / (self.collpos_down - self.collpos_up - x_inc))
             particle.s += incfrac * self.len
             particle.x += incfrac * x_inc
-            particle.lost = self.name + '_down_extr'
+            particle.losscode = self.codes['down_extr']
             return
         # Does it successfully exit from the extraction aperture?
         if ((particle.x + x_inc)
@@ -325,9 +573,88 @@ class DoubleApDrift:
                    / (self.collpos_down - self.collpos_up - x_inc))
         particle.s += incfrac * self.len
         particle.x += incfrac * x_inc
-        particle.lost = self.name + '_down_coll_extr'
+        particle.losscode = self.codes['down_coll_extr']
+        return
+
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track(), see Drift.track_batch()."""
+        cache = self._cached()
+        # Normal drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track_batch(s, x, px, alive, lost, record)
+            return
+        i = np.flatnonzero(alive)
+        xi = x[i]
+        pxi = px[i]
+        # Does particle hit instantly?
+        # ...On the extraction side?
+        if self.ediam > 0:
+            ok = _lose(xi > (self.collpos_up + self.ediam),
+                       i, alive, lost, self.codes['start_extr'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+        # ...On the collimator?
+        ok = _lose((xi < (self.collpos_up + self.coll_thick/2))
+                   & (xi > (self.collpos_up - self.coll_thick/2)),
+                   i, alive, lost, self.codes['start_coll'])
+        i, xi, pxi = i[ok], xi[ok], pxi[ok]
+        # ...On the circulating side?
+        if self.cdiam > 0:
+            ok = _lose(xi < (self.collpos_up - self.cdiam),
+                       i, alive, lost, self.codes['start_circ'])
+            i, xi, pxi = i[ok], xi[ok], pxi[ok]
+        # Particle is within aperture!
+        x_inc = self.len * pxi
+        circ = xi < self.collpos_up
+        # Circulating aperture?
+        ic, xc, incc = i[circ], xi[circ], x_inc[circ]
+        # Does it hit the downstream circulating aperture?
+        if self.cdiam > 0:
+            hit = (xc + incc) < (self.collpos_down - self.cdiam)
+            incfrac = ((xc[hit] - self.collpos_up + self.cdiam)
+                       / (self.collpos_down - self.collpos_up - incc[hit]))
+            s[ic[hit]] += incfrac * self.len
+            x[ic[hit]] += incfrac * incc[hit]
+            ok = _lose(hit, ic, alive, lost, self.codes['down_circ'])
+            ic, xc, incc = ic[ok], xc[ok], incc[ok]
+        # Does it successfully exit from the circulating aperture?
+        out = (xc + incc) < (self.collpos_down - self.coll_thick/2)
+        s[ic[out]] += self.len
+        x[ic[out]] += incc[out]
+        # It is lost on the collimator!
+        hit = ~out
+        incfrac = ((xc[hit] - self.collpos_up + self.coll_thick/2)
+                   / (self.collpos_down - self.collpos_up - incc[hit]))
+        s[ic[hit]] += incfrac * self.len
+        x[ic[hit]] += incfrac * incc[hit]
+        _lose(hit, ic, alive, lost, self.codes['down_coll_circ'])
+        # Extraction aperture!
+        ie, xe, ince = i[~circ], xi[~circ], x_inc[~circ]
+        # Does it hit the downstream extraction aperture?
+        if self.ediam > 0:
+            hit = (xe + ince) > (self.collpos_down + self.ediam)
+            incfrac = ((xe[hit] - self.collpos_up - self.ediam)
+                       / (self.collpos_down - self.collpos_up - ince[hit]))
+            s[ie[hit]] += incfrac * self.len
+            x[ie[hit]] += incfrac * ince[hit]
+            ok = _lose(hit, ie, alive, lost, self.codes['down_extr'])
+            ie, xe, ince = ie[ok], xe[ok], ince[ok]
+        # Does it successfully exit from the extraction aperture?
+        out = (xe + ince) > (self.collpos_down + self.coll_thick/2)
+        s[ie[out]] += self.len
+        x[ie[out]] += ince[out]
+        # It is lost on the collimator!
+        hit = ~out
+        incfrac = ((xe[hit] - self.collpos_up - self.coll_thick/2)
+                   / (self.collpos_down - self.collpos_up - ince[hit]))
+        s[ie[hit]] += incfrac * self.len
+        x[ie[hit]] += incfrac * ince[hit]
+        _lose(hit, ie, alive, lost, self.codes['down_coll_extr'])
         return
 
+    def transfer(self):
+        """Always None, the element is not a plain affine map"""
+        return None
+
     def aperture(self, infty, s0):
         ans = [[[s0, self.collpos_up-self.coll_thick/2],
                  [s0+self.len, self.collpos_down-self.coll_thick/2],
@@ -353,8 +680,14 @@ class DoubleApDrift:
 
 # TODO have field region on either side possible
 
-class Septum:
+class Septum(_Element):
     """A septum with dipole extraction on positive side."""
+    # Extra history points recorded inside track(), at virtual blades
+    substeps = 1
+    nelements = 1
+    losslocations = ('start_extr', 'start_blade', 'start_circ', 'down_circ',
+                     'down_blade_circ', 'down_extr', 'down_blade_extr')
+
     def __init__(self, name, length, bendingangle, bladepos_upstream,
                  bladepos_downstream, blade_thickness, d_circulating,
                  d_extraction):
@@ -370,9 +703,10 @@ class Septum:
         self.ediam = d_extraction
         if d_extraction > 0:
             self.ediam += blade_thickness/2
+        self._cached()
 
-# TODO rewrite with track_circ and track_extr?
-    def track(self, particle):
+    def _prepare(self):
+        cache = super()._prepare()
         # Double drift in disguise?
         if self.an == 0:
             temp_cdiam = 0
@@ -381,24 +715,37 @@ class Septum:
                 temp_cdiam = self.cdiam-self.blade_thick/2
             if self.ediam > 0:
                 temp_ediam = self.ediam-self.blade_thick/2
-            DoubleApDrift(self.name, self.len, self.bladepos_up,
-                          self.bladepos_down, self.blade_thick,
-                          temp_cdiam, temp_ediam).track(particle)
+            cache.drift = DoubleApDrift(self.name, self.len, self.bladepos_up,
+                                        self.bladepos_down, self.blade_thick,
+                                        temp_cdiam, temp_ediam)
+            return cache
+        cache.drift = None
+        # Extraction side trajectory relative to the blade
+        cache.quadraticA = self.an/self.len/2
+        cache.slope = (self.bladepos_down - self.bladepos_up) / self.len
+        return cache
+
+# TODO rewrite with track_circ and track_extr?
+    def track(self, particle):
+        cache = self._cached()
+        # Double drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track(particle)
             return
         # Actual septum!
         # Does particle hit instantly?
         # ...On the extraction side?
         if self.ediam > 0 and particle.x > (self.bladepos_up + self.ediam):
-            particle.lost = self.name + '_start_extr'
+            particle.losscode = self.codes['start_extr']
             return
         # ...On the blade?
         if (particle.x < (self.bladepos_up + self.blade_thick/2)
                 and particle.x > (self.bladepos_up - self.blade_thick/2)):
-            particle.lost = self.name + '_start_blade'
+            particle.losscode = self.codes['start_blade']
             return
         # ...On the circulating side?
         if self.cdiam > 0 and particle.x < (self.bladepos_up - self.cdiam):
-            particle.lost = self.name + '_start_circ'
+            particle.losscode = self.codes['start_circ']
             return
         # Particle is within aperture!
         # Circulating aperture?
@@ -411,7 +758,7 @@ class Septum:
                            / (self.bladepos_down - self.bladepos_up - x_inc))
                 particle.s += incfrac * self.len
                 particle.x += incfrac * x_inc
-                particle.lost = self.name + '_down_circ'
+                particle.losscode = self.codes['down_circ']
                 return
             # Does it successfully exit from circulating aperture?
             if ((particle.x + x_inc)
@@ -426,10 +773,10 @@ class Septum:
             particle.x += incfrac * x_inc
             # ... And hits it?
             if self.blade_thick > 0:
-                particle.lost = self.name + '_down_blade_circ'
+                particle.losscode = self.codes['down_blade_circ']
                 return
             # ... And goes through the virtual blade!
-            particle.update_history()
+            particle.update_history(substep=True)
             templ = self.len - incfrac * self.len
             tempan = self.an - incfrac * self.an
             bladeposmid = particle.x
@@ -446,7 +793,7 @@ class Septum:
                     particle.x += (quadraticA * hitdist**2
                                    + particle.px * hitdist)
                     particle.px += tempan * hitdist / templ
-                    particle.lost = self.name + '_down_extr'
+                    particle.losscode = self.codes['down_extr']
                     return
             # ... ... And exits from the extraction aperture!
             particle.s += templ
@@ -454,9 +801,8 @@ class Septum:
             particle.px += tempan
             return
         # Extraction aperture!
-        quadraticA = self.an/self.len/2
-        quadraticB = (particle.px
-                      - (self.bladepos_down - self.bladepos_up) / self.len)
+        quadraticA = cache.quadraticA
+        quadraticB = particle.px - cache.slope
         quadraticC = particle.x - self.bladepos_up - self.blade_thick/2
         quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
         # Does it reach the downstream blade?
@@ -468,10 +814,10 @@ class Septum:
                 particle.px += self.an * hitdist / self.len
                 # ... And hit it?
                 if self.blade_thick > 0:
-                    particle.lost = self.name + '_down_blade_extr'
+                    particle.losscode = self.codes['down_blade_extr']
                     return
                 # ... It goes through the virtual blade!
-                particle.update_history()
+                particle.update_history(substep=True)
                 templ = self.len - hitdist
                 x_inc = templ * particle.px
                 bladeposmid = particle.x
@@ -482,7 +828,7 @@ class Septum:
                                / (self.bladepos_down - bladeposmid - x_inc))
                     particle.s += incfrac * templ
                     particle.x += incfrac * x_inc
-                    particle.lost = self.name + '_down_circ'
+                    particle.losscode = self.codes['down_circ']
                     return
                 # ... ... And exits from the extraction aperture!
                 particle.s += templ
@@ -497,7 +843,7 @@ class Septum:
                 particle.s += hitdist
                 particle.x += quadraticA * hitdist**2 + particle.px * hitdist
                 particle.px += self.an * hitdist / self.len
-                particle.lost = self.name + '_down_extr'
+                particle.losscode = self.codes['down_extr']
                 return
         # It successfully exits the extraction aperture!
         particle.s += self.len
@@ -505,6 +851,170 @@ class Septum:
         particle.px += self.an
         return
 
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track(), see Drift.track_batch().
+
+        record(index, s, x, px), if given, is called with the states
+        of particles crossing a virtual blade.
+        """
+        cache = self._cached()
+        # Double drift in disguise?
+        if cache.drift is not None:
+            cache.drift.track_batch(s, x, px, alive, lost, record)
+            return
+        # Actual septum!
+        i = np.flatnonzero(alive)
+        xi = x[i]
+        # Does particle hit instantly?
+        # ...On the extraction side?
+        if self.ediam > 0:
+            ok = _lose(xi > (self.bladepos_up + self.ediam),
+                       i, alive, lost, self.codes['start_extr'])
+            i, xi = i[ok], xi[ok]
+        # ...On the blade?
+        ok = _lose((xi < (self.bladepos_up + self.blade_thick/2))
+                   & (xi > (self.bladepos_up - self.blade_thick/2)),
+                   i, alive, lost, self.codes['start_blade'])
+        i, xi = i[ok], xi[ok]
+        # ...On the circulating side?
+        if self.cdiam > 0:
+            ok = _lose(xi < (self.bladepos_up - self.cdiam),
+                       i, alive, lost, self.codes['start_circ'])
+            i, xi = i[ok], xi[ok]
+        # Particle is within aperture!
+        circ = xi < self.bladepos_up
+        self._track_circ_batch(i[circ], s, x, px, alive, lost, record)
+        self._track_extr_batch(i[~circ], s, x, px, alive, lost, record)
+        return
+
+    def _track_circ_batch(self, i, s, x, px, alive, lost, record):
+        xi = x[i]
+        pxi = px[i]
+        x_inc = self.len * pxi
+        # Does it hit the downstream circulating aperture?
+        if self.cdiam > 0:
+            hit = (xi + x_inc) < (self.bladepos_down - self.cdiam)
+            incfrac = ((xi[hit] - self.bladepos_up + self.cdiam)
+                       / (self.bladepos_down - self.bladepos_up - x_inc[hit]))
+            s[i[hit]] += incfrac * self.len
+            x[i[hit]] += incfrac * x_inc[hit]
+            ok = _lose(hit, i, alive, lost, self.codes['down_circ'])
+            i, xi, pxi, x_inc = i[ok], xi[ok], pxi[ok], x_inc[ok]
+        # Does it successfully exit from circulating aperture?
+        out = (xi + x_inc) < (self.bladepos_down - self.blade_thick/2)
+        s[i[out]] += self.len
+        x[i[out]] += x_inc[out]
+        i, xi, pxi, x_inc = i[~out], xi[~out], pxi[~out], x_inc[~out]
+        # It reaches the blade downstream!
+        incfrac = ((xi - self.bladepos_up - self.blade_thick/2)
+                   / (self.bladepos_down - self.bladepos_up - x_inc))
+        si = s[i] + incfrac * self.len
+        xi = xi + incfrac * x_inc
+        s[i] = si
+        x[i] = xi
+        # ... And hits it?
+        if self.blade_thick > 0:
+            lost[i] = self.codes['down_blade_circ']
+            alive[i] = False
+            return
+        # ... And goes through the virtual blade!
+        if record is not None:
+            record(i, si, xi, pxi)
+        templ = self.len - incfrac * self.len
+        tempan = self.an - incfrac * self.an
+        bladeposmid = xi
+        # ... ... And hits the extraction aperture?
+        if self.ediam > 0:
+            quadraticA = tempan/templ/2
+            quadraticB = pxi - (self.bladepos_down - bladeposmid) / templ
+            quadraticC = xi - bladeposmid - self.ediam
+            quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+            with np.errstate(invalid='ignore'):
+                hitdist = ((-1*quadraticB + quadraticD**0.5)
+                           / (2*quadraticA))
+            hit = hitdist < templ
+            h = hitdist[hit]
+            s[i[hit]] += h
+            x[i[hit]] += quadraticA[hit] * h**2 + pxi[hit] * h
+            px[i[hit]] += tempan[hit] * h / templ[hit]
+            ok = _lose(hit, i, alive, lost, self.codes['down_extr'])
+            i, pxi, templ, tempan = i[ok], pxi[ok], templ[ok], tempan[ok]
+        # ... ... And exits from the extraction aperture!
+        s[i] += templ
+        x[i] += (tempan/2 + pxi) * templ
+        px[i] += tempan
+        return
+
+    def _track_extr_batch(self, i, s, x, px, alive, lost, record):
+        xi = x[i]
+        pxi = px[i]
+        cache = self._cached()
+        quadraticA = cache.quadraticA
+        quadraticB = pxi - cache.slope
+        quadraticC = xi - self.bladepos_up - self.blade_thick/2
+        quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+        # Does it reach the downstream blade?
+        with np.errstate(invalid='ignore'):
+            hitdist = (-1*quadraticB - quadraticD**0.5) / (2*quadraticA)
+        reach = (quadraticD > 0) & (hitdist > 0) & (hitdist < self.len)
+        if reach.any():
+            h = hitdist[reach]
+            ir = i[reach]
+            sr = s[ir] + h
+            xr = x[ir] + (quadraticA * h**2 + pxi[reach] * h)
+            pxr = pxi[reach] + self.an * h / self.len
+            s[ir] = sr
+            x[ir] = xr
+            px[ir] = pxr
+            # ... And hit it?
+            if self.blade_thick > 0:
+                lost[ir] = self.codes['down_blade_extr']
+                alive[ir] = False
+            # ... It goes through the virtual blade!
+            else:
+                if record is not None:
+                    record(ir, sr, xr, pxr)
+                templ = self.len - h
+                x_inc = templ * pxr
+                bladeposmid = xr
+                # ... ... And hits the circulating aperture?
+                if self.cdiam > 0:
+                    hit = (xr + x_inc) < (self.bladepos_down - self.cdiam)
+                    incfrac = ((xr[hit] - bladeposmid[hit] + self.cdiam)
+                               / (self.bladepos_down - bladeposmid[hit]
+                                  - x_inc[hit]))
+                    s[ir[hit]] += incfrac * templ[hit]
+                    x[ir[hit]] += incfrac * x_inc[hit]
+                    ok = _lose(hit, ir, alive, lost, self.codes['down_circ'])
+                    ir, templ, x_inc = ir[ok], templ[ok], x_inc[ok]
+                # ... ... And exits from the extraction aperture!
+                s[ir] += templ
+                x[ir] += x_inc
+            i, xi, pxi = i[~reach], xi[~reach], pxi[~reach]
+            quadraticB = quadraticB[~reach]
+        # Does it hit the downstream extraction aperture?
+        if self.ediam > 0:
+            quadraticC = xi - self.bladepos_up - self.ediam
+            quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+            with np.errstate(invalid='ignore'):
+                hitdist = (-1*quadraticB + quadraticD**0.5) / (2*quadraticA)
+            hit = hitdist < self.len
+            h = hitdist[hit]
+            s[i[hit]] += h
+            x[i[hit]] += quadraticA * h**2 + pxi[hit] * h
+            px[i[hit]] += self.an * h / self.len
+            ok = _lose(hit, i, alive, lost, self.codes['down_extr'])
+            i, pxi = i[ok], pxi[ok]
+        # It successfully exits the extraction aperture!
+        s[i] += self.len
+        x[i] += (self.an/2 + pxi) * self.len
+        px[i] += self.an
+        return
+
+    def transfer(self):
+        """Always None, the element is not a plain affine map"""
+        return None
+
     def aperture(self, infty, s0):
         ans = [[[s0, self.bladepos_up-self.blade_thick/2],
                  [s0+self.len, self.bladepos_down-self.blade_thick/2],
@@ -528,13 +1038,17 @@ class Septum:
 #                                                #
 ##################################################
 
-class QuadHole:
+class QuadHole(_Element):
     """A quadrupole with a hole in the yoke.
 
     As in quadrupole, internal aperture check is missing and
     we use k=1/(Brho)*dBy/dx
     """
 
+    substeps = 0
+    nelements = 1
+    losslocations = ()
+
     def __init__(self, name, length, quad_k, hole_k, quad_radius,
                  hole_radius, hole_field_axis, hole_ap_axis_up,
                  hole_ap_axis_down):
@@ -547,20 +1061,45 @@ class QuadHole:
         self.hfax = hole_field_axis
         self.haaxu = hole_ap_axis_up
         self.haaxd = hole_ap_axis_down
+        self._cached()
+
+    def _prepare(self):
+        cache = super()._prepare()
+        cache.hole = Quadrupole(self.name+'_hole', self.len, self.hk, self.hr,
+                                offset_field=self.hfax,
+                                offset_aperture_up=self.haaxu,
+                                offset_aperture_down=self.haaxd)
+        cache.circ = Quadrupole(self.name+'.circ', self.len, self.qk,
+                                self.qr)
+        return cache
 
     def track(self, particle):
+        cache = self._cached()
         # Is it in the hole?
         if particle.x > self.haaxu-self.hr and particle.x < self.haaxu+self.hr:
-            Quadrupole(self.name+'_hole', self.len, self.hk, self.hr,
-                       offset_field=self.hfax, offset_aperture_up=self.haaxu,
-                       offset_aperture_down=self.haaxd).track(particle)
+            cache.hole.track(particle)
             return
 
         # Otherwise treat it like a normal quad.
-        Quadrupole(self.name+'.circ', self.len, self.qk,
-                   self.qr).track(particle)
+        cache.circ.track(particle)
         return
 
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track(), see Drift.track_batch()."""
+        # Is it in the hole?
+        hole = alive & (x > self.haaxu-self.hr) & (x < self.haaxu+self.hr)
+        # Otherwise treat it like a normal quad.
+        circ = alive & ~hole
+        cache = self._cached()
+        cache.hole.track_batch(s, x, px, hole, lost, record)
+        cache.circ.track_batch(s, x, px, circ, lost, record)
+        np.logical_or(hole, circ, out=alive)
+        return
+
+    def transfer(self):
+        """Always None, the element is not a plain affine map"""
+        return None
+
     def aperture(self, infty, s0):
         if self.qr <= 0 or self.hr <= 0:
             print("Aperture for QuadHole object ", self.name, " cannot be reliably drawn. Aperture omitted.")
@@ -572,3 +1111,129 @@ class QuadHole:
                      [s0+self.len, self.haaxd-self.hr], [s0, self.haaxu-self.hr]],
                     [[s0, self.haaxu+self.hr], [s0+self.len, self.haaxd+self.hr],
                      [s0+self.len, self.haaxd+self.hr+infty], [s0, self.haaxu+self.hr+infty]]]
+
+##################################################
+#                                                #
+#   TransferMap: fused aperture-free elements    #
+#                                                #
+##################################################
+
+class TransferMap(_Element):
+    """A run of aperture-free elements collapsed into one affine map.
+
+    The original elements are kept, together with the map and s up to
+    each of their exit boundaries, so positions and histories at the
+    original boundaries can still be reconstructed with states().
+    Normally created by fuse_line(). The map is recomputed when any of
+    the original elements is modified.
+    """
+    substeps = 0
+    losslocations = ()
+
+    def __init__(self, elements):
+        self.elements = list(elements)
+        self.nelements = len(self.elements)
+        self.name = self.elements[0].name + '..' + self.elements[-1].name
+        self._cached()
+
+    def _cached(self):
+        cache = self.__dict__.get('_cache')
+        if cache is not None and any(element._cached() is not part
+                                     for element, part
+                                     in zip(self.elements, cache.parts)):
+            object.__setattr__(self, '_cache', None)
+        return super()._cached()
+
+    def _prepare(self):
+        cache = super()._prepare()
+        # Caches of the elements the map was computed from
+        cache.parts = [element._cached() for element in self.elements]
+        cache.lengths = np.cumsum([element.len for element in self.elements])
+        cache.len = float(cache.lengths[-1])
+        matrix = np.identity(2)
+        offset = np.zeros(2)
+        cache.matrices = np.empty((self.nelements, 2, 2))
+        cache.offsets = np.empty((self.nelements, 2))
+        for index, element in enumerate(self.elements):
+            transfer = element.transfer()
+            if transfer is None:
+                raise ValueError("Element " + element.name + " has an "
+                                 "aperture and cannot be part of a "
+                                 "TransferMap")
+            m, b = transfer
+            matrix = m @ matrix
+            offset = m @ offset + b
+            cache.matrices[index] = matrix
+            cache.offsets[index] = offset
+        cache.matrix = matrix
+        cache.offset = offset
+        # Plain floats, for the scalar track()
+        cache.coefficients = matrix.tolist(), offset.tolist()
+        return cache
+
+    @property
+    def len(self):
+        return self._cached().len
+
+    @property
+    def lengths(self):
+        """s at the exit of every original element"""
+        return self._cached().lengths
+
+    @property
+    def matrices(self):
+        """Map up to the exit of every original element"""
+        return self._cached().matrices
+
+    @property
+    def offsets(self):
+        return self._cached().offsets
+
+    @property
+    def matrix(self):
+        return self._cached().matrix
+
+    @property
+    def offset(self):
+        return self._cached().offset
+
+    def track(self, particle):
+        cache = self._cached()
+        ((m11, m12), (m21, m22)), (b1, b2) = cache.coefficients
+        x = particle.x
+        particle.s += cache.len
+        particle.x = m11*x + m12*particle.px + b1
+        particle.px = m21*x + m22*particle.px + b2
+        return
+
+    def track_batch(self, s, x, px, alive, lost, record=None):
+        """Vectorized track(), see Drift.track_batch()."""
+        cache = self._cached()
+        ((m11, m12), (m21, m22)), (b1, b2) = cache.matrix, cache.offset
+        i = np.flatnonzero(alive)
+        xi = x[i]
+        pxi = px[i]
+        s[i] += cache.len
+        x[i] = m11*xi + m12*pxi + b1
+        px[i] = m21*xi + m22*pxi + b2
+        return
+
+    def states(self, s, x, px):
+        """States (s, x, px) at the exit of every original element.
+
+        Each is an array with a leading axis over the elements, for
+        particles entering the map in state (s, x, px).
+        """
+        s, x, px = np.asarray(s), np.asarray(x), np.asarray(px)
+        shape = (self.nelements,) + (1,)*x.ndim
+        m = self.matrices.reshape(shape + (2, 2))
+        b = self.offsets.reshape(shape + (2,))
+        return (s + self.lengths.reshape(shape),
+                m[..., 0, 0]*x + m[..., 0, 1]*px + b[..., 0],
+                m[..., 1, 0]*x + m[..., 1, 1]*px + b[..., 1])
+
+    def transfer(self):
+        return self.matrix.copy(), self.offset.copy()
+
+    def aperture(self, infty, s0):
+        return []
@@ -270,13 +270,10 @@ def beamcolorcodes():
             ['right up',['2'],[],[]],
             ['right down',['3'],[],[]]]
 
+geometry = lt.ApertureGeometry(line)
+
 def aperture(infty=0.1, s=0):
-    res = []
-    s0 = s
-    for element in line:
-        res.extend(element.aperture(infty, s))
-        s += element.len
-    return res
+    return geometry.vertices(infty, s)
         
 
 beam = [[0.06817,-0.00143],[0.06817,-0.00147],[0.08, -0.00173], [0.082, -0.00173]]
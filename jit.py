@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       JIT-compiled tracking for MAD-X-like tracking in python.       #
+#                                                                      #
+########################################################################
+
+# Optional backend, compiling the rows of compile_line() into one
+# loop over particles and elements with Numba. Selected with
+# backend='jit' in TrackGrid, TrackList and track_bank; without Numba,
+# or for lines with elements compile_line() does not know, these use
+# the NumPy path.
+
+import numpy as np
+from .lattice import (_record_flags, DRIFT, KICKER,
+                      QUADRUPOLE, DOUBLEAPDRIFT, QUADHOLE)
+from .particle import HistoryPolicy
+
+__all__ = ['available', 'track_table']
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+    # Compiled kernels are cached on disk, next to this module
+    _jit = numba.njit(cache=True, nogil=True)
+    _parallel = numba.njit(cache=True, parallel=True)
+    _range = numba.prange
+else:
+    _jit = _parallel = lambda function: function
+    _range = range
+
+def available():
+    """Is the JIT backend available, i.e. is Numba installed?"""
+    return numba is not None
+
+##################################################
+#                                                #
+#   Kernels                                      #
+#                                                #
+##################################################
+
+# As the kernels of lattice.py, on one row p of params. Each returns
+# (s, x, px, loss code, crossed virtual blade, s, x, px at the blade).
+# Square roots of negative numbers give nan as in the NumPy path.
+
+@_jit
+def _drift(p, codes, length, s, x, px):
+    r, ou, od = p[0], p[1], p[2]
+    up_hi, up_lo, down_hi, down_lo = p[3], p[4], p[5], p[6]
+    if r > 0:
+        if x > up_hi or x < up_lo:
+            return s, x, px, codes[0], False, s, x, px
+    x_inc = length * px
+    if r > 0:
+        if (x + x_inc) > down_hi:
+            s_hit_over_l = (up_hi - x) / (x_inc + ou-od)
+            return (s + length * s_hit_over_l, x + x_inc * s_hit_over_l,
+                    px, codes[1], False, s, x, px)
+        if (x + x_inc) < down_lo:
+            s_hit_over_l = (up_lo - x) / (x_inc + ou-od)
+            return (s + length * s_hit_over_l, x + x_inc * s_hit_over_l,
+                    px, codes[1], False, s, x, px)
+    return s + length, x + x_inc, px, 0, False, s, x, px
+
+@_jit
+def _kicker(p, codes, length, s, x, px):
+    an, r, quadraticA, edge, halfan = p[0], p[1], p[2], p[3], p[4]
+    if r > 0:
+        if x > r or x < (-1*r):
+            return s, x, px, codes[0], False, s, x, px
+        quadraticD = px**2 - 4*quadraticA*(x + edge)
+        if quadraticD > 0:
+            hitdist = (-1*px - np.sqrt(quadraticD)) / (2*quadraticA)
+            if hitdist > 0 and hitdist < length:
+                return s + hitdist, -1*edge, px, codes[1], False, s, x, px
+        quadraticD = px**2 - 4*quadraticA*(x - edge)
+        hitdist = (-1*px + np.sqrt(quadraticD)) / (2*quadraticA)
+        if hitdist < length:
+            return s + hitdist, edge, px, codes[1], False, s, x, px
+    return (s + length, x + (px + halfan) * length, px + an, 0,
+            False, s, x, px)
+
+@_jit
+def _quadrupole(p, codes, length, s, x, px):
+    k, r, of, sk, c, sn = p[0], p[1], p[2], p[3], p[4], p[5]
+    up_hi, up_lo, down_hi, down_lo = p[6], p[7], p[8], p[9]
+    if r > 0:
+        if x > up_hi or x < up_lo:
+            return s, x, px, codes[0], False, s, x, px
+    xeff = x - of
+    s += length
+    x = xeff*c + px/sk*sn + of
+    if k > 0:
+        px = -1.0*xeff*sk*sn + px*c
+    else:
+        px = xeff*sk*sn + px*c
+    if r > 0:
+        if x > down_hi or x < down_lo:
+            return s, x, px, codes[1], False, s, x, px
+    return s, x, px, 0, False, s, x, px
+
+@_jit
+def _doubleapdrift(p, codes, length, s, x, px):
+    cu, cd, cdiam, ediam = p[0], p[1], p[2], p[3]
+    up_extr, up_coll_hi, up_coll_lo, up_circ = p[4], p[5], p[6], p[7]
+    down_circ, down_coll_circ, down_extr = p[8], p[9], p[10]
+    down_coll_extr, halfthick = p[11], p[12]
+    if ediam > 0 and x > up_extr:
+        return s, x, px, codes[0], False, s, x, px
+    if x < up_coll_hi and x > up_coll_lo:
+        return s, x, px, codes[1], False, s, x, px
+    if cdiam > 0 and x < up_circ:
+        return s, x, px, codes[2], False, s, x, px
+    x_inc = length * px
+    if x < cu:
+        if cdiam > 0 and (x + x_inc) < down_circ:
+            incfrac = (x - cu + cdiam) / (cd - cu - x_inc)
+            return (s + incfrac * length, x + incfrac * x_inc, px,
+                    codes[3], False, s, x, px)
+        if (x + x_inc) < down_coll_circ:
+            return s + length, x + x_inc, px, 0, False, s, x, px
+        incfrac = (x - cu + halfthick) / (cd - cu - x_inc)
+        return (s + incfrac * length, x + incfrac * x_inc, px, codes[4],
+                False, s, x, px)
+    if ediam > 0 and (x + x_inc) > down_extr:
+        incfrac = (x - cu - ediam) / (cd - cu - x_inc)
+        return (s + incfrac * length, x + incfrac * x_inc, px, codes[5],
+                False, s, x, px)
+    if (x + x_inc) > down_coll_extr:
+        return s + length, x + x_inc, px, 0, False, s, x, px
+    incfrac = (x - cu - halfthick) / (cd - cu - x_inc)
+    return (s + incfrac * length, x + incfrac * x_inc, px, codes[6],
+            False, s, x, px)
+
+@_jit
+def _septum(p, codes, length, s, x, px):
+    an, bu, bd, bt, cdiam, ediam = p[0], p[1], p[2], p[3], p[4], p[5]
+    quadraticA, slope, up_extr, up_blade_hi = p[6], p[7], p[8], p[9]
+    up_blade_lo, up_circ, down_circ = p[10], p[11], p[12]
+    down_blade_circ, halfthick = p[13], p[14]
+    if ediam > 0 and x > up_extr:
+        return s, x, px, codes[0], False, s, x, px
+    if x < up_blade_hi and x > up_blade_lo:
+        return s, x, px, codes[1], False, s, x, px
+    if cdiam > 0 and x < up_circ:
+        return s, x, px, codes[2], False, s, x, px
+    # Circulating aperture?
+    if x < bu:
+        x_inc = length * px
+        if cdiam > 0 and (x + x_inc) < down_circ:
+            incfrac = (x - bu + cdiam) / (bd - bu - x_inc)
+            return (s + incfrac * length, x + incfrac * x_inc, px,
+                    codes[3], False, s, x, px)
+        if (x + x_inc) < down_blade_circ:
+            return s + length, x + x_inc, px, 0, False, s, x, px
+        incfrac = (x - bu - halfthick) / (bd - bu - x_inc)
+        s += incfrac * length
+        x += incfrac * x_inc
+        if bt > 0:
+            return s, x, px, codes[4], False, s, x, px
+        # Through the virtual blade
+        bs, bx, bpx = s, x, px
+        templ = length - incfrac * length
+        tempan = an - incfrac * an
+        bladeposmid = x
+        if ediam > 0:
+            quadraticA = tempan/templ/2
+            quadraticB = px - (bd - bladeposmid) / templ
+            quadraticC = x - bladeposmid - ediam
+            quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+            hitdist = (-1*quadraticB + np.sqrt(quadraticD)) / (2*quadraticA)
+            if hitdist < templ:
+                return (s + hitdist,
+                        x + (quadraticA * hitdist**2 + px * hitdist),
+                        px + tempan * hitdist / templ, codes[5],
+                        True, bs, bx, bpx)
+        return (s + templ, x + (tempan/2 + px) * templ, px + tempan, 0,
+                True, bs, bx, bpx)
+    # Extraction aperture!
+    quadraticB = px - slope
+    quadraticC = x - bu - halfthick
+    quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+    hitdist = (-1*quadraticB - np.sqrt(quadraticD)) / (2*quadraticA)
+    if quadraticD > 0:
+        if hitdist > 0 and hitdist < length:
+            s += hitdist
+            x += quadraticA * hitdist**2 + px * hitdist
+            px += an * hitdist / length
+            if bt > 0:
+                return s, x, px, codes[6], False, s, x, px
+            # Through the virtual blade
+            bs, bx, bpx = s, x, px
+            templ = length - hitdist
+            x_inc = templ * px
+            bladeposmid = x
+            if cdiam > 0 and (x+x_inc) < (bd-cdiam):
+                incfrac = ((x - bladeposmid + cdiam)
+                           / (bd - bladeposmid - x_inc))
+                return (s + incfrac * templ, x + incfrac * x_inc, px,
+                        codes[3], True, bs, bx, bpx)
+            return s + templ, x + x_inc, px, 0, True, bs, bx, bpx
+    if ediam > 0:
+        quadraticC = x - bu - ediam
+        quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+        hitdist = (-1*quadraticB + np.sqrt(quadraticD)) / (2*quadraticA)
+        if hitdist < length:
+            return (s + hitdist,
+                    x + (quadraticA * hitdist**2 + px * hitdist),
+                    px + an * hitdist / length, codes[5], False, s, x, px)
+    return (s + length, x + (an/2 + px) * length, px + an, 0,
+            False, s, x, px)
+
+@_jit
+def _record(history, nhistory, i, s, x, px):
+    row = nhistory[i]
+    history[i, row, 0] = s
+    history[i, row, 1] = x
+    history[i, row, 2] = px
+    nhistory[i] = row + 1
+
+@_parallel
+def _track(kind, jump, length, params, codes, record, final, substeps,
+           s, x, px, lost, history, nhistory):
+    keep = history.shape[1] > 0
+    for i in _range(len(x)):
+        if lost[i] != 0:
+            continue
+        si, xi, pxi = s[i], x[i], px[i]
+        j = 0
+        while j < len(kind):
+            k = kind[j]
+            p = params[j]
+            # QuadHole selector, skip the hole quad if not in the hole
+            if k == QUADHOLE:
+                if not (xi > p[0] and xi < p[1]):
+                    j += 1
+                j += 1
+                continue
+            if k == DRIFT:
+                result = _drift(p, codes[j], length[j], si, xi, pxi)
+            elif k == KICKER:
+                result = _kicker(p, codes[j], length[j], si, xi, pxi)
+            elif k == QUADRUPOLE:
+                result = _quadrupole(p, codes[j], length[j], si, xi, pxi)
+            elif k == DOUBLEAPDRIFT:
+                result = _doubleapdrift(p, codes[j], length[j], si, xi, pxi)
+            else:
+                result = _septum(p, codes[j], length[j], si, xi, pxi)
+            si, xi, pxi, code, blade, bs, bx, bpx = result
+            if keep and blade and substeps:
+                _record(history, nhistory, i, bs, bx, bpx)
+            if code != 0:
+                lost[i] = code
+                if keep and (record[j] or final):
+                    _record(history, nhistory, i, si, xi, pxi)
+                break
+            if keep and record[j]:
+                _record(history, nhistory, i, si, xi, pxi)
+            j += 1 + jump[j]
+        s[i], x[i], px[i] = si, xi, pxi
+
+##################################################
+#                                                #
+#   track_table                                  #
+#                                                #
+##################################################
+
+def track_table(bank, table, history=1):
+    """Track a ParticleBank through a line compiled by compile_line().
+
+    JIT counterpart of tracking.track_bank(), with the particles
+    tracked in parallel over Numba's threads.
+    """
+    policy = HistoryPolicy(history)
+    size = bank.size
+    s, x, px = bank.s.reshape(-1), bank.x.reshape(-1), bank.px.reshape(-1)
+    if bank.history is not None:
+        buffer = bank.history.reshape(size, -1, 3)
+        count = bank.nhistory.reshape(-1)
+        if policy.start:
+            bank.record(np.arange(size), s, x, px)
+    else:
+        buffer = np.empty((size, 0, 3))
+        count = np.zeros(size, dtype=np.intp)
+    _track(table['type'].astype(np.int64), table['jump'].astype(np.int64),
+           table['len'], table['params'], table['codes'].astype(np.int64),
+           np.array(_record_flags(table, policy), dtype=np.bool_),
+           policy.final, policy.substeps, s, x, px, bank.lost.reshape(-1),
+           buffer, count)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Line compilation for MAD-X-like tracking in python.            #
+#                                                                      #
+########################################################################
+
+import numpy as np
+from .elements import (Drift, Kicker, Quadrupole, DoubleApDrift, Septum,
+                       QuadHole, TransferMap)
+from .losses import CIRCULATING
+from .particle import HistoryPolicy
+
+__all__ = ['fuse_line', 'compile_line', 'track_compiled', 'LATTICE', 'DRIFT',
+           'KICKER', 'QUADRUPOLE', 'DOUBLEAPDRIFT', 'SEPTUM', 'QUADHOLE']
+
+##################################################
+#                                                #
+#   fuse_line                                    #
+#                                                #
+##################################################
+
+def fuse_line(line):
+    """Line with every run of aperture-free linear elements fused.
+
+    Each maximal run of two or more elements whose transfer() is an
+    affine map (drifts, kickers and quadrupoles without aperture) is
+    replaced by a single TransferMap, all other elements are kept.
+    """
+    fused = []
+    run = []
+    for element in list(line) + [None]:
+        if element is not None and element.transfer() is not None:
+            run.append(element)
+            continue
+        if len(run) > 1:
+            fused.append(TransferMap(run))
+        else:
+            fused.extend(run)
+        run = []
+        if element is not None:
+            fused.append(element)
+    return fused
+
+##################################################
+#                                                #
+#   compile_line                                 #
+#                                                #
+##################################################
+
+# Row types of a compiled line
+DRIFT, KICKER, QUADRUPOLE, DOUBLEAPDRIFT, SEPTUM, QUADHOLE = range(6)
+
+LATTICE = np.dtype([('type', np.int8), ('jump', np.int8),
+                    ('nelements', np.int16), ('len', float),
+                    ('params', float, (16,)), ('codes', np.uint32, (7,))])
+
+def _row(kind, length, params, codes, nelements=1, jump=0):
+    row = np.zeros((), dtype=LATTICE)
+    row['type'] = kind
+    row['jump'] = jump
+    row['nelements'] = nelements
+    row['len'] = length
+    row['params'][:len(params)] = params
+    row['codes'][:len(codes)] = codes
+    return row
+
+def _lower(element):
+    """Rows of the lattice table for one element"""
+    if isinstance(element, TransferMap):
+        return [row for part in element.elements for row in _lower(part)]
+    if isinstance(element, QuadHole):
+        cache = element._cached()
+        # Selector, then the hole quad (skipping the next row) and the
+        # circulating quad
+        hole = _lower(cache.hole)[0]
+        hole['jump'] = 1
+        return [_row(QUADHOLE, element.len,
+                     (element.haaxu-element.hr, element.haaxu+element.hr),
+                     (), nelements=0),
+                hole, _lower(cache.circ)[0]]
+    if not isinstance(element, (Drift, Kicker, Quadrupole, DoubleApDrift,
+                                Septum)):
+        raise ValueError("Cannot compile element " + str(element.name) +
+                         " of type " + type(element).__name__)
+    cache = element._cached()
+    if getattr(cache, 'drift', None) is not None:
+        return _lower(cache.drift)
+    codes = [element.codes[location] for location in element.losslocations]
+    length = element.len
+    if isinstance(element, Drift):
+        r, ou, od = element.r, element.offset_u, element.offset_d
+        return [_row(DRIFT, length, (r, ou, od, ou+r, ou-r, od+r, od-r),
+                     codes)]
+    if isinstance(element, Kicker):
+        an, r = element.an, element.r
+        return [_row(KICKER, length, (an, r, cache.quadraticA, cache.edge,
+                                      an/2), codes)]
+    if isinstance(element, Quadrupole):
+        r, au, ad = element.r, element.offset_au, element.offset_ad
+        if element.k > 0:
+            c, sn = cache.cos, cache.sin
+        else:
+            c, sn = cache.cosh, cache.sinh
+        return [_row(QUADRUPOLE, length, (element.k, r, element.offset_f,
+                                          cache.sk, c, sn, au+r, au-r,
+                                          ad+r, ad-r), codes)]
+    if isinstance(element, DoubleApDrift):
+        cu, cd, ct = element.collpos_up, element.collpos_down, element.coll_thick
+        cdiam, ediam = element.cdiam, element.ediam
+        return [_row(DOUBLEAPDRIFT, length,
+                     (cu, cd, cdiam, ediam, cu+ediam, cu+ct/2, cu-ct/2,
+                      cu-cdiam, cd-cdiam, cd-ct/2, cd+ediam, cd+ct/2, ct/2),
+                     codes)]
+    bu, bd, bt = element.bladepos_up, element.bladepos_down, element.blade_thick
+    cdiam, ediam = element.cdiam, element.ediam
+    return [_row(SEPTUM, length,
+                 (element.an, bu, bd, bt, cdiam, ediam, cache.quadraticA,
+                  cache.slope, bu+ediam, bu+bt/2, bu-bt/2, bu-cdiam,
+                  bd-cdiam, bd-bt/2, bt/2), codes)]
+
+def compile_line(line):
+    """Lower line into a flat table of rows with dtype LATTICE.
+
+    Each row holds a type code, the length, a fixed set of parameter
+    columns including constants derived from them, and the loss codes
+    of the element. Elements that are drifts in disguise become DRIFT
+    rows, TransferMaps are expanded into their original elements and
+    a QuadHole becomes a selector row followed by its two quadrupoles.
+    The table is a plain array, cheap to store or send to another
+    process, and is tracked by track_compiled().
+    """
+    return np.array([row for element in line for row in _lower(element)],
+                    dtype=LATTICE)
+
+##################################################
+#                                                #
+#   Interpreter                                  #
+#                                                #
+##################################################
+
+# Kernels mirror the track() methods of the elements, operation by
+# operation, on plain floats. Each returns (s, x, px, loss code).
+
+def _drift(p, codes, length, s, x, px, particle):
+    r, ou, od, up_hi, up_lo, down_hi, down_lo = p[:7]
+    if r > 0:
+        if x > up_hi or x < up_lo:
+            return s, x, px, codes[0]
+    x_inc = length * px
+    if r > 0:
+        if (x + x_inc) > down_hi:
+            s_hit_over_l = (up_hi - x) / (x_inc + ou-od)
+            return (s + length * s_hit_over_l, x + x_inc * s_hit_over_l,
+                    px, codes[1])
+        if (x + x_inc) < down_lo:
+            s_hit_over_l = (up_lo - x) / (x_inc + ou-od)
+            return (s + length * s_hit_over_l, x + x_inc * s_hit_over_l,
+                    px, codes[1])
+    return s + length, x + x_inc, px, CIRCULATING
+
+def _kicker(p, codes, length, s, x, px, particle):
+    an, r, quadraticA, edge, halfan = p[:5]
+    if r > 0:
+        if x > r or x < (-1*r):
+            return s, x, px, codes[0]
+        quadraticD = px**2 - 4*quadraticA*(x + edge)
+        if quadraticD > 0:
+            hitdist = (-1*px - quadraticD**0.5) / (2*quadraticA)
+            if hitdist > 0 and hitdist < length:
+                return s + hitdist, -1*edge, px, codes[1]
+        quadraticD = px**2 - 4*quadraticA*(x - edge)
+        hitdist = (-1*px + quadraticD**0.5) / (2*quadraticA)
+        if hitdist < length:
+            return s + hitdist, edge, px, codes[1]
+    return s + length, x + (px + halfan) * length, px + an, CIRCULATING
+
+def _quadrupole(p, codes, length, s, x, px, particle):
+    k, r, of, sk, c, sn, up_hi, up_lo, down_hi, down_lo = p[:10]
+    if r > 0:
+        if x > up_hi or x < up_lo:
+            return s, x, px, codes[0]
+    xeff = x - of
+    s += length
+    x = xeff*c + px/sk*sn + of
+    if k > 0:
+        px = -1.0*xeff*sk*sn + px*c
+    else:
+        px = xeff*sk*sn + px*c
+    if r > 0:
+        if x > down_hi or x < down_lo:
+            return s, x, px, codes[1]
+    return s, x, px, CIRCULATING
+
+def _doubleapdrift(p, codes, length, s, x, px, particle):
+    (cu, cd, cdiam, ediam, up_extr, up_coll_hi, up_coll_lo, up_circ,
+     down_circ, down_coll_circ, down_extr, down_coll_extr, halfthick) = p[:13]
+    if ediam > 0 and x > up_extr:
+        return s, x, px, codes[0]
+    if x < up_coll_hi and x > up_coll_lo:
+        return s, x, px, codes[1]
+    if cdiam > 0 and x < up_circ:
+        return s, x, px, codes[2]
+    x_inc = length * px
+    if x < cu:
+        if cdiam > 0 and (x + x_inc) < down_circ:
+            incfrac = (x - cu + cdiam) / (cd - cu - x_inc)
+            return s + incfrac * length, x + incfrac * x_inc, px, codes[3]
+        if (x + x_inc) < down_coll_circ:
+            return s + length, x + x_inc, px, CIRCULATING
+        incfrac = (x - cu + halfthick) / (cd - cu - x_inc)
+        return s + incfrac * length, x + incfrac * x_inc, px, codes[4]
+    if ediam > 0 and (x + x_inc) > down_extr:
+        incfrac = (x - cu - ediam) / (cd - cu - x_inc)
+        return s + incfrac * length, x + incfrac * x_inc, px, codes[5]
+    if (x + x_inc) > down_coll_extr:
+        return s + length, x + x_inc, px, CIRCULATING
+    incfrac = (x - cu - halfthick) / (cd - cu - x_inc)
+    return s + incfrac * length, x + incfrac * x_inc, px, codes[6]
+
+def _septum(p, codes, length, s, x, px, particle):
+    (an, bu, bd, bt, cdiam, ediam, quadraticA, slope, up_extr, up_blade_hi,
+     up_blade_lo, up_circ, down_circ, down_blade_circ, halfthick) = p[:15]
+    if ediam > 0 and x > up_extr:
+        return s, x, px, codes[0]
+    if x < up_blade_hi and x > up_blade_lo:
+        return s, x, px, codes[1]
+    if cdiam > 0 and x < up_circ:
+        return s, x, px, codes[2]
+    # Circulating aperture?
+    if x < bu:
+        x_inc = length * px
+        if cdiam > 0 and (x + x_inc) < down_circ:
+            incfrac = (x - bu + cdiam) / (bd - bu - x_inc)
+            return s + incfrac * length, x + incfrac * x_inc, px, codes[3]
+        if (x + x_inc) < down_blade_circ:
+            return s + length, x + x_inc, px, CIRCULATING
+        incfrac = (x - bu - halfthick) / (bd - bu - x_inc)
+        s += incfrac * length
+        x += incfrac * x_inc
+        if bt > 0:
+            return s, x, px, codes[4]
+        # Through the virtual blade
+        if particle.substeps:
+            particle.history.append([s, x, px])
+        templ = length - incfrac * length
+        tempan = an - incfrac * an
+        bladeposmid = x
+        if ediam > 0:
+            quadraticA = tempan/templ/2
+            quadraticB = px - (bd - bladeposmid) / templ
+            quadraticC = x - bladeposmid - ediam
+            quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+            hitdist = (-1*quadraticB + quadraticD**0.5) / (2*quadraticA)
+            if hitdist < templ:
+                return (s + hitdist,
+                        x + (quadraticA * hitdist**2 + px * hitdist),
+                        px + tempan * hitdist / templ, codes[5])
+        return (s + templ, x + (tempan/2 + px) * templ, px + tempan,
+                CIRCULATING)
+    # Extraction aperture!
+    quadraticB = px - slope
+    quadraticC = x - bu - halfthick
+    quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+    hitdist = (-1*quadraticB - quadraticD**0.5) / (2*quadraticA)
+    if quadraticD > 0:
+        if hitdist > 0 and hitdist < length:
+            s += hitdist
+            x += quadraticA * hitdist**2 + px * hitdist
+            px += an * hitdist / length
+            if bt > 0:
+                return s, x, px, codes[6]
+            # Through the virtual blade
+            if particle.substeps:
+                particle.history.append([s, x, px])
+            templ = length - hitdist
+            x_inc = templ * px
+            bladeposmid = x
+            if cdiam > 0 and (x+x_inc) < (bd-cdiam):
+                incfrac = ((x - bladeposmid + cdiam)
+                           / (bd - bladeposmid - x_inc))
+                return (s + incfrac * templ, x + incfrac * x_inc, px,
+                        codes[3])
+            return s + templ, x + x_inc, px, CIRCULATING
+    if ediam > 0:
+        quadraticC = x - bu - ediam
+        quadraticD = quadraticB**2 - 4*quadraticA*quadraticC
+        hitdist = (-1*quadraticB + quadraticD**0.5) / (2*quadraticA)
+        if hitdist < length:
+            return (s + hitdist, x + (quadraticA * hitdist**2 + px * hitdist),
+                    px + an * hitdist / length, codes[5])
+    return s + length, x + (an/2 + px) * length, px + an, CIRCULATING
+
+_KERNELS = {DRIFT: _drift, KICKER: _kicker, QUADRUPOLE: _quadrupole,
+            DOUBLEAPDRIFT: _doubleapdrift, SEPTUM: _septum}
+
+def _nelements(table):
+    """Number of elements of a compiled line"""
+    # Only one of the two quadrupole rows of a QuadHole is tracked
+    return int(table['nelements'].sum() - (table['type'] == QUADHOLE).sum())
+
+def _record_flags(table, policy):
+    """Per row, is the state after it recorded by HistoryPolicy policy?
+
+    Assumes the particle survives the row, lost particles are recorded
+    if policy.final.
+    """
+    nlast = _nelements(table)
+    flags = []
+    n = 0
+    for jump, nelements in zip(table['jump'].tolist(),
+                               table['nelements'].tolist()):
+        # The hole quad of a QuadHole is the same element as the next
+        after = n + nelements
+        if not jump:
+            n = after
+        flags.append(policy.boundary(after)
+                     or policy.finalpoint(False, after == nlast))
+    return flags
+
+def _interpreter_rows(table, policy):
+    """Rows of a compiled line as tuples of plain Python values"""
+    return [(_KERNELS.get(kind), jump, length, tuple(params), tuple(codes),
+             record)
+            for kind, jump, length, params, codes, record in zip(
+                table['type'].tolist(), table['jump'].tolist(),
+                table['len'].tolist(), table['params'].tolist(),
+                table['codes'].tolist(), _record_flags(table, policy))]
+
+def _run(particle, rows, final):
+    s, x, px = particle.s, particle.x, particle.px
+    rows = iter(rows)
+    for kernel, jump, length, params, codes, record in rows:
+        # QuadHole selector, skip the hole quad if not in the hole
+        # (the parameters are the bounds of the hole)
+        if kernel is None:
+            if not (x > params[0] and x < params[1]):
+                next(rows)
+            continue
+        s, x, px, code = kernel(params, codes, length, s, x, px, particle)
+        if code != CIRCULATING:
+            particle.s, particle.x, particle.px = s, x, px
+            particle.losscode = code
+            if record or final:
+                particle.update_history()
+            return
+        if record:
+            particle.s, particle.x, particle.px = s, x, px
+            particle.update_history()
+        if jump:
+            next(rows)
+    particle.s, particle.x, particle.px = s, x, px
+    return
+
+def track_compiled(particle, table, history=1):
+    """track() through a line compiled by compile_line().
+
+    Gives the same results as track() on the original line, but runs
+    a single loop over the table rows with plain float kernels.
+    """
+    policy = HistoryPolicy(history)
+    if not policy.start:
+        particle.history = []
+    particle.substeps = policy.substeps
+    _run(particle, _interpreter_rows(table, policy), policy.final)
+    return
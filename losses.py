@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Loss bookkeeping for MAD-X-like tracking in python.            #
+#                                                                      #
+########################################################################
+
+import numpy as np
+
+__all__ = ['CIRCULATING', 'LossRegistry', 'losscodes', 'SIDES', 'LossMap',
+           'lossmap']
+
+CIRCULATING = 0
+
+##################################################
+#                                                #
+#   LossRegistry                                 #
+#                                                #
+##################################################
+
+class LossRegistry:
+    """Interned table of loss labels.
+
+    Every (element, location) pair, e.g. ('ZS3', 'start_extr'), gets a
+    small integer code the first time it is registered, normally when
+    the element is constructed. Tracking only stores these codes, the
+    label 'ZS3_start_extr' is decoded on demand. Code 0 is
+    'CIRCULATING'.
+    """
+    def __init__(self):
+        self.labels = ['CIRCULATING']
+        self.elements = ['']
+        self.locations = ['']
+        self._codes = {'CIRCULATING': CIRCULATING}
+        self._table = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def code(self, element, location=None):
+        """Code of a loss label, registered if new"""
+        label = element
+        if location is not None:
+            label = element + '_' + location
+        if label not in self._codes:
+            self._codes[label] = len(self.labels)
+            self.labels.append(label)
+            self.elements.append(element)
+            self.locations.append(location or '')
+            self._table = None
+        return self._codes[label]
+
+    def register(self, element, locations):
+        """Codes of all loss locations of an element, as a dict"""
+        return {location: self.code(element, location)
+                for location in locations}
+
+    def label(self, code):
+        return self.labels[code]
+
+    def decode(self, codes):
+        """Object array of loss labels for an array of codes"""
+        if self._table is None or len(self._table) != len(self.labels):
+            self._table = np.array(self.labels, dtype=object)
+        return self._table[codes]
+
+    def dtype(self):
+        """Smallest unsigned integer type holding all current codes"""
+        if len(self.labels) <= np.iinfo(np.uint16).max + 1:
+            return np.uint16
+        return np.uint32
+
+losscodes = LossRegistry()
+
+##################################################
+#                                                #
+#   Loss maps                                    #
+#                                                #
+##################################################
+
+# Sides of an aperture a loss location can be on
+SIDES = ('aperture', 'circ', 'extr', 'blade', 'coll')
+
+def _side(location):
+    for side in ('blade', 'coll', 'circ', 'extr'):
+        if side in location:
+            return SIDES.index(side)
+    return SIDES.index('aperture')
+
+class LossMap:
+    """Losses binned in s, per element and side of the aperture.
+
+    counts[element, side, bin] holds the (weighted) number of
+    particles lost by element elements[element], on side SIDES[side],
+    with s between edges[bin] and edges[bin+1].
+    """
+    def __init__(self, elements, edges, counts):
+        self.elements = elements
+        self.edges = edges
+        self.counts = counts
+
+    def element(self, name):
+        """(side, bin) counts of the element called name"""
+        return self.counts[self.elements.index(name)]
+
+    def total(self):
+        """Counts per bin of all elements and sides"""
+        return self.counts.sum(axis=(0, 1))
+
+    def density(self):
+        """Counts per metre, per element, side and bin"""
+        return self.counts / np.diff(self.edges)
+
+def _code_tables(registry):
+    """Element index and side of every loss code, -1 if circulating"""
+    names = list(dict.fromkeys(registry.elements[1:]))
+    index = {name: number for number, name in enumerate(names)}
+    elements = np.array([-1] + [index[name]
+                                for name in registry.elements[1:]])
+    sides = np.array([-1] + [_side(location)
+                             for location in registry.locations[1:]])
+    return names, elements, sides
+
+def lossmap(results, bins=1000, weights=None, smax=None, block=4000000):
+    """LossMap of the particles lost in results.
+
+    results is a ParticleBank (or TrackGrid), a ResultStore, or a pair
+    of arrays (s, codes) of final s and loss codes; an AdaptiveGrid
+    has no final s and is refused. bins is a number of bins from 0 to
+    smax, by default the largest s of a loss, or an array of bin
+    edges. weights, shaped like the particles, weights each particle.
+    Particles are binned by code and s with one bincount per block
+    particles, so a ResultStore is read in blocks. Losses outside the
+    edges are dropped.
+    """
+    table = None
+    if hasattr(results, 'labels'):
+        # ResultStore, its codes are indices into its labels
+        table = results.table()
+        s, codes = results.s, results.lost
+    elif isinstance(results, tuple):
+        s, codes = results
+    else:
+        particles = getattr(results, 'particles', results)
+        if not hasattr(particles, 's'):
+            # e.g. an AdaptiveGrid, which only keeps loss codes
+            raise ValueError("lossmap needs the final s of the particles, "
+                             "not only their loss codes")
+        s, codes = particles.s, particles.lost
+    s = np.asarray(s).reshape(-1)
+    codes = np.asarray(codes).reshape(-1)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float).reshape(-1)
+
+    names, elements, sides = _code_tables(losscodes)
+    if np.ndim(bins) == 0:
+        if smax is None:
+            smax = 0.0
+            for start in range(0, len(s), block):
+                part = codes[start:start+block]
+                if table is not None:
+                    part = table[part]
+                lost = part != CIRCULATING
+                if lost.any():
+                    smax = max(smax, float(s[start:start+block][lost].max()))
+            smax = smax or 1.0
+        edges = np.linspace(0, smax, bins+1)
+    else:
+        edges = np.asarray(bins, dtype=float)
+    nbins = len(edges) - 1
+    nsides = len(SIDES)
+
+    counts = np.zeros(len(names) * nsides * nbins)
+    for start in range(0, len(s), block):
+        part = codes[start:start+block]
+        if table is not None:
+            part = table[part]
+        where = s[start:start+block]
+        binned = np.searchsorted(edges, where, side='right') - 1
+        # Losses at the last edge fall in the last bin
+        binned[where == edges[-1]] = nbins - 1
+        keep = (part != CIRCULATING) & (binned >= 0) & (binned < nbins)
+        flat = ((elements[part[keep]] * nsides + sides[part[keep]]) * nbins
+                + binned[keep])
+        counts += np.bincount(
+            flat, minlength=len(counts),
+            weights=None if weights is None
+            else weights[start:start+block][keep])
+    return LossMap(names, edges, counts.reshape(len(names), nsides, nbins))
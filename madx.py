@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       MAD-X import for MAD-X-like tracking in python.                #
+#                                                                      #
+########################################################################
+
+import os
+import re
+import json
+import pickle
+import hashlib
+from .elements import (Drift, Kicker, Quadrupole, DoubleApDrift, Septum,
+                       QuadHole)
+
+__all__ = ['read_tfs', 'line_from_tfs', 'import_tfs']
+
+##################################################
+#                                                #
+#   TFS tables                                   #
+#                                                #
+##################################################
+
+_TOKEN = re.compile(r'"[^"]*"|\S+')
+
+def _value(token, form):
+    if form.endswith('s'):
+        return token.strip('"')
+    if form.endswith('d'):
+        return int(token)
+    return float(token)
+
+def read_tfs(filename):
+    """Header dict and list of row dicts of a MAD-X TFS table"""
+    header = {}
+    columns = []
+    forms = []
+    rows = []
+    with open(filename) as f:
+        for text in f:
+            if not text.strip() or text.startswith('#'):
+                continue
+            tokens = _TOKEN.findall(text)
+            if tokens[0] == '@':
+                header[tokens[1]] = _value(' '.join(tokens[3:]), tokens[2])
+            elif tokens[0] == '*':
+                columns = [column.upper() for column in tokens[1:]]
+            elif tokens[0] == '$':
+                forms = tokens[1:]
+            else:
+                if len(tokens) != len(columns):
+                    raise ValueError("Row of " + str(len(tokens)) + " values"
+                                     " for " + str(len(columns)) + " columns"
+                                     " in " + filename)
+                rows.append({column: _value(token, form) for column, form,
+                             token in zip(columns, forms, tokens)})
+    return header, rows
+
+##################################################
+#                                                #
+#   Lines                                        #
+#                                                #
+##################################################
+
+_CLASSES = {cls.__name__: cls for cls in (Drift, Kicker, Quadrupole,
+                                          DoubleApDrift, Septum, QuadHole)}
+
+# MAD-X keywords tracked as a Kicker, kicking by their HKICK
+_KICKERS = ('HKICKER', 'KICKER')
+
+def _element(row, overrides, aperture):
+    """Element of a TFS row, None for thin elements without effect"""
+    name = row['NAME']
+    length = row.get('L', 0.0)
+    if name in overrides:
+        kind, parameters = overrides[name]
+        if kind not in _CLASSES:
+            raise ValueError("Unknown element class " + kind + " for "
+                             + name)
+        return _CLASSES[kind](name, length, **parameters)
+    keyword = row.get('KEYWORD', 'DRIFT').upper()
+    radius = max(row.get(aperture, 0.0), 0.0)
+    if keyword == 'QUADRUPOLE' and length > 0:
+        return Quadrupole(name, length, row.get('K1L', 0.0)/length, radius)
+    if keyword in _KICKERS and row.get('HKICK', 0.0) != 0:
+        if length <= 0:
+            raise ValueError("Thin " + keyword + " " + name + " is not "
+                             "supported, give it a length")
+        return Kicker(name, length, row['HKICK'], radius)
+    if keyword == 'QUADRUPOLE' and row.get('K1L', 0.0) != 0:
+        raise ValueError("Thin QUADRUPOLE " + name + " is not supported, "
+                         "give it a length")
+    if length > 0:
+        return Drift(name, length, radius)
+    return None
+
+def line_from_tfs(rows, overrides=None, aperture='APER_1', tolerance=1E-9):
+    """Line of elements from the rows of a MAD-X twiss or survey table.
+
+    Rows need NAME, S (at the element exit) and L, and use KEYWORD,
+    K1L, HKICK and the aperture column if present. QUADRUPOLEs become
+    Quadrupoles, HKICKERs and KICKERs Kickers, other elements with
+    length Drifts, and thin elements without effect are left out.
+    Gaps between elements are filled with Drifts.
+
+    Tracking is relative to the MAD-X reference orbit, which the ANGLE
+    of SBENDs and RBENDs bends, so these become Drifts too (without
+    their weak focusing). Give bends that kick the beam off the
+    reference orbit as a Kicker in overrides.
+
+    Elements MAD-X has no equivalent for, such as septa, are given in
+    overrides, mapping an element name to (class name, parameters),
+    e.g. {'ZS1': ('Septum', {'bendingangle': 8.327E-5, ...})}. The
+    element is then built as the class with the name and length of
+    the row and these keyword parameters.
+    """
+    overrides = overrides or {}
+    line = []
+    s = None
+    for row in rows:
+        start = row['S'] - row.get('L', 0.0)
+        if s is None:
+            s = start
+        if start > s + tolerance:
+            line.append(Drift('DRIFT_' + str(len(line)), start - s, 0))
+        elif start < s - tolerance:
+            raise ValueError("Element " + row['NAME'] + " overlaps the "
+                             "previous one by " + str(s - start) + " m")
+        element = _element(row, overrides, aperture)
+        if element is not None:
+            line.append(element)
+        s = row['S']
+    return line
+
+##################################################
+#                                                #
+#   Cached import                                #
+#                                                #
+##################################################
+
+# Bump when the import or the elements change how a file is read
+_VERSION = 2
+
+def _cached_line(path, key):
+    """Line pickled at path, if its entry matches key"""
+    try:
+        with open(path + '.json') as f:
+            entry = json.load(f)
+        if entry.get('key') != key:
+            return None
+        with open(path, 'rb') as f:
+            content = f.read()
+    except (OSError, ValueError):
+        return None
+    if hashlib.sha256(content).hexdigest() != entry.get('sha256'):
+        return None
+    return pickle.loads(content)
+
+def _write_atomic(path, content):
+    # Replace atomically, for workers importing at the same time
+    temp = path + '.' + str(os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(content)
+    os.replace(temp, path)
+
+def import_tfs(filename, overrides=None, aperture='APER_1', cache=None):
+    """Line of the MAD-X TFS file filename, see line_from_tfs().
+
+    The line is cached as a pickle keyed by the hash of the file and
+    of the import options, in cache, by default a __linecache__
+    directory next to the file, so later imports of an unchanged file
+    only unpickle it. A JSON entry next to the pickle records the key
+    and the hash of the pickle, which are checked before it is
+    loaded. Unpickling runs code, so the cache directory must be
+    trusted like the source. A cache that cannot be written, e.g. in
+    a read-only directory, is skipped. cache=False disables the
+    cache.
+    """
+    with open(filename, 'rb') as f:
+        content = f.read()
+    # default=float for NumPy scalars among the override parameters
+    options = json.dumps([_VERSION, overrides or {}, aperture],
+                         sort_keys=True, default=float)
+    key = hashlib.sha256(content + options.encode()).hexdigest()
+    if cache is None:
+        cache = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                             '__linecache__')
+    if cache is not False:
+        path = os.path.join(cache, key + '.pkl')
+        line = _cached_line(path, key)
+        if line is not None:
+            return line
+
+    _, rows = read_tfs(filename)
+    line = line_from_tfs(rows, overrides, aperture)
+
+    if cache is not False:
+        pickled = pickle.dumps(line, protocol=pickle.HIGHEST_PROTOCOL)
+        entry = {'key': key, 'sha256': hashlib.sha256(pickled).hexdigest()}
+        try:
+            os.makedirs(cache, exist_ok=True)
+            _write_atomic(path, pickled)
+            _write_atomic(path + '.json', json.dumps(entry).encode())
+        except OSError:
+            pass
+    return line
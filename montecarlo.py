@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Monte Carlo loss estimates for MAD-X-like tracking in python.  #
+#                                                                      #
+########################################################################
+
+import numpy as np
+from .particle import ParticleBank
+from .losses import losscodes
+from .tracking import track_bank
+
+__all__ = ['halton', 'inside_polygon', 'LossEstimate', 'stream_losses',
+           'estimate_losses']
+
+##################################################
+#                                                #
+#   Sampling                                     #
+#                                                #
+##################################################
+
+def halton(index, base):
+    """Radical inverse in base of an integer array index, in [0, 1)"""
+    index = np.array(index, dtype=np.int64)
+    result = np.zeros(index.shape)
+    factor = 1.0
+    while (index > 0).any():
+        factor /= base
+        result += factor * (index % base)
+        index //= base
+    return result
+
+def inside_polygon(x, px, polygon):
+    """Mask of the points (x, px) inside polygon, by the even-odd rule"""
+    x = np.asarray(x, dtype=float)
+    px = np.asarray(px, dtype=float)
+    polygon = np.asarray(polygon, dtype=float)
+    inside = np.zeros(np.broadcast(x, px).shape, dtype=bool)
+    for (xa, pa), (xb, pb) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        if pa == pb:
+            continue
+        crosses = (pa > px) != (pb > px)
+        inside ^= crosses & (x < xa + (px-pa) * (xb-xa) / (pb-pa))
+    return inside
+
+##################################################
+#                                                #
+#   Loss estimates                               #
+#                                                #
+##################################################
+
+class LossEstimate:
+    """Loss fractions estimated from n tracked samples.
+
+    fractions and errors map loss labels to the estimated fraction of
+    the beam and the half width of its confidence interval, z standard
+    errors of the spread between the independently shifted replicates.
+    """
+    def __init__(self, n, fractions, errors):
+        self.n = n
+        self.fractions = fractions
+        self.errors = errors
+
+    def __repr__(self):
+        return ('LossEstimate(n=' + str(self.n) + ', ' + ', '.join(
+            '{0}: {1:.4g} +- {2:.2g}'.format(label, self.fractions[label],
+                                            self.errors[label])
+            for label in self.fractions) + ')')
+
+def stream_losses(line, beam=None, density=None, box=None, precision=1E-3,
+                  batch=4096, replicates=16, max_samples=10**7, z=1.96,
+                  seed=None, backend='numpy'):
+    """Yield LossEstimates of a beam as samples are tracked in batches.
+
+    The beam is a polygon of (x, px) points, as the beam of the
+    examples, and/or a density(x, px) weighting the samples. Samples
+    are Halton points (bases 2 and 3) spread over box, ((xmin, xmax),
+    (pxmin, pxmax)), by default the bounding box of beam. Each of the
+    replicates uses its own random shift of the sequence (randomized
+    quasi Monte Carlo), and the confidence intervals come from the
+    spread between the replicates.
+
+    Every batch tracks batch points per replicate. Stops once the
+    errors of all labels are below precision, after at least two
+    batches, or after max_samples samples.
+    """
+    if beam is None and density is None:
+        raise ValueError("Need a beam polygon or a density to sample")
+    if box is None:
+        if beam is None:
+            raise ValueError("Need a box to sample a density in")
+        corners = np.asarray(beam, dtype=float)
+        box = tuple(zip(corners.min(axis=0), corners.max(axis=0)))
+    (xmin, xmax), (pxmin, pxmax) = box
+    shifts = np.random.default_rng(seed).random((replicates, 2, 1))
+
+    # Sums of the weights per replicate, of all and of each label
+    total = np.zeros(replicates)
+    sums = {}
+    nsamples = 0
+    start = 1
+    while True:
+        index = np.arange(start, start+batch)
+        start += batch
+        x = xmin + (xmax-xmin) * ((halton(index, 2) + shifts[:, 0]) % 1)
+        px = pxmin + (pxmax-pxmin) * ((halton(index, 3) + shifts[:, 1]) % 1)
+        weight = np.ones(x.shape)
+        if beam is not None:
+            weight *= inside_polygon(x, px, beam)
+        if density is not None:
+            weight *= density(x, px)
+        counted = weight > 0
+        nsamples += int(counted.sum())
+        total += weight.sum(axis=1)
+
+        # Only track samples that count
+        bank = ParticleBank(x[counted], px[counted])
+        track_bank(bank, line, None, backend)
+        lost = np.zeros(x.shape, dtype=bank.lost.dtype)
+        lost[counted] = bank.lost
+        for code in np.unique(bank.lost).tolist():
+            label = losscodes.label(code)
+            sums.setdefault(label, np.zeros(replicates))
+            sums[label] += np.where(lost == code, weight, 0).sum(axis=1)
+
+        if not (total > 0).all():
+            if (start-1) * replicates < max_samples:
+                continue
+            raise ValueError("No samples inside the beam")
+        fractions = {}
+        errors = {}
+        for label, weights in sums.items():
+            estimates = weights / total
+            fractions[label] = float(estimates.mean())
+            errors[label] = float(z * estimates.std(ddof=1)
+                                  / np.sqrt(replicates))
+        yield LossEstimate(nsamples, fractions, errors)
+        if ((start > 1 + batch and max(errors.values()) <= precision)
+                or (start-1) * replicates >= max_samples):
+            return
+
+def estimate_losses(line, beam=None, density=None, **kwargs):
+    """Last LossEstimate of stream_losses()"""
+    for estimate in stream_losses(line, beam, density, **kwargs):
+        pass
+    return estimate
@@ -14,9 +14,31 @@
 #                                                #
 ##################################################
 
-def lineprint(line):
+def lineprint(line, profile=None):
+    """Print the elements of line with the s at their end.
+
+    Given a LineProfile (see profiling.instrument()), also prints the
+    particles entering, lost and surviving each element, the time
+    spent in it and the losses per location.
+    """
+    if profile is not None:
+        stats = {id(stat.element): stat for stat in profile.elements}
+        row = '{0:<20} {1:>10.4f} {2:>10} {3:>10} {4:>10} {5:>10.3f}  {6}'
+        print('{0:<20} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10}  {6}'.format(
+            'name', 's', 'entering', 'lost', 'surviving', 'ms', 'losses'))
     dist = 0.0
     for element in line:
         dist += element.len
-        print(element.name, '{0:.4f}'.format(dist))
+        if profile is None:
+            print(element.name, '{0:.4f}'.format(dist))
+            continue
+        stat = stats.get(id(element))
+        if stat is None:
+            print('{0:<20} {1:>10.4f}'.format(element.name, dist))
+            continue
+        print(row.format(
+            element.name, dist, stat.entering, sum(stat.lost.values()),
+            stat.surviving, stat.seconds*1E3,
+            ', '.join('{0}: {1}'.format(label, count)
+                      for label, count in stat.lost.items())))
     return
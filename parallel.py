@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Worker pools for MAD-X-like tracking in python.                #
+#                                                                      #
+########################################################################
+
+import multiprocessing
+
+__all__ = ['pool']
+
+def pool(workers, **kwargs):
+    """multiprocessing.Pool of workers, for tracking and rendering.
+
+    Workers are started from a fork server, or spawned where there is
+    none, never forked from this process: once Numba's parallel
+    kernels ran here (backend='jit'), forked children inherit its
+    thread pool locked and hang. As with any spawned pool, scripts
+    must start it under if __name__ == '__main__':.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    method = 'forkserver' if 'forkserver' in methods else 'spawn'
+    return multiprocessing.get_context(method).Pool(workers, **kwargs)
@@ -1,20 +1,163 @@
+import numpy as np
+from .losses import CIRCULATING, losscodes
+
 class Particle:
     """Particle-like object, used for tracking"""
     def __init__(self, x, px):
         self.s = 0
         self.x = x
         self.px = px
-        self.lost = 'CIRCULATING'
+        self.losscode = CIRCULATING
         self.start = [0, x, px]
         self.history = [self.start]
+        # Record states inside elements, e.g. at virtual septum blades?
+        self.substeps = True
+
+    @property
+    def lost(self):
+        """Loss label, decoded from losscode"""
+        return losscodes.label(self.losscode)
+
+    @lost.setter
+    def lost(self, label):
+        self.losscode = losscodes.code(label)
 
     def state(self):
         return [self.s, self.x, self.px]
 
-    def update_history(self):
+    def update_history(self, substep=False):
+        if substep and not self.substeps:
+            return
         self.history.append(self.state())
 
     def print(self):
         print(" Particle state: " + str(self.state()) +
               "\n Lost?: " + self.lost +
               "\n Particle history: " + str(self.history) + "\n")
+
+class HistoryPolicy:
+    """Selects the states recorded in particle histories.
+
+    history can be
+        None or 'none'  record nothing,
+        'final'         only the final state,
+        'loss'          the start and, for lost particles, the loss point,
+        N               the start, every N-th element boundary and the
+                        final state. N=1 also records virtual septum blade
+                        crossings, i.e. everything, as track() always did.
+    """
+    def __init__(self, history=1):
+        if isinstance(history, HistoryPolicy):
+            history = history.mode
+        self.mode = history
+        self.every = 0
+        self.start = False
+        self.final = False
+        self.lossonly = False
+        if history is None or history == 'none':
+            pass
+        elif history == 'final':
+            self.final = True
+        elif history == 'loss':
+            self.start = True
+            self.final = True
+            self.lossonly = True
+        elif isinstance(history, (int, np.integer)) and history > 0:
+            self.every = int(history)
+            self.start = True
+            self.final = True
+        else:
+            raise ValueError("Unknown history policy: " + repr(history))
+        self.substeps = self.every == 1
+
+    def boundary(self, n):
+        """Record the state after the n-th element (counting from 1)?"""
+        return self.every > 0 and n % self.every == 0
+
+    def finalpoint(self, lost, last):
+        """Record the state of a particle that was lost or left the line?"""
+        return self.final and (lost | (last and not self.lossonly))
+
+    def npoints(self, line):
+        """Maximum number of recorded states of a particle in line"""
+        if self.every == 0:
+            return int(self.start) + int(self.final)
+        nelements = sum(element.nelements for element in line)
+        npoints = 2 + nelements // self.every
+        if self.substeps:
+            npoints += sum(element.substeps for element in line)
+        return npoints
+
+class ParticleBank:
+    """Many particles stored as arrays rather than Particle objects.
+
+    s, x and px are float64 arrays shaped like the grid, start adds a
+    trailing (s, x, px) axis, and lost holds the integer loss codes of
+    losscodes. If npoints > 0 the states recorded during tracking, see
+    HistoryPolicy, are kept in history[..., :nhistory, :]. ids, None
+    unless set, labels every particle, e.g. by its index in a TrackList,
+    apart from its loss code.
+    Indexing returns a Particle copy of a single entry.
+    """
+    def __init__(self, x, px, npoints=0):
+        self.x = np.array(x, dtype=float)
+        self.px = np.array(px, dtype=float)
+        self.shape = self.x.shape
+        self.s = np.zeros(self.shape)
+        self.start = np.stack((self.s, self.x, self.px), axis=-1)
+        self.lost = np.full(self.shape, CIRCULATING,
+                            dtype=losscodes.dtype())
+        self.ids = None
+        self.history = None
+        self.nhistory = None
+        if npoints > 0:
+            self.history = np.empty(self.shape + (npoints, 3))
+            self.nhistory = np.zeros(self.shape, dtype=np.intp)
+
+    @property
+    def size(self):
+        return self.x.size
+
+    def set_ids(self, ids):
+        """Label every particle, e.g. by its index, keeping its loss code"""
+        self.ids = np.array([str(label) for label in np.ravel(ids)],
+                            dtype=object).reshape(self.shape)
+
+    def losses(self):
+        """Object array of loss labels, shaped like the bank"""
+        return losscodes.decode(self.lost)
+
+    def record(self, index, s, x, px):
+        """Append states to the histories of flat indices index"""
+        history = self.history.reshape(self.size, -1, 3)
+        count = self.nhistory.reshape(-1)
+        rows = count[index]
+        history[index, rows, 0] = s
+        history[index, rows, 1] = x
+        history[index, rows, 2] = px
+        count[index] += 1
+
+    def store(self, index, particle):
+        """Copy a tracked Particle into entry index"""
+        self.s[index] = particle.s
+        self.x[index] = particle.x
+        self.px[index] = particle.px
+        self.start[index] = particle.start
+        self.lost[index] = particle.losscode
+        if self.history is not None:
+            self.nhistory[index] = len(particle.history)
+            self.history[index][:len(particle.history)] = particle.history
+
+    def __getitem__(self, index):
+        particle = Particle(float(self.start[index][1]),
+                            float(self.start[index][2]))
+        particle.s = float(self.s[index])
+        particle.x = float(self.x[index])
+        particle.px = float(self.px[index])
+        particle.losscode = int(self.lost[index])
+        particle.start = self.start[index].tolist()
+        particle.history = []
+        if self.history is not None:
+            particle.history = (self.history[index]
+                                [:self.nhistory[index]].tolist())
+        return particle
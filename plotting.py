@@ -1,34 +1,262 @@
+import zlib
+import struct
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.patches import Polygon
+from matplotlib.collections import PolyCollection, LineCollection
+from .particle import ParticleBank
+from .losses import losscodes
+from .store import ResultStore
+from .tracking import grid_tiles
+from .parallel import pool as _pool
 
-def _color_losses(particles, colorcodes):
-    colored_losses = np.zeros_like(particles, dtype=int)
+__all__ = ['ApertureGeometry', 'acceptance_raster', 'acceptancepng',
+           'draw_acceptance', 'acceptanceplot', 'draw_trajectories',
+           'trajectoryplot', 'acceptancefigure', 'trajectoryfigure',
+           'render_batch']
+
+def _loss_codes(particles):
+    """Loss codes of a ParticleBank, a code array or Particle array"""
+    if isinstance(particles, ParticleBank):
+        return particles.lost
+    particles = np.asarray(particles)
+    if particles.dtype != object:
+        return particles
+    codes = np.empty(particles.shape, dtype=int)
+    for index, particle in np.ndenumerate(particles):
+        codes[index] = particle.losscode
+    return codes
 
+def _classify(label, colorcodes):
+    """Colour index of one loss label, 0 if no colorcode matches"""
+    colored = 0
     for c_index, colorcode in enumerate(colorcodes):
         if colorcode[0] != 'Other':
-            for p_index, particle in np.ndenumerate(particles):
-                contains_checks = all(sub in particle.lost
-                                      for sub in colorcode[1])
-                exclude_checks = all(sub not in particle.lost
-                                     for sub in colorcode[2])
-                options_empty = (len(colorcode[3])==0)
-                options_checks = any(sub in particle.lost
-                                      for sub in colorcode[3])
-                if (contains_checks and exclude_checks
-                    and (options_empty or options_checks)):
-                    colored_losses[p_index] = c_index+1
-
-    if colorcodes[-1][0] == 'Other':
-        for index, entry in np.ndenumerate(colored_losses):
-            if entry == 0:
-                colored_losses[index] = len(colorcodes)
-
-    return colored_losses
+            contains_checks = all(sub in label for sub in colorcode[1])
+            exclude_checks = all(sub not in label for sub in colorcode[2])
+            options_empty = (len(colorcode[3])==0)
+            options_checks = any(sub in label for sub in colorcode[3])
+            if (contains_checks and exclude_checks
+                and (options_empty or options_checks)):
+                colored = c_index+1
+    if colored == 0 and colorcodes[-1][0] == 'Other':
+        colored = len(colorcodes)
+    return colored
 
-def acceptanceplot(trackgrid, colorcodes, colormap, show=True,
-                   filename=None, beam=None, aperture=None):
-    colored_losses = _color_losses(trackgrid.particles, colorcodes)
+def _remember(cache, key, value, size):
+    """Store value under key, dropping the least recently stored
+    entries beyond size"""
+    cache.pop(key, None)
+    cache[key] = value
+    while len(cache) > size:
+        del cache[next(iter(cache))]
+
+# Colour tables of the most recently used colorcode lists
+_color_tables = {}
+_COLOR_TABLES = 16
+
+def _color_table(colorcodes):
+    """Colour index per loss code, compiled once per colorcode list.
+
+    Labels registered after compilation are classified when the
+    table is next requested, so the cost scales with the number of
+    distinct labels and not with the number of particles. Tables of
+    the last _COLOR_TABLES colorcode lists are kept.
+    """
+    key = repr(colorcodes)
+    table = _color_tables.get(key, np.zeros(0, dtype=int))
+    if len(table) < len(losscodes):
+        new = [_classify(label, colorcodes)
+               for label in losscodes.labels[len(table):]]
+        table = np.concatenate((table, np.array(new, dtype=int)))
+    _remember(_color_tables, key, table, _COLOR_TABLES)
+    return table
+
+def _color_losses(particles, colorcodes):
+    """Colour indices of particles, by their ids if they have any"""
+    ids = getattr(particles, 'ids', None)
+    if ids is not None:
+        labels, inverse = np.unique(ids, return_inverse=True)
+        table = np.array([_classify(label, colorcodes) for label in labels],
+                         dtype=int)
+        return table[inverse].reshape(ids.shape)
+    return np.take(_color_table(colorcodes), _loss_codes(particles))
+
+class ApertureGeometry:
+    """Aperture polygons of all elements of a line, built once.
+
+    vertices(infty, s0) returns the polygons of element.aperture() for
+    the whole line as one (npolygons, 4, 2) array of (s, x) corners,
+    the line starting at s0. The polygons are cached for the last
+    few infty used and rebuilt for elements whose parameters changed
+    or that were replaced since. Elements no longer in the line are
+    dropped from the cache.
+    """
+    # Number of infty values cached
+    ninfty = 4
+
+    def __init__(self, line):
+        self.line = line
+        self._elements = {}
+        self._vertices = {}
+
+    def _element(self, element, infty):
+        """Polygons of element starting at s = 0, cached"""
+        key = (id(element), infty)
+        cached = self._elements.get(key)
+        if cached is None or cached[0] is not element._cached():
+            polygons = np.array(element.aperture(infty, 0.0),
+                                dtype=float).reshape(-1, 4, 2)
+            cached = (element._cached(), polygons)
+            self._elements[key] = cached
+        return cached[1]
+
+    def vertices(self, infty=0.1, s0=0.0):
+        signature = [(element, element._cached()) for element in self.line]
+        cached = self._vertices.get(infty)
+        if cached is None or len(cached[0]) != len(signature) or any(
+                element is not old or cache is not oldcache
+                for (element, cache), (old, oldcache)
+                in zip(signature, cached[0])):
+            parts = []
+            s = 0.0
+            for element in self.line:
+                polygons = self._element(element, infty).copy()
+                polygons[..., 0] += s
+                parts.append(polygons)
+                s += element.len
+            vertices = np.concatenate(parts + [np.zeros((0, 4, 2))])
+            vertices.flags.writeable = False
+            cached = (signature, vertices)
+            _remember(self._vertices, infty, cached, self.ninfty)
+            current = {id(element) for element in self.line}
+            self._elements = {key: value for key, value
+                              in self._elements.items()
+                              if key[0] in current
+                              and key[1] in self._vertices}
+        vertices = cached[1]
+        if s0 != 0:
+            vertices = vertices + np.array([s0, 0.0])
+        return vertices
+
+    def collection(self, infty=0.1, s0=0.0, **kwargs):
+        """PolyCollection of the apertures, drawn like trajectoryplot"""
+        kwargs.setdefault('facecolor', (0, 0, 0, 0.65))
+        kwargs.setdefault('edgecolor', 'none')
+        return PolyCollection(self.vertices(infty, s0), closed=True,
+                              **kwargs)
+
+# Grids larger than this are downsampled by default
+_MAXPIXELS = 2000
+
+def _color_rows(trackgrid, colorcodes):
+    """Function of a row slice giving the colour indices of those rows.
+
+    Reads a ResultStore lazily, tiles not yet completed get colour 0.
+    """
+    if not isinstance(trackgrid, ResultStore):
+        table = _color_table(colorcodes)
+        codes = _loss_codes(trackgrid.particles)
+        return lambda rows: table[codes[rows]]
+    # Register the stored labels before the table classifies them
+    codes = trackgrid.table()
+    table = _color_table(colorcodes)[codes]
+    missing = [index for number, index in enumerate(
+        grid_tiles((trackgrid.nx, trackgrid.npx), trackgrid.tile))
+        if not trackgrid.done[number]]
+    def read(rows):
+        colors = table[trackgrid.lost[rows]]
+        for index in missing:
+            start = max(index[0].start, rows.start)
+            stop = min(index[0].stop, rows.stop)
+            if start < stop:
+                colors[start-rows.start:stop-rows.start, index[1]] = 0
+        return colors
+    return read
+
+def acceptance_raster(trackgrid, colorcodes, resolution=None):
+    """Colour indices of a TrackGrid or ResultStore, downsampled.
+
+    Returns an (nx, npx) array, or for a resolution (nx, npx) smaller
+    than the grid an array of at most that shape, each pixel holding
+    the colour most gridpoints of its block have. The grid is read in
+    blocks of rows, so a ResultStore is never loaded as a whole.
+    """
+    nx, npx = trackgrid.nx, trackgrid.npx
+    read = _color_rows(trackgrid, colorcodes)
+    if resolution is None:
+        resolution = (nx, npx)
+    fx = -(-nx // resolution[0])
+    fp = -(-npx // resolution[1])
+    if fx == 1 and fp == 1:
+        return read(slice(0, nx))
+    ncolors = len(colorcodes) + 1
+    nbx = -(-nx // fx)
+    nbp = -(-npx // fp)
+    raster = np.zeros((nbx, nbp), dtype=np.intp)
+    # Blocks of whole output rows, of about 4E6 gridpoints
+    step = fx * max(1, 4000000 // (fx*npx))
+    for start in range(0, nx, step):
+        rows = slice(start, min(start+step, nx))
+        colors = read(rows)
+        # Pad to whole blocks with a colour that never wins
+        padded = np.full((-(-colors.shape[0] // fx) * fx, nbp * fp),
+                         ncolors, dtype=np.intp)
+        padded[:colors.shape[0], :npx] = colors
+        blocks = padded.reshape(-1, fx, nbp, fp).transpose(0, 2, 1, 3)
+        blocks = blocks.reshape(blocks.shape[0], nbp, fx*fp)
+        counts = np.stack([(blocks == color).sum(axis=-1)
+                           for color in range(ncolors)], axis=-1)
+        raster[start//fx:start//fx+blocks.shape[0]] = counts.argmax(axis=-1)
+    return raster
+
+def acceptancepng(trackgrid, colorcodes, colormap, filename,
+                  resolution=None):
+    """Write the acceptance raster as an indexed-colour PNG.
+
+    One pixel per gridpoint, or per block of at most resolution
+    pixels (see acceptance_raster), x to the right and x' up, coloured
+    as acceptanceplot() does, with the alpha of colormap. Colour 0,
+    unclassified or not yet tracked, is transparent. No matplotlib
+    figure is made.
+    """
+    raster = acceptance_raster(trackgrid, colorcodes, resolution)
+    cols = len(colorcodes)
+    palette = [(0, 0, 0, 0)] + [
+        tuple(int(round(255*channel)) for channel in colormap(
+            (color-0.5) / cols)) for color in range(1, cols+1)]
+    palette = np.array(palette, dtype=np.uint8)
+    # Rows from x'max down, each prefixed by filter type 0
+    image = raster.T.astype(np.uint8)
+    data = np.zeros((image.shape[0], image.shape[1]+1), dtype=np.uint8)
+    data[:, 1:] = image
+
+    def chunk(kind, payload):
+        return (struct.pack('>I', len(payload)) + kind + payload
+                + struct.pack('>I', zlib.crc32(kind + payload)))
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', image.shape[1],
+                                           image.shape[0], 8, 3, 0, 0, 0)))
+        f.write(chunk(b'PLTE', palette[:, :3].tobytes()))
+        f.write(chunk(b'tRNS', palette[:, 3].tobytes()))
+        f.write(chunk(b'IDAT', zlib.compress(data.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+    return
+
+def draw_acceptance(fig, ax, trackgrid, colorcodes, colormap, beam=None,
+                    resolution=None):
+    """Draw the loss colours of a TrackGrid or ResultStore on ax.
+
+    Grids larger than resolution, by default 2000x2000, are shown
+    downsampled with the colour of the majority of each block, see
+    acceptance_raster(). The colorbar is added to fig.
+    """
+    if resolution is None:
+        resolution = (_MAXPIXELS, _MAXPIXELS)
+    colored_losses = acceptance_raster(trackgrid, colorcodes, resolution)
 
     xscale = 1E3
     xlabel = "$x$  [mm]"
@@ -42,7 +270,6 @@ def acceptanceplot(trackgrid, colorcodes, colormap, show=True,
     cols = len(colorcodes)
     colorlabels = [colorcode[0] for colorcode in colorcodes]
 
-    fig, ax = plt.subplots()
     cax = ax.imshow(colored_losses.transpose(), interpolation='none',
                     extent=[xmin, xmax, xpmin, xpmax],
                     aspect=(xmax-xmin)/(xpmax-xpmin), cmap=colormap,
@@ -55,8 +282,16 @@ def acceptanceplot(trackgrid, colorcodes, colormap, show=True,
         beam = [[point[0]*xscale, point[1]*xpscale] for point in beam]
         ax.add_patch(Polygon(beam, closed=True, fill=True, edgecolor='none',
                      facecolor=(0.5, 0.5, 0.5, 0.5)))
-    cbar = fig.colorbar(cax, ticks=[i+1 for i in range(cols)])
+    cbar = fig.colorbar(cax, ax=ax, ticks=[i+1 for i in range(cols)])
     cbar.ax.set_yticklabels(colorlabels)
+    return
+
+def acceptanceplot(trackgrid, colorcodes, colormap, show=True,
+                   filename=None, beam=None, aperture=None, resolution=None):
+    """Plot the loss colours of a TrackGrid or ResultStore with pyplot"""
+    fig, ax = plt.subplots()
+    draw_acceptance(fig, ax, trackgrid, colorcodes, colormap, beam,
+                    resolution)
     plt.tight_layout()
     if filename is not None:
         plt.savefig(filename)
@@ -64,36 +299,144 @@ def acceptanceplot(trackgrid, colorcodes, colormap, show=True,
         plt.show()
     return
 
-def trajectoryplot(tracks, colorcodes, colormap, aperture=None,
-                   show=True, filename=None, reducepoints=[1,1], linewidth=0.1):
-    colored_losses = _color_losses(tracks.particles, colorcodes)
+def _trajectories(particles, reducepoints, maxlines):
+    """Flat indices of the particles to draw.
 
-    xlabel = "$s$  [m]"
-    xplabel = "$x$  [m]"
+    Takes every reducepoints[k]-th particle along axis k, then at most
+    maxlines of those, evenly spread.
+    """
+    strides = list(reducepoints) + [1] * (len(particles.shape)
+                                          - len(reducepoints))
+    selected = np.zeros(particles.shape, dtype=bool)
+    selected[tuple(slice(None, None, stride)
+                   for stride in strides[:len(particles.shape)])] = True
+    index = np.flatnonzero(selected)
+    if maxlines is not None and len(index) > maxlines:
+        index = index[np.linspace(0, len(index)-1, maxlines).astype(int)]
+    return index
 
-    cols = len(colorcodes)
-    colorlabels = [colorcode[0] for colorcode in colorcodes]
+def draw_trajectories(ax, tracks, colorcodes, colormap, aperture=None,
+                      reducepoints=[1,1], linewidth=0.1, maxlines=None,
+                      rasterized=None):
+    """Draw the (s, x) histories of tracks on ax, coloured by loss.
 
-    fig, ax = plt.subplots()
+    All trajectories are drawn as one LineCollection. reducepoints
+    gives a stride per axis of tracks.particles, and maxlines limits
+    the number of trajectories drawn to an even sample of them.
+    rasterized, by default for more than 1000 trajectories, renders
+    them as an image in vector output.
+    """
+    particles = tracks.particles
+    if particles.history is None:
+        raise ValueError("Tracks hold no histories to plot")
+    colored_losses = _color_losses(particles, colorcodes).reshape(-1)
+
+    xlabel = "$s$  [m]"
+    xplabel = "$x$  [m]"
 
-    for index, particle in np.ndenumerate(tracks.particles):
-            if index[0]%reducepoints[0] == 0 and index[1]%reducepoints[1] == 0:
-                data_s = [coordinate[0] for coordinate in particle.history]
-                data_x = [coordinate[1] for coordinate in particle.history]
-                cax = ax.plot(data_s, data_x, linewidth=linewidth,
-                              color=colormap(colored_losses[index]-1))
+    index = _trajectories(particles, reducepoints, maxlines)
+    counts = particles.nhistory.reshape(-1)[index]
+    index, counts = index[counts > 0], counts[counts > 0]
+    history = particles.history.reshape(
+        (particles.size,) + particles.history.shape[-2:])
+    # One preallocated (lines, points, (s, x)) array, shorter
+    # histories padded with their last point
+    points = np.minimum(np.arange(history.shape[1]), counts[:, None]-1)
+    vertices = history[index[:, None], points, :2]
+    if rasterized is None:
+        rasterized = len(index) > 1000
+    ax.add_collection(LineCollection(
+        vertices, linewidths=linewidth, rasterized=rasterized,
+        colors=colormap(colored_losses[index]-1)))
+    ax.autoscale_view()
 
     ax.set_xlabel(xlabel)
     ax.set_ylabel(xplabel)
 
-    if aperture is not None:
-        for patch in aperture:
-            ax.add_patch(Polygon(patch, closed=True, fill=True, edgecolor='none',
-                         facecolor=(0, 0, 0, 0.65)))
-    #cbar = fig.colorbar(cax, ticks=[i+1 for i in range(cols)])
-    #cbar.ax.set_yticklabels(colorlabels)
+    if isinstance(aperture, ApertureGeometry):
+        ax.add_collection(aperture.collection())
+    elif aperture is not None:
+        ax.add_collection(PolyCollection(aperture, closed=True,
+                                         facecolor=(0, 0, 0, 0.65),
+                                         edgecolor='none'))
+    return
+
+def trajectoryplot(tracks, colorcodes, colormap, aperture=None,
+                   show=True, filename=None, reducepoints=[1,1], linewidth=0.1,
+                   maxlines=None, rasterized=None):
+    """Plot the (s, x) histories of tracks with pyplot"""
+    fig, ax = plt.subplots()
+    draw_trajectories(ax, tracks, colorcodes, colormap, aperture,
+                      reducepoints, linewidth, maxlines, rasterized)
     if filename is not None:
         plt.savefig(filename)
     if show is True:
         plt.show()
     return
+
+##################################################
+#                                                #
+#   Headless rendering                           #
+#                                                #
+##################################################
+
+def _figure(**kwargs):
+    """Figure on an Agg canvas, outside of pyplot"""
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def acceptancefigure(trackgrid, colorcodes, colormap, beam=None,
+                     resolution=None, **kwargs):
+    """Figure of acceptanceplot(), without pyplot.
+
+    kwargs go to Figure, e.g. figsize and dpi. Nothing refers to the
+    figure but the caller, so it is freed once dropped.
+    """
+    fig = _figure(**kwargs)
+    ax = fig.subplots()
+    draw_acceptance(fig, ax, trackgrid, colorcodes, colormap, beam,
+                    resolution)
+    fig.tight_layout()
+    return fig
+
+def trajectoryfigure(tracks, colorcodes, colormap, aperture=None,
+                     reducepoints=[1,1], linewidth=0.1, maxlines=None,
+                     rasterized=None, **kwargs):
+    """Figure of trajectoryplot(), without pyplot, see acceptancefigure"""
+    fig = _figure(**kwargs)
+    ax = fig.subplots()
+    draw_trajectories(ax, tracks, colorcodes, colormap, aperture,
+                      reducepoints, linewidth, maxlines, rasterized)
+    return fig
+
+_FIGURES = {'acceptance': acceptancefigure, 'trajectory': trajectoryfigure}
+
+def _render(job):
+    kind, filename, kwargs = job
+    fig = _FIGURES[kind](**kwargs)
+    try:
+        fig.savefig(filename)
+    finally:
+        fig.clear()
+    return filename
+
+def render_batch(jobs, workers=None, maxtasksperchild=20):
+    """Render plot jobs to files, in a pool of worker processes.
+
+    Every job is (kind, filename, kwargs), kind 'acceptance' or
+    'trajectory' and kwargs the arguments of acceptancefigure() or
+    trajectoryfigure(), e.g. with a ResultStore as trackgrid. Each
+    figure is cleared once saved, and workers are replaced after
+    maxtasksperchild jobs, so memory stays flat over long batches.
+    Without workers, renders in this process. Returns the filenames
+    in the order of jobs.
+    """
+    jobs = list(jobs)
+    for kind, _, _ in jobs:
+        if kind not in _FIGURES:
+            raise ValueError("Unknown plot kind: " + repr(kind))
+    if workers is None or workers <= 1:
+        return [_render(job) for job in jobs]
+    with _pool(workers, maxtasksperchild=maxtasksperchild) as pool:
+        return pool.map(_render, jobs, chunksize=1)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Profiling for MAD-X-like tracking in python.                   #
+#                                                                      #
+########################################################################
+
+from contextlib import contextmanager
+import numpy as np
+from .losses import losscodes
+
+__all__ = ['ElementProfile', 'LineProfile', 'instrument']
+
+# LineProfile collecting statistics, None when not instrumenting.
+# Tracking loops check it once per element.
+current = None
+
+##################################################
+#                                                #
+#   LineProfile                                  #
+#                                                #
+##################################################
+
+class ElementProfile:
+    """Particles and time spent in one element of a line"""
+    def __init__(self, element):
+        self.element = element
+        self.entering = 0
+        self.lost = {}
+        self.seconds = 0.0
+
+    @property
+    def surviving(self):
+        return self.entering - sum(self.lost.values())
+
+class LineProfile:
+    """Per-element statistics of the tracking done while instrumenting.
+
+    elements holds an ElementProfile per element tracked, in the order
+    they were first seen, so in line order for a single line.
+    """
+    def __init__(self):
+        self.elements = []
+        self._index = {}
+
+    def record(self, element, seconds, entering, codes=()):
+        """Add entering particles, losses with codes and time to element"""
+        if id(element) not in self._index:
+            self._index[id(element)] = len(self.elements)
+            self.elements.append(ElementProfile(element))
+        profile = self.elements[self._index[id(element)]]
+        profile.entering += entering
+        profile.seconds += seconds
+        if len(codes) > 0:
+            values, counts = np.unique(codes, return_counts=True)
+            for code, count in zip(values.tolist(), counts.tolist()):
+                label = losscodes.label(code)
+                profile.lost[label] = profile.lost.get(label, 0) + count
+
+    def report(self):
+        """List of dicts per element, with the s at its end"""
+        rows = []
+        s = 0.0
+        for profile in self.elements:
+            s += profile.element.len
+            rows.append({'name': profile.element.name,
+                         'type': type(profile.element).__name__,
+                         's': s,
+                         'entering': profile.entering,
+                         'lost': dict(profile.lost),
+                         'surviving': profile.surviving,
+                         'seconds': profile.seconds})
+        return rows
+
+@contextmanager
+def instrument():
+    """Collect a LineProfile of track(), TrackGrid and TrackList.
+
+    with instrument() as profile: ... tracks serially with NumPy or
+    track(), as the compiled, jit and parallel paths are not
+    instrumented.
+    """
+    global current
+    previous = current
+    current = LineProfile()
+    try:
+        yield current
+    finally:
+        current = previous
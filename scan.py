@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       Parameter scans for MAD-X-like tracking in python.             #
+#                                                                      #
+########################################################################
+
+import os
+import copy
+import json
+import base64
+import hashlib
+import numpy as np
+from .elements import _Element
+from .losses import losscodes, CIRCULATING
+from .store import line_fingerprint, _write_manifest, _packed
+
+__all__ = ['ParameterScan', 'grid_inits']
+
+##################################################
+#                                                #
+#   Settings                                     #
+#                                                #
+##################################################
+
+def _targets(line, parameters):
+    """Line indices and attributes set by each parameter"""
+    names = {element.name: index for index, element in enumerate(line)}
+    targets = {}
+    for parameter, (attributes, values) in parameters.items():
+        targets[parameter] = []
+        for target in attributes:
+            name, _, attribute = target.rpartition('.')
+            if name not in names:
+                raise ValueError("Element " + name + " of parameter "
+                                 + parameter + " not in line (elements "
+                                 "inside fused maps cannot be scanned)")
+            if not hasattr(line[names[name]], attribute):
+                raise ValueError("Element " + name + " has no parameter "
+                                 + attribute)
+            targets[parameter].append((names[name], attribute))
+    return targets
+
+def _configured(line, targets, setting):
+    """Copies of the scanned elements of line for one setting"""
+    elements = {}
+    for parameter, value in setting.items():
+        for index, attribute in targets[parameter]:
+            if index not in elements:
+                elements[index] = copy.copy(line[index])
+            # Drops the cache of the copy
+            setattr(elements[index], attribute, value)
+    return elements
+
+def _labels(element):
+    """Loss labels element and its delegates can produce"""
+    labels = [losscodes.label(code) for code in element.codes.values()]
+    for delegate in vars(element._cached()).values():
+        if isinstance(delegate, _Element):
+            labels += _labels(delegate)
+    return labels
+
+##################################################
+#                                                #
+#   ParameterScan                                #
+#                                                #
+##################################################
+
+class ParameterScan:
+    """Loss fractions of a set of particles for a grid of settings.
+
+    parameters maps a parameter name to (targets, values), with
+    targets a list of 'ELEMENT.attribute' strings all set to each of
+    values, e.g. {'zs_an': (['ZS1.an', 'ZS2.an'], np.linspace(...))}.
+    The settings are the outer product of the values of all
+    parameters, in the order of parameters.
+
+    All settings are tracked at once, as an extra axis of the particle
+    arrays: elements not scanned track the particles of all settings
+    in one batch, scanned elements are copied per setting and track
+    their part only. chunk settings are tracked at a time, by default
+    about 10^6 particles.
+
+    counts[setting..., label] holds the number of particles per loss
+    label, for the labels in labels. With cell, the area of initial
+    phase space per particle in m*rad (e.g. xres*xpres of a grid),
+    area() gives acceptance areas in mm*mrad.
+
+    With path, the loss codes of all particles (lost.npy, indices into
+    labels) and the counts are written to path as chunks complete, and
+    a scan of the same line, parameters and particles at path resumes
+    where it stopped, as scan_to_store() does.
+    """
+    def __init__(self, line, parameters, inits, cell=None, chunk=None,
+                 path=None):
+        inits = np.array(inits, dtype=float).reshape(-1, 2)
+        self.names = list(parameters)
+        self.values = [np.asarray(parameters[name][1], dtype=float)
+                       for name in self.names]
+        self.shape = tuple(len(values) for values in self.values)
+        self.cell = cell
+        n = len(inits)
+        nsettings = int(np.prod(self.shape))
+        if chunk is None:
+            chunk = max(1, 10**6 // max(n, 1))
+
+        targets = _targets(line, parameters)
+        settings = [dict(zip(self.names, [float(values[i]) for values, i
+                                          in zip(self.values, index)]))
+                    for index in np.ndindex(*self.shape)]
+        configured = [_configured(line, targets, setting)
+                      for setting in settings]
+        labels = ['CIRCULATING']
+        copies = [element for elements in configured
+                  for element in elements.values()]
+        for element in list(line) + copies:
+            labels += [label for label in _labels(element)
+                       if label not in labels]
+        self.labels = labels
+
+        chunks = [range(start, min(start+chunk, nsettings))
+                  for start in range(0, nsettings, chunk)]
+        done = np.zeros(len(chunks), dtype=bool)
+        if path is None:
+            counts = np.zeros((nsettings, len(labels)), dtype=np.int64)
+            lost = None
+        else:
+            counts, lost, done, manifest = self._open(
+                path, line, parameters, inits, chunk, labels, nsettings,
+                len(chunks))
+
+        # Loss codes of this session to indices into labels
+        table = np.zeros(len(losscodes), dtype=np.uint16)
+        for index, label in enumerate(labels):
+            table[losscodes.code(label)] = index
+        for number, indices in enumerate(chunks):
+            if done[number]:
+                continue
+            codes = self._track(line, configured, indices, inits)
+            local = table[codes]
+            for k, setting in enumerate(indices):
+                counts[setting] = np.bincount(local[k],
+                                              minlength=len(labels))
+            if path is not None:
+                lost[indices.start:indices.stop] = local
+                lost.flush()
+                counts.flush()
+                done[number] = True
+                manifest['done'] = _packed(done)
+                _write_manifest(path, manifest)
+
+        self.counts = np.array(counts).reshape(self.shape + (len(labels),))
+
+    def _open(self, path, line, parameters, inits, chunk, labels, nsettings,
+              nchunks):
+        """Arrays and manifest of the scan at path, created if new"""
+        manifest = {'fingerprint': line_fingerprint(line),
+                    'parameters': {name: [list(targets),
+                                          np.asarray(values).tolist()]
+                                   for name, (targets, values)
+                                   in parameters.items()},
+                    'inits': hashlib.sha256(inits.tobytes()).hexdigest(),
+                    'chunk': chunk, 'labels': labels, 'nchunks': nchunks}
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            with open(os.path.join(path, 'manifest.json')) as f:
+                stored = json.load(f)
+            done = np.unpackbits(np.frombuffer(
+                base64.b64decode(stored.pop('done')), dtype=np.uint8),
+                count=nchunks).astype(bool)
+            if stored != manifest:
+                raise ValueError("Scan " + path + " holds results of "
+                                 "another line, scan or set of particles")
+            counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r+')
+            lost = np.load(os.path.join(path, 'lost.npy'), mmap_mode='r+')
+        else:
+            os.makedirs(path, exist_ok=True)
+            done = np.zeros(nchunks, dtype=bool)
+            counts = np.lib.format.open_memmap(
+                os.path.join(path, 'counts.npy'), mode='w+', dtype=np.int64,
+                shape=(nsettings, len(labels)))
+            lost = np.lib.format.open_memmap(
+                os.path.join(path, 'lost.npy'), mode='w+', dtype=np.uint16,
+                shape=(nsettings, len(inits)))
+        manifest['done'] = _packed(done)
+        _write_manifest(path, manifest)
+        return counts, lost, done, manifest
+
+    @staticmethod
+    def _track(line, configured, indices, inits):
+        """Loss codes, shape (len(indices), n), of a chunk of settings"""
+        n = len(inits)
+        s = np.zeros(len(indices)*n)
+        x = np.tile(inits[:, 0], len(indices))
+        px = np.tile(inits[:, 1], len(indices))
+        lost = np.full(len(indices)*n, CIRCULATING,
+                       dtype=losscodes.dtype())
+        alive = np.ones(len(indices)*n, dtype=bool)
+        for index, element in enumerate(line):
+            if not any(index in configured[setting] for setting in indices):
+                element.track_batch(s, x, px, alive, lost)
+            else:
+                for k, setting in enumerate(indices):
+                    part = slice(k*n, (k+1)*n)
+                    configured[setting].get(index, element).track_batch(
+                        s[part], x[part], px[part], alive[part], lost[part])
+            if not alive.any():
+                break
+        return lost.reshape(len(indices), n)
+
+    def fraction(self, label='CIRCULATING'):
+        """Fraction of particles with loss label, per setting"""
+        counts = self.counts.sum(axis=-1)
+        if label not in self.labels:
+            return np.zeros(self.shape)
+        return self.counts[..., self.labels.index(label)] / counts
+
+    def fractions(self):
+        """Dict of fraction() of every label"""
+        return {label: self.fraction(label) for label in self.labels}
+
+    def area(self, label='CIRCULATING'):
+        """Area of initial phase space with loss label in mm*mrad"""
+        if self.cell is None:
+            raise ValueError("Areas need the phase space cell of the "
+                             "particles")
+        if label not in self.labels:
+            return np.zeros(self.shape)
+        return 1E6 * self.cell * self.counts[..., self.labels.index(label)]
+
+def grid_inits(xmin, xmax, xres, xpmin, xpmax, xpres):
+    """Initial conditions of a TrackGrid and their cell, for scans"""
+    nx = round((xmax-xmin)/xres)
+    npx = round((xpmax-xpmin)/xpres)
+    ix, ipx = np.indices((nx, npx))
+    inits = np.column_stack(((xmin+ix*xres).ravel(),
+                             (xpmax-ipx*xpres).ravel()))
+    return inits, xres*xpres
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#       On-disk result stores for MAD-X-like tracking in python.       #
+#                                                                      #
+########################################################################
+
+import os
+import json
+import base64
+import hashlib
+import numpy as np
+from .losses import losscodes
+from .tracking import stream_grid, _stream_tile, grid_tiles
+
+__all__ = ['line_fingerprint', 'ResultStore', 'scan_to_store']
+
+##################################################
+#                                                #
+#   Line fingerprints                            #
+#                                                #
+##################################################
+
+def _describe(value):
+    """JSON-able description of an element parameter"""
+    if isinstance(value, (list, tuple)):
+        return [_describe(item) for item in value]
+    if hasattr(value, '__dict__') and not isinstance(value, type):
+        return [type(value).__name__,
+                {key: _describe(item) for key, item in vars(value).items()
+                 if not key.startswith('_')}]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def line_fingerprint(line):
+    """Hash of the element types and parameters of line.
+
+    Equal for lines that track identically, different as soon as an
+    element or one of its parameters changes.
+    """
+    text = json.dumps(_describe(list(line)), sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+##################################################
+#                                                #
+#   ResultStore                                  #
+#                                                #
+##################################################
+
+_ARRAYS = {'lost': np.uint16, 's': float, 'x': float, 'px': float}
+
+class ResultStore:
+    """TrackGrid results in a directory, read lazily.
+
+    path holds lost.npy, s.npy, x.npy and px.npy, the loss codes and
+    final states of the (nx, npx) grid, and manifest.json with the grid
+    spec, the fingerprint of the line, the tile shape, the loss labels
+    the stored codes refer to, as labels and as (element, location)
+    pairs, and a bitmap of the tiles completed. Normally written by
+    scan_to_store().
+
+    Arrays are memory-mapped when first used, so a store can be
+    analysed region by region without loading it into memory.
+    particles gives the loss codes of the current session, loading the
+    whole grid. acceptanceplot() and acceptancepng() take the store
+    itself and read it in blocks of rows instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        for key, value in manifest['grid'].items():
+            setattr(self, key, value)
+        self.nx, self.npx = manifest['shape']
+        self.tile = tuple(manifest['tile'])
+        self.fingerprint = manifest['fingerprint']
+        self.labels = manifest['labels']
+        self.pairs = [tuple(pair) for pair in manifest['pairs']]
+        self.ntiles = manifest['ntiles']
+        self.done = np.unpackbits(
+            np.frombuffer(base64.b64decode(manifest['done']), dtype=np.uint8),
+            count=self.ntiles).astype(bool)
+        self._arrays = {}
+
+    def __getstate__(self):
+        # Reopen the maps after pickling, e.g. when sent to a worker
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _array(self, key):
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.path, key+'.npy'),
+                                        mmap_mode='r')
+        return self._arrays[key]
+
+    @property
+    def lost(self):
+        """Stored loss codes, indices into labels"""
+        return self._array('lost')
+
+    @property
+    def s(self):
+        return self._array('s')
+
+    @property
+    def x(self):
+        return self._array('x')
+
+    @property
+    def px(self):
+        return self._array('px')
+
+    @property
+    def complete(self):
+        return bool(self.done.all())
+
+    def table(self):
+        """Codes of losscodes of the stored codes, registering them"""
+        codes = _register(self.pairs)
+        return np.array(codes, dtype=losscodes.dtype())
+
+    def codes(self, index=Ellipsis):
+        """Loss codes of losscodes, for the gridpoints in index"""
+        return self.table()[self.lost[index]]
+
+    def losses(self, index=Ellipsis):
+        """Object array of loss labels, for the gridpoints in index"""
+        return np.array(self.labels, dtype=object)[self.lost[index]]
+
+    @property
+    def particles(self):
+        return self.codes()
+
+    def tiles(self):
+        """Yield (index, codes) for every completed tile"""
+        for number, index in enumerate(grid_tiles((self.nx, self.npx),
+                                                  self.tile)):
+            if self.done[number]:
+                yield index, self.codes(index)
+
+def _register(pairs):
+    # As the elements register them, so that labels are not split anew
+    return [losscodes.code(element, location or None)
+            for element, location in pairs]
+
+def _write_manifest(path, manifest):
+    # Replace atomically, a crash leaves the previous manifest
+    temp = os.path.join(path, 'manifest.json.tmp')
+    with open(temp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp, os.path.join(path, 'manifest.json'))
+
+def _packed(done):
+    return base64.b64encode(np.packbits(done).tobytes()).decode('ascii')
+
+def scan_to_store(path, line, xmin, xmax, xres, xpmin, xpmax, xpres,
+                  tile=None, workers=None, fuse=False, backend='numpy'):
+    """Track a TrackGrid scan into a ResultStore at path, resumably.
+
+    Tiles are tracked with stream_grid() and written to the store one
+    by one, each marked completed in the manifest only once its
+    arrays are flushed. If path already holds a store of the same line
+    and grid, only the tiles not yet completed are tracked, so an
+    interrupted scan continues where it stopped. A store of another
+    line or grid raises a ValueError. Returns the ResultStore.
+    """
+    grid = {'xmin': xmin, 'xmax': xmax, 'xres': xres,
+            'xpmin': xpmin, 'xpmax': xpmax, 'xpres': xpres}
+    shape = (round((xmax-xmin)/xres), round((xpmax-xpmin)/xpres))
+    fingerprint = line_fingerprint(line)
+
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        store = ResultStore(path)
+        if store.fingerprint != fingerprint:
+            raise ValueError("Store " + path + " holds results of "
+                             "another line")
+        if ({key: getattr(store, key) for key in grid} != grid
+                or (store.nx, store.npx) != shape):
+            raise ValueError("Store " + path + " holds another grid")
+        tile = store.tile
+        done = store.done.copy()
+        labels = list(store.labels)
+        pairs = [list(pair) for pair in store.pairs]
+        arrays = {key: np.load(os.path.join(path, key+'.npy'),
+                               mmap_mode='r+') for key in _ARRAYS}
+    else:
+        os.makedirs(path, exist_ok=True)
+        if tile is None:
+            tile = _stream_tile(shape[1])
+        tile = tuple(tile)
+        done = np.zeros(len(list(grid_tiles(shape, tile))), dtype=bool)
+        labels = ['CIRCULATING']
+        pairs = [['CIRCULATING', '']]
+        arrays = {key: np.lib.format.open_memmap(
+                      os.path.join(path, key+'.npy'), mode='w+',
+                      dtype=dtype, shape=shape)
+                  for key, dtype in _ARRAYS.items()}
+
+    manifest = {'grid': grid, 'shape': list(shape), 'tile': list(tile),
+                'fingerprint': fingerprint, 'labels': labels,
+                'pairs': pairs,
+                'ntiles': len(done), 'done': _packed(done)}
+    _write_manifest(path, manifest)
+
+    # Loss codes of this session to codes of the store
+    stored = {code: number for number, code in enumerate(_register(pairs))}
+    numbers = {(index[0].start, index[1].start): number for number, index
+               in enumerate(grid_tiles(shape, tile))}
+    skip = set(np.flatnonzero(done).tolist())
+    for index, bank in stream_grid(line, xmin, xmax, xres, xpmin, xpmax,
+                                   xpres, tile=tile, workers=workers,
+                                   fuse=fuse, skip=skip, backend=backend):
+        codes, inverse = np.unique(bank.lost, return_inverse=True)
+        for code in codes.tolist():
+            if code not in stored:
+                stored[code] = len(labels)
+                labels.append(losscodes.label(code))
+                pairs.append([losscodes.elements[code],
+                              losscodes.locations[code]])
+        if len(labels) > np.iinfo(np.uint16).max + 1:
+            raise ValueError("Too many loss labels for store " + path)
+        table = np.array([stored[code] for code in codes.tolist()])
+        arrays['lost'][index] = table[inverse].reshape(bank.shape)
+        arrays['s'][index] = bank.s
+        arrays['x'][index] = bank.x
+        arrays['px'][index] = bank.px
+        for array in arrays.values():
+            array.flush()
+        done[numbers[(index[0].start, index[1].start)]] = True
+        manifest['done'] = _packed(done)
+        _write_manifest(path, manifest)
+
+    del arrays
+    return ResultStore(path)
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+# The repository root is the linetracking package itself. Make it
+# importable under that name, also in spawned worker processes, whatever
+# the checkout directory is called.
+
+import os
+import sys
+import tempfile
+
+import matplotlib
+matplotlib.use('Agg')
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if os.path.basename(_ROOT) == 'linetracking':
+    sys.path.insert(0, os.path.dirname(_ROOT))
+else:
+    _parent = tempfile.mkdtemp(prefix='linetracking-')
+    os.symlink(_ROOT, os.path.join(_parent, 'linetracking'))
+    sys.path.insert(0, _parent)
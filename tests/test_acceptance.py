@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+WINDOW = (0.035, 0.085, -0.004, 0.002)
+N = 400
+
+def _grid():
+    xmin, xmax, xpmin, xpmax = WINDOW
+    return lt.TrackGrid(ex.line, xmin, xmax, (xmax-xmin)/N, xpmin, xpmax,
+                        (xpmax-xpmin)/N, history=None)
+
+def test_acceptance_areas_match_grid():
+    acceptance = lt.Acceptance(ex.line, *WINDOW)
+    grid = _grid()
+    xmin, xmax, xpmin, xpmax = WINDOW
+    cell = 1E6 * (xmax-xmin)/N * (xpmax-xpmin)/N
+    areas = acceptance.areas()
+    assert np.isclose(sum(areas.values()), 1E6 * (xmax-xmin)*(xpmax-xpmin))
+    losses = grid.particles.losses()
+    assert set(areas) >= set(np.unique(losses))
+    for label, area in areas.items():
+        # Regions are exact, the grid counts whole cells along edges
+        assert abs(area - cell*(losses == label).sum()) <= 0.01*area + 0.05
+
+def test_acceptance_codes_match_grid():
+    acceptance = lt.Acceptance(ex.line, *WINDOW)
+    grid = _grid()
+    start = grid.particles.start
+    codes = acceptance.codes(start[..., 1], start[..., 2])
+    # Only gridpoints on a region boundary may differ
+    assert (codes != grid.particles.lost).mean() < 1E-3
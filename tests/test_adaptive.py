@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.05/110, -0.004, 0.002, 0.006/80)
+FINE = (0.035, 0.085, 0.05/400, -0.004, 0.002, 0.006/400)
+
+def test_adaptive_matches_full_grid():
+    full = lt.TrackGrid(ex.line, *GRID, history=None)
+    for colorcodes in (None, ex.colorcodes()):
+        for levels in (3, 4):
+            grid = lt.AdaptiveGrid(ex.line, *GRID, levels=levels,
+                                   colorcodes=colorcodes)
+            assert grid.particles.shape == full.particles.shape
+            assert np.array_equal(grid.particles, full.particles.lost)
+            assert grid.ntracked < full.particles.size
+
+def test_adaptive_fine_grid_tracks_boundaries_only():
+    full = lt.TrackGrid(ex.line, *FINE, history=None)
+    grid = lt.AdaptiveGrid(ex.line, *FINE)
+    coarse = lt.AdaptiveGrid(ex.line, *FINE, edges=False)
+    assert np.array_equal(grid.particles, full.particles.lost)
+    assert np.array_equal(coarse.particles, full.particles.lost)
+    # Following the boundaries beats splitting down to gridpoints
+    assert grid.ntracked < coarse.ntracked
+    assert grid.ntracked < full.particles.size / 4
+
+def test_adaptive_lossmap_needs_final_states():
+    grid = lt.AdaptiveGrid(ex.line, *GRID)
+    with pytest.raises(ValueError):
+        lt.lossmap(grid)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+# One line per element type, between apertured drifts so that
+# particles arrive at every element with a spread of positions
+ELEMENTS = {
+    'drift': lambda: lt.Drift('D', 2.0, 0.05, offset_up=0.01,
+                              offset_down=-0.005),
+    'kicker': lambda: lt.Kicker('K', 1.5, 3E-4, 0.06),
+    'quadrupole': lambda: lt.Quadrupole('Q', 3.0, 0.015, 0.055,
+                                        offset_field=0.002,
+                                        offset_aperture_up=0.001,
+                                        offset_aperture_down=-0.001),
+    'doubleapdrift': lambda: lt.DoubleApDrift('C', 2.0, 0.04, 0.045,
+                                              0.004, 0.02, 0.04),
+    'doubleapdrift_thin': lambda: lt.DoubleApDrift('C', 2.0, 0.04, 0.045,
+                                                   0.0, 0.04, 0.04),
+    'septum': lambda: lt.Septum('S', 3.13, 2E-3, 0.03, 0.026, 2E-4,
+                                0.0, 0.02),
+    'septum_circulating': lambda: lt.Septum('S', 3.13, 2E-3, 0.03, 0.026,
+                                            2E-4, 0.05, 0.02),
+    'septum_virtual': lambda: lt.Septum('S', 3.13, 2E-3, 0.03, 0.026, 0.0,
+                                        0.05, 0.02),
+    'septum_virtual_open': lambda: lt.Septum('S', 3.13, 2E-3, 0.03, 0.026,
+                                             0.0, 0.0, 0.0),
+    'septum_drift': lambda: lt.Septum('S', 3.13, 0.0, 0.03, 0.026, 2E-4,
+                                      0.0, 0.02),
+    'quadhole': lambda: lt.QuadHole('H', 3.0, -0.012, 0.0019, 0.04,
+                                    0.02, 0.07, 0.065, 0.06),
+}
+
+GRID = (-0.1, 0.1, 0.004, -0.004, 0.004, 0.0002)
+
+def _line(name):
+    return [lt.Drift('UP', 1.0, 0.1), ELEMENTS[name](),
+            lt.Drift('DOWN', 1.0, 0.1)]
+
+def _assert_same(batch, scalar):
+    a, b = batch.particles, scalar.particles
+    assert np.array_equal(a.lost, b.lost)
+    assert np.allclose(a.s, b.s, rtol=0, atol=1E-12)
+    assert np.allclose(a.x, b.x, rtol=0, atol=1E-12)
+    assert np.allclose(a.px, b.px, rtol=0, atol=1E-12)
+    if b.history is not None:
+        assert np.array_equal(a.nhistory, b.nhistory)
+        for index in np.ndindex(a.shape):
+            count = b.nhistory[index]
+            assert np.allclose(a.history[index][:count],
+                               b.history[index][:count],
+                               rtol=0, atol=1E-12)
+
+@pytest.mark.parametrize('history', [1, None])
+@pytest.mark.parametrize('name', sorted(ELEMENTS))
+def test_batch_matches_scalar(name, history):
+    line = _line(name)
+    batch = lt.TrackGrid(line, *GRID, history=history)
+    scalar = lt.TrackGrid(line, *GRID, batch=False, history=history)
+    assert (batch.particles.lost != lt.CIRCULATING).any()
+    if history is not None and name.startswith('septum_virtual'):
+        # Virtual blade crossings are recorded as extra points
+        assert batch.particles.nhistory.max() == 5
+    _assert_same(batch, scalar)
+
+@pytest.mark.parametrize('history', [1, None])
+def test_batch_matches_scalar_lss2(history):
+    grid = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+    batch = lt.TrackGrid(ex.line, *grid, history=history)
+    scalar = lt.TrackGrid(ex.line, *grid, batch=False, history=history)
+    _assert_same(batch, scalar)
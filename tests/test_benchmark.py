@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+import linetracking as lt
+from linetracking import benchmark
+
+def test_synthetic_lines_reuse_loss_labels():
+    for kind in benchmark._SYNTHETIC:
+        benchmark.synthetic_line(kind, 20)
+    before = len(lt.losscodes)
+    for kind in benchmark._SYNTHETIC:
+        line = benchmark.synthetic_line(kind, 1000)
+        assert len(line) == 1000
+    assert len(lt.losscodes) == before
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+
+# Virtual blade crossings and drifts fused around a quadrupole, so that
+# substeps and boundaries inside fused elements are recorded as well
+LINE = [lt.Drift('UP', 1.0, 0.1), lt.Drift('UP2', 0.5, 0.1),
+        lt.Quadrupole('Q', 3.0, 0.015, 0.055),
+        lt.Septum('S', 3.13, 2E-3, 0.03, 0.026, 0.0, 0.05, 0.02),
+        lt.Drift('DOWN', 1.0, 0.1)]
+LINE_GRID = (-0.1, 0.1, 0.004, -0.004, 0.004, 0.0002)
+
+PATHS = {
+    'batch': {},
+    'fused': {'fuse': True},
+    'jit': {'backend': 'jit'},
+}
+
+def _histories(particles):
+    return [particles.history[index][:particles.nhistory[index]]
+            for index in np.ndindex(particles.shape)]
+
+@pytest.mark.parametrize('path', sorted(PATHS))
+@pytest.mark.parametrize('history', [None, 'final', 'loss', 1, 2, 3])
+@pytest.mark.parametrize('line, grid', [(ex.line, GRID),
+                                        (LINE, LINE_GRID)])
+def test_history_policy_matches_scalar(line, grid, history, path):
+    scalar = lt.TrackGrid(line, *grid, batch=False, history=history)
+    other = lt.TrackGrid(line, *grid, history=history, **PATHS[path])
+    a, b = other.particles, scalar.particles
+    assert np.array_equal(a.lost, b.lost)
+    assert np.allclose(a.s, b.s, rtol=0, atol=1E-12)
+    assert np.allclose(a.x, b.x, rtol=0, atol=1E-12)
+    assert np.allclose(a.px, b.px, rtol=0, atol=1E-12)
+    if history is None:
+        assert a.history is None and b.history is None
+        return
+    assert np.array_equal(a.nhistory, b.nhistory)
+    for mine, theirs in zip(_histories(a), _histories(b)):
+        assert np.allclose(mine, theirs, rtol=0, atol=1E-12)
+    lost = b.lost != lt.CIRCULATING
+    if history == 'final':
+        assert (b.nhistory == 1).all()
+    elif history == 'loss':
+        # The start, and the loss point of lost particles only
+        assert np.array_equal(b.nhistory, 1 + lost)
+    if history != 'final':
+        assert np.array_equal(b.history[..., 0, :], b.start)
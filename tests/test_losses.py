@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import subprocess
+import numpy as np
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+
+# Loss map of a store in a process whose losscodes start out empty
+SCRIPT = '''
+import sys
+import numpy as np
+import linetracking as lt
+store = lt.ResultStore(sys.argv[1])
+losses = lt.lossmap(store, bins=50, smax=100.0)
+from linetracking.examples import sps_lss2_se as ex
+full = lt.TrackGrid(ex.line, *GRID, history=None)
+reference = lt.lossmap(full, bins=50, smax=100.0)
+assert losses.elements == reference.elements[:len(losses.elements)]
+assert np.array_equal(losses.counts,
+                      reference.counts[:len(losses.elements)])
+assert losses.counts.sum() == (full.particles.lost != lt.CIRCULATING).sum()
+# Stored labels split into elements and aperture sides as tracked
+assert 'ZS1' in losses.elements and 'ZS1_down_extr' not in losses.elements
+'''
+
+def test_lossmap_of_store_matches_trackgrid(tmp_path):
+    store = lt.scan_to_store(str(tmp_path), ex.line, *GRID, tile=(16, 16))
+    full = lt.TrackGrid(ex.line, *GRID, history=None)
+    losses = lt.lossmap(store, bins=50, smax=100.0)
+    reference = lt.lossmap(full, bins=50, smax=100.0)
+    assert losses.elements == reference.elements
+    assert np.array_equal(losses.counts, reference.counts)
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    script = SCRIPT.replace('*GRID', repr(GRID)[1:-1])
+    subprocess.run([sys.executable, '-c', script, str(tmp_path)], env=env,
+                   check=True, timeout=300)
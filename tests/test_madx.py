@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pytest
+import linetracking as lt
+
+TABLE = '''@ NAME             %05s "TWISS"
+* NAME KEYWORD S L K1L ANGLE HKICK APER_1
+$ %s %s %le %le %le %le %le %le
+ "#S" "MARKER" 0 0 0 0 0 0
+ "MBA" "SBEND" 6.26 6.26 0 0.008445 0 0.04
+ "QF" "QUADRUPOLE" 9.46 3.2 0.0448 0 0 0.045
+ "MKE" "KICKER" 13.0 3.0 0 0 0.0005 0.03
+ "ZS" "MARKER" 13.0 0 0 0 0 0
+'''
+
+def _table(tmp_path, table=TABLE):
+    filename = tmp_path / 'line.tfs'
+    filename.write_text(table)
+    return str(filename)
+
+def test_bends_follow_the_reference_orbit(tmp_path):
+    line = lt.import_tfs(_table(tmp_path), cache=False)
+    assert [type(element).__name__ for element in line] == [
+        'Drift', 'Quadrupole', 'Drift', 'Kicker']
+    assert line[0].name == 'MBA' and line[0].r == 0.04
+    assert line[1].k == pytest.approx(0.014)
+    assert line[2].len == pytest.approx(0.54)
+    assert line[3].an == 0.0005
+
+def test_thin_kicker_needs_a_length(tmp_path):
+    table = TABLE.replace('"MKE" "KICKER" 13.0 3.0', '"MKE" "KICKER" 9.46 0')
+    with pytest.raises(ValueError):
+        lt.import_tfs(_table(tmp_path, table), cache=False)
+
+def test_cache_checks_its_entries(tmp_path, monkeypatch):
+    overrides = {'ZS': ('Septum', {
+        'bendingangle': np.float64(8E-5), 'bladepos_upstream': 0.068,
+        'bladepos_downstream': 0.068, 'blade_thickness': 0.0002,
+        'd_circulating': 0.05, 'd_extraction': 0.02})}
+    table = TABLE.replace('"ZS" "MARKER" 13.0 0', '"ZS" "MARKER" 14.0 1.0')
+    filename = _table(tmp_path, table)
+    cache = tmp_path / 'cache'
+    first = lt.import_tfs(filename, overrides, cache=str(cache))
+    # Only the content counts, e.g. not a fresh checkout's times
+    os.utime(filename, (0, 0))
+    with monkeypatch.context() as patch:
+        # Served from the cache, without building the line
+        patch.setattr(lt.madx, 'line_from_tfs', None)
+        second = lt.import_tfs(filename, overrides, cache=str(cache))
+    assert [element.name for element in second] == [
+        element.name for element in first]
+    assert isinstance(second[-1], lt.Septum)
+    # A pickle not matching its entry is rebuilt, never loaded
+    pickled, = cache.glob('*.pkl')
+    pickled.write_bytes(b'not a pickle')
+    third = lt.import_tfs(filename, overrides, cache=str(cache))
+    assert [element.name for element in third] == [
+        element.name for element in first]
+
+def test_unwritable_cache_still_imports(tmp_path):
+    filename = _table(tmp_path)
+    # A file where the cache directory should be
+    blocked = tmp_path / 'blocked'
+    blocked.write_text('')
+    line = lt.import_tfs(filename, cache=str(blocked))
+    assert [element.name for element in line] == [
+        element.name for element in lt.import_tfs(filename, cache=False)]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+N = 1000
+
+def _dense(box, beam=None):
+    """Loss fractions of the gridpoints of a dense TrackGrid over box"""
+    (xmin, xmax), (pxmin, pxmax) = box
+    grid = lt.TrackGrid(ex.line, xmin, xmax, (xmax-xmin)/N, pxmin, pxmax,
+                        (pxmax-pxmin)/N, history=None)
+    losses = grid.particles.losses()
+    if beam is not None:
+        start = grid.particles.start
+        losses = losses[lt.inside_polygon(start[..., 1], start[..., 2],
+                                          beam)]
+    labels, counts = np.unique(losses, return_counts=True)
+    return dict(zip(labels.tolist(), (counts / counts.sum()).tolist()))
+
+def _assert_agrees(estimate, reference):
+    assert set(estimate.fractions) == set(reference)
+    for label, fraction in reference.items():
+        # Within the confidence interval, widened by the gridpoints of
+        # the reference along the edges of the loss regions
+        assert (abs(estimate.fractions[label] - fraction)
+                <= 2*estimate.errors[label] + 2/N)
+
+def test_beam_estimate_matches_dense_grid():
+    beam = np.asarray(ex.beam)
+    box = tuple(zip(beam.min(axis=0), beam.max(axis=0)))
+    estimate = lt.estimate_losses(ex.line, beam, precision=1E-3, seed=0)
+    assert max(estimate.errors.values()) <= 1E-3
+    assert np.isclose(sum(estimate.fractions.values()), 1)
+    _assert_agrees(estimate, _dense(box, beam))
+
+def test_density_estimate_matches_dense_grid():
+    box = ((0.05, 0.08), (-0.002, 0.0))
+    estimate = lt.estimate_losses(ex.line, density=lambda x, px: 1.0 + 0*x,
+                                  box=box, precision=2E-3, seed=0)
+    _assert_agrees(estimate, _dense(box))
+    with pytest.raises(ValueError):
+        lt.estimate_losses(ex.line)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+import linetracking as lt
+
+SCRIPT = '''
+import numpy as np
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+grid = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+compiled = lt.TrackGrid(ex.line, *grid, backend='jit')
+pooled = lt.TrackGrid(ex.line, *grid, workers=2)
+assert np.array_equal(compiled.particles.lost, pooled.particles.lost)
+streamed = list(lt.stream_grid(ex.line, *grid, workers=2))
+assert len(streamed) > 0
+'''
+
+@pytest.mark.skipif(not lt.jit.available(), reason="needs Numba")
+def test_workers_after_jit_exit_cleanly():
+    # Forked pools hung at interpreter exit once parallel kernels ran
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, '-c', SCRIPT], env=env, check=True,
+                   timeout=300)
+
+def test_track_parallel_writes_into_the_bank():
+    from linetracking.examples import sps_lss2_se as ex
+    grid = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+    serial = lt.TrackGrid(ex.line, *grid)
+    pooled = lt.TrackGrid(ex.line, *grid, workers=2, tile=(7, 13))
+    for key in ('s', 'x', 'px', 'lost', 'nhistory'):
+        assert np.array_equal(getattr(pooled.particles, key),
+                              getattr(serial.particles, key))
+    for index in np.ndindex(serial.particles.shape):
+        count = serial.particles.nhistory[index]
+        assert np.array_equal(pooled.particles.history[index][:count],
+                              serial.particles.history[index][:count])
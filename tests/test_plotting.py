@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import copy
+import subprocess
+import numpy as np
+import matplotlib.pyplot as plt
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+
+# Plots a store in a process whose losscodes start out empty
+SCRIPT = '''
+import sys
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import linetracking as lt
+store = lt.ResultStore(sys.argv[1])
+colorcodes = [['free aperture', ['CIRCULATING'], [], []],
+              ['ZS blade', ['ZS', 'blade'], [], []],
+              ['ZS cathode', ['ZS', 'extr'], ['blade'], []],
+              ['Other', [], [], []]]
+raster = lt.acceptance_raster(store, colorcodes)
+lt.acceptanceplot(store, colorcodes, 'viridis', show=False,
+                  filename=sys.argv[2])
+from linetracking.examples import sps_lss2_se as ex
+full = lt.TrackGrid(ex.line, *store_grid, history=None)
+assert np.array_equal(raster, lt.acceptance_raster(full, colorcodes))
+assert set(np.unique(raster).tolist()) == {1, 2, 3, 4}
+'''
+
+def test_acceptanceplot_adaptive_grid(tmp_path):
+    grid = lt.AdaptiveGrid(ex.line, *GRID)
+    full = lt.TrackGrid(ex.line, *GRID, history=None)
+    assert np.array_equal(lt.acceptance_raster(grid, ex.colorcodes()),
+                          lt.acceptance_raster(full, ex.colorcodes()))
+    filename = tmp_path / 'adaptive.png'
+    lt.acceptanceplot(grid, ex.colorcodes(), ex.colormap(), show=False,
+                      filename=str(filename))
+    plt.close('all')
+    assert filename.stat().st_size > 0
+
+def test_acceptanceplot_store_in_fresh_process(tmp_path):
+    lt.scan_to_store(str(tmp_path / 'store'), ex.line, *GRID, tile=(16, 16))
+    filename = tmp_path / 'store.png'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    script = SCRIPT.replace('*store_grid', repr(GRID)[1:-1])
+    subprocess.run([sys.executable, '-c', script, str(tmp_path / 'store'),
+                    str(filename)], env=env, check=True, timeout=300)
+    assert filename.stat().st_size > 0
+
+def test_aperture_geometry_cache_is_bounded():
+    line = list(ex.line)
+    geometry = lt.ApertureGeometry(line)
+    reference = geometry.vertices().copy()
+    for number in range(20):
+        line[3] = lt.Drift('D' + str(number), line[3].len, line[3].r)
+        geometry.vertices(0.1 + 0.01*number)
+    assert len(geometry._vertices) == geometry.ninfty
+    assert len(geometry._elements) <= geometry.ninfty * len(line)
+    line[3] = ex.line[3]
+    assert np.array_equal(geometry.vertices(), reference)
+
+def _apertures(line, infty, s0):
+    """Polygons of every element, built directly without a cache"""
+    polygons = []
+    s = s0
+    for element in line:
+        polygons += element.aperture(infty, s)
+        s += element.len
+    return np.array(polygons, dtype=float).reshape(-1, 4, 2)
+
+def test_aperture_geometry_matches_elements():
+    line = copy.deepcopy(ex.line)
+    geometry = lt.ApertureGeometry(line)
+    names = [element.name for element in line]
+    tce = names.index('TCE')
+
+    def check():
+        for infty, s0 in ((0.1, 0.0), (0.05, 12.5), (0.1, -3.0)):
+            assert np.allclose(geometry.vertices(infty, s0),
+                               _apertures(line, infty, s0),
+                               rtol=0, atol=1E-12)
+
+    check()
+    line[names.index('ZS3')].bladepos_up += 1E-3
+    check()
+    line[tce] = lt.Drift('TCE', line[tce].len + 0.5, 0.05)
+    check()
+    del line[tce]
+    check()
+    line.append(lt.Quadrupole('QEND', 2.0, 0.01, 0.04))
+    check()
+
+def test_color_losses_by_id():
+    bank = lt.ParticleBank(np.zeros((3, 2)), np.zeros((3, 2)))
+    bank.set_ids(['0', '1', '2', '3', '1', '0'])
+    colors = lt.plotting._color_losses(bank, ex.beamcolorcodes())
+    assert colors.tolist() == [[1, 2], [3, 4], [2, 1]]
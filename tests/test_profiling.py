@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+
+@pytest.mark.parametrize('options', [{}, {'batch': False},
+                                     {'backend': 'jit', 'workers': 2}])
+def test_profile_totals_match_grid(options):
+    reference = lt.TrackGrid(ex.line, *GRID, history=None)
+    start = time.perf_counter()
+    with lt.instrument() as profile:
+        grid = lt.TrackGrid(ex.line, *GRID, history=None, **options)
+    seconds = time.perf_counter() - start
+    assert np.array_equal(grid.particles.lost, reference.particles.lost)
+
+    rows = profile.report()
+    assert [row['name'] for row in rows] == [
+        element.name for element in ex.line][:len(rows)]
+    assert rows[0]['entering'] == reference.particles.size
+    for row, following in zip(rows, rows[1:]):
+        assert following['entering'] == row['surviving']
+    assert np.isclose(rows[-1]['s'], sum(element.len for element
+                                         in ex.line[:len(rows)]))
+
+    # Every loss is counted once, at its element
+    losses = reference.particles.losses()
+    lost = {}
+    for row in rows:
+        assert set(row['lost']).isdisjoint(lost)
+        lost.update(row['lost'])
+    labels, counts = np.unique(losses[losses != 'CIRCULATING'],
+                               return_counts=True)
+    assert lost == dict(zip(labels.tolist(), counts.tolist()))
+    assert rows[-1]['surviving'] == (losses == 'CIRCULATING').sum()
+    assert 0 < sum(row['seconds'] for row in rows) <= seconds
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.002, -0.004, 0.002, 0.0002)
+PARAMETERS = {'an': (['ZS1.an', 'ZS2.an'], [6E-5, 8.327E-5, 1E-4]),
+              'tce': (['TCE.r'], [0.05, 0.0645])}
+
+def _reference(settings):
+    """Loss codes of a separate TrackGrid per setting"""
+    codes = []
+    for setting in settings:
+        line = list(ex.line)
+        for name, value in zip(PARAMETERS, setting):
+            for target in PARAMETERS[name][0]:
+                element, _, attribute = target.rpartition('.')
+                index = [e.name for e in line].index(element)
+                line[index] = copy.copy(line[index])
+                setattr(line[index], attribute, value)
+        codes.append(lt.TrackGrid(line, *GRID, history=None).particles.lost)
+    return codes
+
+def _assert_counts(scan):
+    settings = [[PARAMETERS[name][1][i] for name, i in zip(PARAMETERS,
+                                                            index)]
+                for index in np.ndindex(*scan.shape)]
+    for index, codes in zip(np.ndindex(*scan.shape), _reference(settings)):
+        labels = lt.losscodes.decode(codes.reshape(-1))
+        expected = [(labels == label).sum() for label in scan.labels]
+        assert scan.counts[index].tolist() == expected
+
+def test_scan_matches_separate_grids():
+    inits, cell = lt.grid_inits(*GRID)
+    scan = lt.ParameterScan(ex.line, PARAMETERS, inits, cell=cell, chunk=4)
+    assert scan.shape == (3, 2)
+    _assert_counts(scan)
+    fractions = scan.fractions()
+    assert np.allclose(sum(fractions.values()), 1)
+    assert np.allclose(sum(scan.area(label) for label in scan.labels),
+                       1E6 * cell * len(inits))
+
+def test_scan_resumes_after_interruption(tmp_path, monkeypatch):
+    inits, cell = lt.grid_inits(*GRID)
+    track = lt.ParameterScan._track
+    calls = []
+
+    def interrupted(*args):
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        calls.append(args[2])
+        return track(*args)
+
+    monkeypatch.setattr(lt.ParameterScan, '_track',
+                        staticmethod(interrupted))
+    with pytest.raises(KeyboardInterrupt):
+        lt.ParameterScan(ex.line, PARAMETERS, inits, chunk=2,
+                         path=str(tmp_path))
+    resumed = []
+
+    def counted(*args):
+        resumed.append(args[2])
+        return track(*args)
+
+    monkeypatch.setattr(lt.ParameterScan, '_track', staticmethod(counted))
+    scan = lt.ParameterScan(ex.line, PARAMETERS, inits, chunk=2,
+                            path=str(tmp_path))
+    # Only the chunk of settings 4 and 5 was left
+    assert resumed == [range(4, 6)]
+    _assert_counts(scan)
+    with pytest.raises(ValueError):
+        lt.ParameterScan(ex.line, PARAMETERS, inits[:-1], chunk=2,
+                         path=str(tmp_path))
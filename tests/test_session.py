@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+
+def _assert_tracked(session, inits):
+    bank = lt.ParticleBank(inits[..., 0], inits[..., 1])
+    lt.track_bank(bank, session.line, history=None)
+    for key in ('lost', 's', 'x', 'px'):
+        assert np.array_equal(getattr(session.particles, key),
+                              getattr(bank, key))
+
+@pytest.mark.parametrize('memory', [256E6, 1E5])
+def test_session_matches_track_bank(memory):
+    line = copy.deepcopy(ex.line)
+    inits = lt.TrackGrid(line, *GRID, history=None).particles.start[..., 1:]
+    session = lt.TrackSession(line, inits, memory=memory)
+    _assert_tracked(session, inits)
+    names = [element.name for element in line]
+    zs3 = line[names.index('ZS3')]
+    tce = names.index('TCE')
+
+    # Downstream changes retrack only part of the line
+    original = zs3.an
+    zs3.an = 1.2 * original
+    assert session.changed() == [names.index('ZS3')]
+    session.update()
+    _assert_tracked(session, inits)
+    assert session.retracked < len(line)
+
+    zs3.an = original
+    session.update()
+    _assert_tracked(session, inits)
+
+    # Replaced elements and changes at the start of the line
+    line[tce] = lt.Drift('TCE', line[tce].len, 0.05)
+    session.update()
+    _assert_tracked(session, inits)
+    line[0].bladepos_up += 2E-4
+    session.update()
+    assert session.retracked == len(line)
+    _assert_tracked(session, inits)
+
+    assert session.update() is session.particles
+    assert session.retracked == 0
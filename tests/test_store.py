@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+import pytest
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+GRID = (0.035, 0.085, 0.001, -0.004, 0.002, 0.0001)
+TILE = (16, 16)
+
+SCRIPT = '''
+import sys
+import numpy as np
+import linetracking as lt
+if len(sys.argv) > 1:
+    store = lt.ResultStore(sys.argv[1])
+    codes = store.codes()
+    assert np.array_equal(lt.losscodes.decode(codes), store.losses())
+from linetracking.examples import sps_lss2_se as ex
+if len(sys.argv) > 1:
+    reference = lt.TrackGrid(ex.line, *GRID, history=None)
+    assert np.array_equal(codes, reference.particles.lost)
+print(sorted(zip(lt.losscodes.elements, lt.losscodes.locations)))
+'''
+
+def _reference():
+    return lt.TrackGrid(ex.line, *GRID, history=None)
+
+def test_store_matches_trackgrid(tmp_path):
+    store = lt.scan_to_store(str(tmp_path), ex.line, *GRID, tile=TILE)
+    full = _reference()
+    assert store.complete
+    assert np.array_equal(store.codes(), full.particles.lost)
+    assert np.array_equal(store.particles, full.particles.lost)
+    assert np.array_equal(store.losses(), full.particles.losses())
+    for key in ('s', 'x', 'px'):
+        assert np.array_equal(getattr(store, key),
+                              getattr(full.particles, key))
+    ntiles = 0
+    for index, codes in store.tiles():
+        assert np.array_equal(codes, full.particles.lost[index])
+        ntiles += 1
+    assert ntiles == store.ntiles
+
+def test_store_resumes_after_interruption(tmp_path, monkeypatch):
+    stream_grid = lt.store.stream_grid
+    skipped = []
+
+    def interrupted(*args, **kwargs):
+        for number, item in enumerate(stream_grid(*args, **kwargs)):
+            if number == 3:
+                raise KeyboardInterrupt
+            yield item
+
+    def resumed(*args, **kwargs):
+        skipped.append(set(kwargs['skip']))
+        return stream_grid(*args, **kwargs)
+
+    monkeypatch.setattr(lt.store, 'stream_grid', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        lt.scan_to_store(str(tmp_path), ex.line, *GRID, tile=TILE)
+    partial = lt.ResultStore(str(tmp_path))
+    assert partial.done.sum() == 3 and not partial.complete
+
+    monkeypatch.setattr(lt.store, 'stream_grid', resumed)
+    store = lt.scan_to_store(str(tmp_path), ex.line, *GRID)
+    assert skipped == [{0, 1, 2}]
+    assert store.tile == TILE and store.complete
+    assert np.array_equal(store.codes(), _reference().particles.lost)
+
+def test_store_refuses_other_line_or_grid(tmp_path):
+    lt.scan_to_store(str(tmp_path), ex.line, *GRID, tile=TILE)
+    other = list(ex.line) + [lt.Drift('END', 1.0, 0.1)]
+    with pytest.raises(ValueError, match="another line"):
+        lt.scan_to_store(str(tmp_path), other, *GRID)
+    with pytest.raises(ValueError, match="another grid"):
+        lt.scan_to_store(str(tmp_path), ex.line, *GRID[:2], 0.002,
+                         *GRID[3:])
+
+def test_store_in_fresh_process(tmp_path):
+    lt.scan_to_store(str(tmp_path), ex.line, *GRID, tile=TILE)
+    with open(os.path.join(str(tmp_path), 'manifest.json')) as f:
+        manifest = json.load(f)
+    assert len(manifest['pairs']) == len(manifest['labels'])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    script = SCRIPT.replace('*GRID', repr(GRID)[1:-1])
+    # The stored labels register the same (element, location) pairs as
+    # the elements of the line do
+    fresh, opened = [subprocess.run(
+        [sys.executable, '-c', script] + args, env=env, check=True,
+        timeout=300, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        for args in ([], [str(tmp_path)])]
+    assert opened == fresh
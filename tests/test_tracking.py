@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import linetracking as lt
+from linetracking.examples import sps_lss2_se as ex
+
+def test_tracklist_ids_leave_losscodes():
+    inits = [[0.06817, -0.00143], [0.2, 0.0], [0.08, -0.00173]]
+    before = len(lt.losscodes)
+    tracks = lt.TrackList(ex.line, inits)
+    assert len(lt.losscodes) == before
+    assert tracks.particles.ids.reshape(-1).tolist() == ['0', '1', '2']
+    # A particle far outside the aperture is still reported lost
+    assert tracks.particles.losses()[1, 0] != 'CIRCULATING'
+    reference = lt.TrackGrid(ex.line, 0.2, 0.201, 0.001, -0.001, 0.0, 0.001)
+    assert tracks.particles.lost[1, 0] == reference.particles.lost[0, 0]
@@ -1,17 +1,336 @@
+import os
+import time
+import shutil
+import tempfile
 import numpy as np
-from .particle import Particle
+from .particle import Particle, ParticleBank, HistoryPolicy
+from .losses import CIRCULATING, losscodes
+from .lattice import fuse_line, compile_line, _interpreter_rows, _run
+from . import jit
+from . import profiling
+from .parallel import pool as _pool
 
-def track(particle, line):
+__all__ = ['track', 'track_batch', 'track_bank', 'grid_tiles',
+           'track_parallel', 'stream_grid', 'TrackGrid', 'TrackList',
+           'TrackSession']
+
+def track(particle, line, history=1):
+    """Track a particle through line, see HistoryPolicy for history"""
+    policy = HistoryPolicy(history)
+    if not policy.start:
+        particle.history = []
+    particle.substeps = policy.substeps
+    nlast = sum(element.nelements for element in line)
+    n = 0
+    profile = profiling.current
     for element in line:
+        # Boundaries inside fused elements, see TransferMap
+        if element.nelements > 1 and policy.every:
+            inner = element.states(particle.s, particle.x, particle.px)
+            for k in range(element.nelements-1):
+                if policy.boundary(n+k+1):
+                    particle.history.append([float(inner[0][k]),
+                                             float(inner[1][k]),
+                                             float(inner[2][k])])
+        if profile is not None:
+            start = time.perf_counter()
         element.track(particle)
-        particle.update_history()
-        if particle.lost != 'CIRCULATING':
+        n += element.nelements
+        lost = particle.losscode != CIRCULATING
+        if profile is not None:
+            profile.record(element, time.perf_counter() - start, 1,
+                           [particle.losscode] if lost else [])
+        if policy.boundary(n) or policy.finalpoint(lost, n == nlast):
+            particle.update_history()
+        if lost:
+            return
+    return
+
+def _scalar_tracker(line, history):
+    """track(particle, line, history) as a function of particle only.
+
+    Uses the compiled line interpreter (see compile_line), unless the
+    line holds elements it does not know or tracking is instrumented.
+    """
+    if profiling.current is not None:
+        return lambda particle: track(particle, line, history)
+    try:
+        table = compile_line(line)
+    except ValueError:
+        return lambda particle: track(particle, line, history)
+    policy = HistoryPolicy(history)
+    rows = _interpreter_rows(table, policy)
+    def tracker(particle):
+        if not policy.start:
+            particle.history = []
+        particle.substeps = policy.substeps
+        _run(particle, rows, policy.final)
+    return tracker
+
+def track_batch(s, x, px, lost, line, record=None, history=1):
+    """Track flat arrays of particles through line, in place.
+
+    Vectorized counterpart of track(), lost holds the integer loss
+    codes and particles already lost are skipped. record(index, s, x,
+    px), if given, receives the states to append to the histories,
+    selected by the history policy (see HistoryPolicy) except for the
+    starting point.
+    """
+    policy = HistoryPolicy(history if record is not None else None)
+    substep = record if policy.substeps else None
+    alive = lost == CIRCULATING
+    nlast = sum(element.nelements for element in line)
+    n = 0
+    profile = profiling.current
+    for element in line:
+        if policy.final or policy.every:
+            entering = np.flatnonzero(alive)
+        if profile is not None:
+            before = alive.copy()
+            start = time.perf_counter()
+        # Boundaries inside fused elements, see TransferMap
+        if element.nelements > 1 and policy.every:
+            inner = element.states(s[entering], x[entering], px[entering])
+            for k in range(element.nelements-1):
+                if policy.boundary(n+k+1) and len(entering) > 0:
+                    record(entering, inner[0][k], inner[1][k], inner[2][k])
+        element.track_batch(s, x, px, alive, lost, substep)
+        if profile is not None:
+            profile.record(element, time.perf_counter() - start,
+                           int(before.sum()), lost[before & ~alive])
+        n += element.nelements
+        if policy.boundary(n):
+            index = entering
+        elif policy.final:
+            index = entering[policy.finalpoint(~alive[entering],
+                                               n == nlast)]
+        else:
+            index = None
+        if index is not None and len(index) > 0:
+            record(index, s[index], x[index], px[index])
+        if not alive.any():
             return
     return
 
+def track_bank(bank, line, history=1, backend='numpy'):
+    """Batch-track all particles of a ParticleBank through line.
+
+    The bank needs room for HistoryPolicy(history).npoints(line)
+    history points, or no history buffer at all. backend 'jit' tracks
+    with the compiled kernels of jit.py, if Numba is installed and
+    compile_line() knows all elements, and with NumPy otherwise.
+    """
+    if backend not in ('numpy', 'jit'):
+        raise ValueError("Unknown backend: " + repr(backend))
+    if backend == 'jit' and jit.available() and profiling.current is None:
+        try:
+            table = compile_line(line)
+        except ValueError:
+            table = None
+        if table is not None:
+            jit.track_table(bank, table, history)
+            return
+    record = None
+    s, x, px = bank.s.reshape(-1), bank.x.reshape(-1), bank.px.reshape(-1)
+    if bank.history is not None:
+        record = bank.record
+        if HistoryPolicy(history).start:
+            record(np.arange(bank.size), s, x, px)
+    track_batch(s, x, px, bank.lost.reshape(-1), line, record, history)
+
+def grid_tiles(shape, tile):
+    """Slices cutting a 2D shape into tiles of at most tile points.
+
+    Tiles are yielded row by row, in the order track_parallel,
+    stream_grid and ResultStore number them.
+    """
+    for i in range(0, shape[0], tile[0]):
+        for j in range(0, shape[1], tile[1]):
+            yield (slice(i, min(i+tile[0], shape[0])),
+                   slice(j, min(j+tile[1], shape[1])))
+
+##################################################
+#                                                #
+#   Parallel tracking                            #
+#                                                #
+##################################################
+
+# Per-process state of the worker pool, set by _init_worker
+_worker = {}
+
+_SHARED = ('s', 'x', 'px', 'lost', 'history', 'nhistory')
+
+# Memory-backed file system for the shared bank arrays, if any
+_SHM = '/dev/shm'
+
+def _init_worker(line, history, registry, specs, backend='numpy'):
+    # Same codes as the parent, labels new to the worker are mapped
+    # back by the parent after each tile
+    losscodes.__dict__.update(registry.__dict__)
+    _worker['line'] = line
+    _worker['history'] = history
+    _worker['backend'] = backend
+    _worker['first'] = len(losscodes)
+    _worker['npoints'] = specs.pop('npoints')
+    _worker['arrays'] = {}
+    for key, (filename, shape, dtype) in specs.items():
+        _worker['arrays'][key] = np.memmap(filename, dtype=dtype,
+                                           mode='r+', shape=shape)
+
+def _track_tile(tile):
+    arrays = _worker['arrays']
+    bank = ParticleBank(arrays['x'][tile], arrays['px'][tile],
+                        _worker['npoints'])
+    track_bank(bank, _worker['line'], _worker['history'], _worker['backend'])
+    for key in _SHARED:
+        if key in arrays:
+            arrays[key][tile] = getattr(bank, key)
+    return tile, losscodes.labels[_worker['first']:]
+
+def track_parallel(bank, line, workers, tile=None, history=1,
+                   backend='numpy'):
+    """Batch-track a 2D ParticleBank in a pool of worker processes.
+
+    The bank is cut into tiles of shape tile, which workers track and
+    write straight into the bank arrays. These are moved, one at a
+    time, into files mapped by all processes, in /dev/shm where it
+    exists, and stay mapped in the bank after the files are removed.
+    The history buffer is only allocated there, never copied, so the
+    bank takes about the same memory as when tracked serially. The
+    line is sent to every worker once, when the pool starts. Tracks
+    in this process when instrumented, see profiling.instrument().
+    """
+    if profiling.current is not None or bank.size == 0:
+        track_bank(bank, line, history, backend)
+        return
+    if tile is None:
+        tile = (max(1, bank.shape[0] // (4*workers)), bank.shape[1])
+    specs = {'npoints': 0}
+    if bank.history is not None:
+        specs['npoints'] = bank.history.shape[-2]
+    directory = tempfile.mkdtemp(prefix='linetracking-',
+                                 dir=_SHM if os.path.isdir(_SHM) else None)
+    try:
+        for key in _SHARED:
+            array = getattr(bank, key)
+            if array is None:
+                continue
+            filename = os.path.join(directory, key)
+            shared = np.memmap(filename, dtype=array.dtype, mode='w+',
+                               shape=array.shape)
+            # Histories are written by the workers, nothing to copy
+            if key != 'history':
+                shared[...] = array
+            setattr(bank, key, shared.view(np.ndarray))
+            specs[key] = (filename, array.shape, array.dtype)
+            del array, shared
+
+        first = len(losscodes)
+        with _pool(workers, initializer=_init_worker,
+                   initargs=(line, history, losscodes, specs,
+                             backend)) as pool:
+            for done, labels in pool.imap_unordered(
+                    _track_tile, list(grid_tiles(bank.shape, tile))):
+                if labels:
+                    codes = bank.lost[done]
+                    new = codes >= first
+                    table = np.array([losscodes.code(label)
+                                      for label in labels])
+                    codes[new] = table[codes[new] - first]
+    finally:
+        # The mappings of the bank outlive the files
+        shutil.rmtree(directory, ignore_errors=True)
+
+##################################################
+#                                                #
+#   Streaming grids                              #
+#                                                #
+##################################################
+
+def _grid_tile(xmin, xres, xpmax, xpres, tile, npoints):
+    """ParticleBank of the gridpoints in tile, see TrackGrid"""
+    ix, ipx = np.ogrid[tile]
+    ix, ipx = np.broadcast_arrays(ix, ipx)
+    # due to matrix indexing we start at xmin,xpmax
+    return ParticleBank(xmin+ix*xres, xpmax-ipx*xpres, npoints)
+
+def _stream_tile(npx):
+    """Default stream_grid tile, rows of at most 2**20 points"""
+    return (max(1, 2**20 // npx), min(npx, 2**20))
+
+def _track_grid_tile(task):
+    tile, grid = task
+    bank = _grid_tile(*grid, tile, _worker['npoints'])
+    track_bank(bank, _worker['line'], _worker['history'], _worker['backend'])
+    return tile, bank, losscodes.labels[_worker['first']:]
+
+def stream_grid(line, xmin, xmax, xres, xpmin, xpmax, xpres, tile=None,
+                history=None, workers=None, fuse=False, skip=(),
+                backend='numpy'):
+    """Track the TrackGrid gridpoints tile by tile, as a generator.
+
+    Yields (index, bank) for each tile in order, where index is the
+    pair of slices of the tile in the full (nx, npx) grid and bank a
+    tracked ParticleBank with its starting points, loss codes and
+    final states. Only the tiles in flight are kept in memory, by
+    default tiles of at most 2**20 points, so e.g. loss tallies can
+    be accumulated over grids far too large for TrackGrid:
+
+        for index, bank in stream_grid(line, ...):
+            counts += np.bincount(bank.lost, minlength=len(counts))
+
+    With workers > 1 up to 2*workers tiles are tracked ahead in a
+    pool of worker processes. Tiles are numbered in the order they
+    are yielded, those numbered in skip are left out.
+    """
+    nx = round((xmax-xmin)/xres)
+    npx = round((xpmax-xpmin)/xpres)
+    if fuse:
+        line = fuse_line(line)
+    if tile is None:
+        tile = _stream_tile(npx)
+    grid = (xmin, xres, xpmax, xpres)
+    npoints = HistoryPolicy(history).npoints(line)
+    tiles = (index for number, index
+             in enumerate(grid_tiles((nx, npx), tile))
+             if number not in skip)
+
+    if workers is None or workers <= 1:
+        for index in tiles:
+            bank = _grid_tile(*grid, index, npoints)
+            track_bank(bank, line, history, backend)
+            yield index, bank
+        return
+
+    first = len(losscodes)
+    with _pool(workers, initializer=_init_worker,
+               initargs=(line, history, losscodes, {'npoints': npoints},
+                         backend)) as pool:
+        pending = []
+        for index in tiles:
+            pending.append(pool.apply_async(_track_grid_tile,
+                                            ((index, grid),)))
+            if len(pending) < 2*workers:
+                continue
+            yield _remapped(pending.pop(0).get(), first)
+        while pending:
+            yield _remapped(pending.pop(0).get(), first)
+
+def _remapped(result, first):
+    """(index, bank) of a worker tile, with the parent's loss codes"""
+    index, bank, labels = result
+    if labels:
+        new = bank.lost >= first
+        table = np.array([losscodes.code(label) for label in labels])
+        bank.lost = bank.lost.astype(losscodes.dtype())
+        bank.lost[new] = table[bank.lost[new] - first]
+    return index, bank
+
 class TrackGrid:
     """Array of particles tracked through line starting from gridpoints"""
-    def __init__(self, line, xmin, xmax, xres, xpmin, xpmax, xpres):
+    def __init__(self, line, xmin, xmax, xres, xpmin, xpmax, xpres,
+                 batch=True, workers=None, tile=None, history=1,
+                 fuse=False, backend='numpy'):
         self.xmin = xmin
         self.xmax = xmax
         self.xres = xres
@@ -22,21 +341,146 @@ class TrackGrid:
         self.nx = round((xmax-xmin)/xres)
         self.npx = round((xpmax-xpmin)/xpres)
 
-        self.particles = np.zeros((self.nx, self.npx), dtype=object)
+        if fuse:
+            line = fuse_line(line)
 
-        for index, _ in np.ndenumerate(self.particles):
-            # due to matrix indexing we start at xmin,xpmax
-            self.particles[index] = Particle(xmin+index[0]*xres,
-                                             xpmax-index[1]*xpres)
-            track(self.particles[index], line)
+        # due to matrix indexing we start at xmin,xpmax
+        ix, ipx = np.indices((self.nx, self.npx))
+        self.particles = ParticleBank(xmin+ix*xres, xpmax-ipx*xpres,
+                                      HistoryPolicy(history).npoints(line))
+
+        if batch and workers is not None and workers > 1:
+            track_parallel(self.particles, line, workers, tile, history,
+                           backend)
+            return
+        if batch:
+            track_bank(self.particles, line, history, backend)
+            return
+
+        tracker = _scalar_tracker(line, history)
+        for index in np.ndindex(self.particles.shape):
+            particle = Particle(float(self.particles.x[index]),
+                                float(self.particles.px[index]))
+            tracker(particle)
+            self.particles.store(index, particle)
 
 class TrackList:
-    """List of particles tracked through line starting from initial conditions"""
-    def __init__(self, line, inits):
-        self.particles = np.zeros((len(inits), 1), dtype=object)
-
-        for index, _ in np.ndenumerate(self.particles):
-            self.particles[index] = Particle(inits[index[0]][0],
-                                             inits[index[0]][1])
-            track(self.particles[index], line)
-            self.particles[index].lost = str(index[0])
+    """List of particles tracked through line starting from initial conditions
+
+    particles.ids holds the index of every particle in inits.
+    """
+    def __init__(self, line, inits, batch=True, history=1, fuse=False,
+                 backend='numpy'):
+        if fuse:
+            line = fuse_line(line)
+        inits = np.array(inits, dtype=float).reshape(-1, 2)
+        self.particles = ParticleBank(inits[:, :1], inits[:, 1:],
+                                      HistoryPolicy(history).npoints(line))
+
+        if batch:
+            track_bank(self.particles, line, history, backend)
+        else:
+            tracker = _scalar_tracker(line, history)
+            for index in np.ndindex(self.particles.shape):
+                particle = Particle(float(self.particles.x[index]),
+                                    float(self.particles.px[index]))
+                tracker(particle)
+                self.particles.store(index, particle)
+
+        self.particles.set_ids(range(len(inits)))
+
+##################################################
+#                                                #
+#   Incremental tracking                         #
+#                                                #
+##################################################
+
+class TrackSession:
+    """Particles tracked through line, retracked as elements change.
+
+    inits holds (x, px) along its last axis, particles is a ParticleBank
+    shaped like the other axes, without history. The state of the
+    particles is snapshot at element boundaries. update() finds the
+    elements whose parameters changed or that were replaced since the
+    last tracking (setting an attribute drops an element's cache, see
+    elements._Element) and retracks from the last snapshot before the
+    first of them, so tuning downstream elements skips the upstream
+    part of the line.
+
+    Snapshots take up to memory bytes. Boundaries in front of elements
+    changed before are kept first, most recent first, the rest of the
+    budget is spread evenly along the line.
+    """
+    def __init__(self, line, inits, memory=256E6):
+        self.line = line
+        inits = np.asarray(inits, dtype=float)
+        self.memory = memory
+        self.particles = ParticleBank(inits[..., 0], inits[..., 1])
+        self._start = (self.particles.s.reshape(-1).copy(),
+                       self.particles.x.reshape(-1).copy(),
+                       self.particles.px.reshape(-1).copy(),
+                       self.particles.lost.reshape(-1).copy())
+        self._seen = None
+        self._snapshots = {}
+        self._hot = []
+        self.retracked = 0
+        self.update()
+
+    def changed(self):
+        """Indices of the elements changed since the last tracking"""
+        if self._seen is None or len(self._seen) != len(self.line):
+            return list(range(len(self.line)))
+        return [index for index, (element, (seen, cache))
+                in enumerate(zip(self.line, self._seen))
+                if element is not seen or element._cached() is not cache]
+
+    def _keep(self):
+        """Boundaries to snapshot within the memory budget"""
+        size = sum(array.nbytes for array in self._start)
+        budget = int(self.memory // max(size, 1))
+        boundaries = range(1, len(self.line))
+        if budget >= len(boundaries):
+            return set(boundaries)
+        keep = set(self._hot[:budget])
+        spread = budget - len(keep)
+        if spread > 0:
+            keep.update(boundaries[int(k)] for k in np.linspace(
+                0, len(boundaries)-1, spread))
+        return keep
+
+    def update(self):
+        """Retrack from the first changed element, returns particles"""
+        changed = self.changed()
+        self.retracked = 0
+        if not changed:
+            return self.particles
+        if self._seen is not None and len(self._seen) == len(self.line):
+            for index in reversed(changed[changed[0] == 0:]):
+                if index in self._hot:
+                    self._hot.remove(index)
+                self._hot.insert(0, index)
+        else:
+            self._snapshots = {}
+        first = changed[0]
+        start = max([boundary for boundary in self._snapshots
+                     if boundary <= first], default=0)
+        state = self._snapshots.get(start, self._start)
+        s, x, px, lost = (array.copy() for array in state)
+        keep = self._keep()
+        self._snapshots = {boundary: state for boundary, state
+                           in self._snapshots.items()
+                           if boundary <= start and boundary in keep}
+        alive = lost == CIRCULATING
+        for index in range(start, len(self.line)):
+            if index > start and index in keep:
+                self._snapshots[index] = (s.copy(), x.copy(), px.copy(),
+                                          lost.copy())
+            self.line[index].track_batch(s, x, px, alive, lost)
+            self.retracked += 1
+        self._seen = [(element, element._cached()) for element in self.line]
+        shape = self.particles.shape
+        self.particles.s = s.reshape(shape)
+        self.particles.x = x.reshape(shape)
+        self.particles.px = px.reshape(shape)
+        self.particles.lost = lost.reshape(shape)
+        return self.particles